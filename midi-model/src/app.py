@@ -17,6 +17,7 @@ from transformers import DynamicCache
 from safetensors.torch import load_file as safe_load_file
 
 import MIDI
+from midi_grammar import get_grammar
 from midi_model import MIDIModel, config_name_list, MIDIModelConfig
 from midi_synthesizer import MidiSynthesizer
 from midi_tokenizer import MIDITokenizerV1, MIDITokenizerV2
@@ -27,10 +28,8 @@ MAX_SEED = np.iinfo(np.int32).max
 @torch.inference_mode()
 def generate(prompt=None, batch_size=1, max_len=512, temp=1.0, top_p=0.98, top_k=20,
              disable_patch_change=False, disable_control_change=False, disable_channels=None, generator=None):
-    if disable_channels is not None:
-        disable_channels = [tokenizer.parameter_ids["channel"][c] for c in disable_channels]
-    else:
-        disable_channels = []
+    grammar = get_grammar(tokenizer, disable_patch_change, disable_control_change, disable_channels)
+    mask_rows = torch.from_numpy(grammar.rows).to(model.device)
     max_token_seq = tokenizer.max_token_seq
     if prompt is None:
         input_tensor = torch.full((1, max_token_seq), tokenizer.pad_id, dtype=torch.long, device=model.device)
@@ -57,35 +56,13 @@ def generate(prompt=None, batch_size=1, max_len=512, temp=1.0, top_p=0.98, top_k
     past_len = 0
     with bar:
         while cur_len < max_len:
-            end = [False] * batch_size
+            state = grammar.new_state(batch_size)
             hidden = model.forward(input_tensor[:, past_len:], cache=cache1)[:, -1]
             next_token_seq = None
-            event_names = [""] * batch_size
             cache2 = DynamicCache()
             for i in range(max_token_seq):
-                mask = torch.zeros((batch_size, tokenizer.vocab_size), dtype=torch.int64, device=model.device)
-                for b in range(batch_size):
-                    if end[b]:
-                        mask[b, tokenizer.pad_id] = 1
-                        continue
-                    if i == 0:
-                        mask_ids = list(tokenizer.event_ids.values()) + [tokenizer.eos_id]
-                        if disable_patch_change:
-                            mask_ids.remove(tokenizer.event_ids["patch_change"])
-                        if disable_control_change:
-                            mask_ids.remove(tokenizer.event_ids["control_change"])
-                        mask[b, mask_ids] = 1
-                    else:
-                        param_names = tokenizer.events[event_names[b]]
-                        if i > len(param_names):
-                            mask[b, tokenizer.pad_id] = 1
-                            continue
-                        param_name = param_names[i - 1]
-                        mask_ids = tokenizer.parameter_ids[param_name]
-                        if param_name == "channel":
-                            mask_ids = [i for i in mask_ids if i not in disable_channels]
-                        mask[b, mask_ids] = 1
-                mask = mask.unsqueeze(1)
+                row_ids = torch.from_numpy(grammar.row_ids(state, i)).to(model.device)
+                mask = mask_rows[row_ids].unsqueeze(1)
                 x = next_token_seq
                 if i != 0:
                     hidden = None
@@ -95,17 +72,10 @@ def generate(prompt=None, batch_size=1, max_len=512, temp=1.0, top_p=0.98, top_k
                 samples = model.sample_top_p_k(scores, top_p, top_k, generator=generator)
                 if i == 0:
                     next_token_seq = samples
-                    for b in range(batch_size):
-                        if end[b]:
-                            continue
-                        eid = samples[b].item()
-                        if eid == tokenizer.eos_id:
-                            end[b] = True
-                        else:
-                            event_names[b] = tokenizer.id_events[eid]
+                    state = samples[:, 0].cpu().numpy()
                 else:
                     next_token_seq = torch.cat([next_token_seq, samples], dim=1)
-                    if all([len(tokenizer.events[event_names[b]]) == i for b in range(batch_size) if not end[b]]):
+                    if grammar.is_complete(state, i):
                         break
             if next_token_seq.shape[1] < max_token_seq:
                 next_token_seq = F.pad(next_token_seq, (0, max_token_seq - next_token_seq.shape[1]),
@@ -116,7 +86,7 @@ def generate(prompt=None, batch_size=1, max_len=512, temp=1.0, top_p=0.98, top_k
             cur_len += 1
             bar.update(1)
             yield next_token_seq[:, 0].cpu().numpy()
-            if all(end):
+            if np.all(state == tokenizer.eos_id):
                 break
 
 
@@ -4,213 +4,28 @@ import json
 import os.path
 import time
 from concurrent.futures import ThreadPoolExecutor
-from pathlib import Path
 from sys import exit
 
 import gradio as gr
 import numpy as np
 import onnxruntime as rt
 import requests
-import tqdm
 from packaging import version
 
 import MIDI
+import midi_inference
+# The inference core lives in midi_inference, its names stay importable from here
+from midi_inference import (KV_CACHE_SLIDE, MAX_MID_SEQ, SESSION_PROFILES, GenerateSession,  # noqa: F401
+                            KVCache, PrefixCache, Sampler, apply_io_binding, create_session, decode_tokens,
+                            download, download_if_not_exit, draw_uniform, generate, get_emb_size,
+                            get_tokenizer, run_with_cache, sample_top_p_k, softmax)
+from model_registry import ModelPair, ModelRegistry, model_nbytes
 from midi_synthesizer import MidiSynthesizer
-from midi_tokenizer import MIDITokenizer
+from midi_tokenizer import StreamingDetokenizer
 
 VERSION = "v1.3.5"
 MAX_SEED = np.iinfo(np.int32).max
 
-rt.set_default_logger_severity(3)
-
-
-def softmax(x, axis):
-    x_max = np.amax(x, axis=axis, keepdims=True)
-    exp_x_shifted = np.exp(x - x_max)
-    return exp_x_shifted / np.sum(exp_x_shifted, axis=axis, keepdims=True)
-
-
-def sample_top_p_k(probs, p, k, generator=None):
-    if generator is None:
-        generator = np.random
-    probs_idx = np.argsort(-probs, axis=-1)
-    probs_sort = np.take_along_axis(probs, probs_idx, -1)
-    probs_sum = np.cumsum(probs_sort, axis=-1)
-    mask = probs_sum - probs_sort > p
-    probs_sort[mask] = 0.0
-    mask = np.zeros(probs_sort.shape[-1])
-    mask[:k] = 1
-    probs_sort = probs_sort * mask
-    probs_sort /= np.sum(probs_sort, axis=-1, keepdims=True)
-    shape = probs_sort.shape
-    probs_sort_flat = probs_sort.reshape(-1, shape[-1])
-    probs_idx_flat = probs_idx.reshape(-1, shape[-1])
-    next_token = np.stack([generator.choice(idxs, p=pvals) for pvals, idxs in zip(probs_sort_flat, probs_idx_flat)])
-    next_token = next_token.reshape(*shape[:-1])
-    return next_token
-
-def apply_io_binding(model: rt.InferenceSession, inputs, outputs, batch_size, past_len, cur_len):
-    io_binding = model.io_binding()
-    for input_ in  model.get_inputs():
-        name = input_.name
-        if name.startswith("past_key_values"):
-            present_name = name.replace("past_key_values", "present")
-            if present_name in outputs:
-                v = outputs[present_name]
-                if past_len > 4095:
-                    v = v.numpy()
-                    v = v[:, :, -4095:]
-                    v = rt.OrtValue.ortvalue_from_numpy(v, device_type=device)
-            else:
-                v = rt.OrtValue.ortvalue_from_shape_and_type(
-                    (batch_size, input_.shape[1], past_len, input_.shape[3]),
-                    element_type=np.float32,
-                    device_type=device)
-            inputs[name] = v
-        else:
-            v = inputs[name]
-        io_binding.bind_ortvalue_input(name, v)
-
-    for output in model.get_outputs():
-        name = output.name
-        if name.startswith("present"):
-            v = rt.OrtValue.ortvalue_from_shape_and_type(
-                (batch_size, output.shape[1], cur_len, output.shape[3]),
-                element_type=np.float32,
-                device_type=device)
-            outputs[name] = v
-        else:
-            v = outputs[name]
-        io_binding.bind_ortvalue_output(name, v)
-    return io_binding
-
-def generate(model, prompt=None, batch_size=1, max_len=512, temp=1.0, top_p=0.98, top_k=20,
-             disable_patch_change=False, disable_control_change=False, disable_channels=None, generator=None):
-    tokenizer = model[2]
-    if disable_channels is not None:
-        disable_channels = [tokenizer.parameter_ids["channel"][c] for c in disable_channels]
-    else:
-        disable_channels = []
-    if generator is None:
-        generator = np.random
-    max_token_seq = tokenizer.max_token_seq
-    if prompt is None:
-        input_tensor = np.full((1, max_token_seq), tokenizer.pad_id, dtype=np.int64)
-        input_tensor[0, 0] = tokenizer.bos_id  # bos
-        input_tensor = input_tensor[None, :, :]
-        input_tensor = np.repeat(input_tensor, repeats=batch_size, axis=0)
-    else:
-        if len(prompt.shape) == 2:
-            prompt = prompt[None, :]
-            prompt = np.repeat(prompt, repeats=batch_size, axis=0)
-        elif prompt.shape[0] == 1:
-            prompt = np.repeat(prompt, repeats=batch_size, axis=0)
-        elif len(prompt.shape) != 3 or prompt.shape[0] != batch_size:
-            raise ValueError(f"invalid shape for prompt, {prompt.shape}")
-        prompt = prompt[..., :max_token_seq]
-        if prompt.shape[-1] < max_token_seq:
-            prompt = np.pad(prompt, ((0, 0), (0, 0), (0, max_token_seq - prompt.shape[-1])),
-                            mode="constant", constant_values=tokenizer.pad_id)
-        input_tensor = prompt
-    input_tensor = input_tensor[:, -4096:]
-    cur_len = input_tensor.shape[1]
-    bar = tqdm.tqdm(desc="generating", total=max_len - cur_len)
-    model0_inputs = {}
-    model0_outputs = {}
-    emb_size = 1024
-    for output in model[0].get_outputs():
-        if output.name == "hidden":
-            emb_size = output.shape[2]
-    past_len = 0
-    with bar:
-        while cur_len < max_len:
-            end = [False] * batch_size
-            model0_inputs["x"] = rt.OrtValue.ortvalue_from_numpy(input_tensor[:, past_len:], device_type=device)
-            model0_outputs["hidden"] = rt.OrtValue.ortvalue_from_shape_and_type(
-                (batch_size, cur_len - past_len, emb_size),
-                element_type=np.float32,
-                device_type=device)
-            io_binding = apply_io_binding(model[0], model0_inputs, model0_outputs, batch_size, past_len, cur_len)
-            io_binding.synchronize_inputs()
-            model[0].run_with_iobinding(io_binding)
-            io_binding.synchronize_outputs()
-
-            hidden = model0_outputs["hidden"].numpy()[:, -1:]
-            next_token_seq = np.zeros((batch_size, 0), dtype=np.int64)
-            event_names = [""] * batch_size
-            model1_inputs = {"hidden": rt.OrtValue.ortvalue_from_numpy(hidden, device_type=device)}
-            model1_outputs = {}
-            for i in range(max_token_seq):
-                mask = np.zeros((batch_size, tokenizer.vocab_size), dtype=np.int64)
-                for b in range(batch_size):
-                    if end[b]:
-                        mask[b, tokenizer.pad_id] = 1
-                        continue
-                    if i == 0:
-                        mask_ids = list(tokenizer.event_ids.values()) + [tokenizer.eos_id]
-                        if disable_patch_change:
-                            mask_ids.remove(tokenizer.event_ids["patch_change"])
-                        if disable_control_change:
-                            mask_ids.remove(tokenizer.event_ids["control_change"])
-                        mask[b, mask_ids] = 1
-                    else:
-                        param_names = tokenizer.events[event_names[b]]
-                        if i > len(param_names):
-                            mask[b, tokenizer.pad_id] = 1
-                            continue
-                        param_name = param_names[i - 1]
-                        mask_ids = tokenizer.parameter_ids[param_name]
-                        if param_name == "channel":
-                            mask_ids = [i for i in mask_ids if i not in disable_channels]
-                        mask[b, mask_ids] = 1
-                mask = mask[:, None, :]
-                x = next_token_seq
-                if i != 0:
-                    # cached
-                    if i == 1:
-                        hidden = np.zeros((batch_size, 0, emb_size), dtype=np.float32)
-                        model1_inputs["hidden"] = rt.OrtValue.ortvalue_from_numpy(hidden, device_type=device)
-                    x = x[:, -1:]
-                model1_inputs["x"] = rt.OrtValue.ortvalue_from_numpy(x, device_type=device)
-                model1_outputs["y"] = rt.OrtValue.ortvalue_from_shape_and_type(
-                    (batch_size, 1, tokenizer.vocab_size),
-                    element_type=np.float32,
-                    device_type=device
-                )
-                io_binding = apply_io_binding(model[1], model1_inputs, model1_outputs, batch_size, i, i+1)
-                io_binding.synchronize_inputs()
-                model[1].run_with_iobinding(io_binding)
-                io_binding.synchronize_outputs()
-                logits = model1_outputs["y"].numpy()
-                scores = softmax(logits / temp, -1) * mask
-                samples = sample_top_p_k(scores, top_p, top_k, generator)
-                if i == 0:
-                    next_token_seq = samples
-                    for b in range(batch_size):
-                        if end[b]:
-                            continue
-                        eid = samples[b].item()
-                        if eid == tokenizer.eos_id:
-                            end[b] = True
-                        else:
-                            event_names[b] = tokenizer.id_events[eid]
-                else:
-                    next_token_seq = np.concatenate([next_token_seq, samples], axis=1)
-                    if all([len(tokenizer.events[event_names[b]]) == i for b in range(batch_size) if not end[b]]):
-                        break
-            if next_token_seq.shape[1] < max_token_seq:
-                next_token_seq = np.pad(next_token_seq,
-                                        ((0, 0), (0, max_token_seq - next_token_seq.shape[-1])),
-                                        mode="constant", constant_values=tokenizer.pad_id)
-            next_token_seq = next_token_seq[:, None, :]
-            input_tensor = np.concatenate([input_tensor, next_token_seq], axis=1)
-            past_len = cur_len
-            cur_len += 1
-            bar.update(1)
-            yield next_token_seq[:, 0]
-            if all(end):
-                break
-
 
 def create_msg(name, data):
     return {"name": name, "data": data}
@@ -223,30 +38,19 @@ def send_msgs(msgs):
 def run(model_name, tab, mid_seq, continuation_state, continuation_select, instruments, drum_kit, bpm, time_sig,
         key_sig, mid, midi_events, reduce_cc_st, remap_track_channel, add_default_instr, remove_empty_channels,
         seed, seed_rand, gen_events, temp, top_p, top_k, allow_cc):
-    global current_model, model_base, model_token, tokenizer
+    global current_model, model_base, model_token, tokenizer, generate_session, output_detokenizers
     if current_model != model_name:
-        gr.Info("Loading model...")
-        model_info = models_info[model_name]
-        model_config, model_config_url = model_info[0]
-        model_base_path, model_base_url = model_info[1]
-        model_token_path, model_token_url = model_info[2]
-        try:
-            if model_config.endswith(".json"):
-                download_if_not_exit(model_config_url, model_config)
-            download_if_not_exit(model_base_url, model_base_path)
-            download_if_not_exit(model_token_url, model_token_path)
-        except Exception as e:
-            print(e)
-            raise gr.Error("Failed to download files.")
-        try:
-            model_base = rt.InferenceSession(model_base_path, providers=providers)
-            model_token = rt.InferenceSession(model_token_path, providers=providers)
-            tokenizer = get_tokenizer(model_config)
-            current_model = model_name
+        # Models used before stay resident within --models-memory-mb, switching back to them is instant
+        resident = model_name in model_registry.models
+        if not resident:
+            gr.Info("Loading model...")
+        with model_registry.use(model_name) as loaded:
+            model_base, model_token, tokenizer = loaded.model
+        current_model = model_name
+        generate_session = None
+        output_detokenizers = [None] * OUTPUT_BATCH_SIZE
+        if not resident:
             gr.Info("Model loaded")
-        except Exception as e:
-            print(e)
-            raise gr.Error("Failed to load models, maybe you need to delete them and re-download it.")
 
     bpm = int(bpm)
     if time_sig == "auto":
@@ -332,11 +136,20 @@ def run(model_name, tab, mid_seq, continuation_state, continuation_select, instr
             init_msgs += [create_msg("visualizer_clear", [i, tokenizer.version]),
                           create_msg("visualizer_append", [i, events])]
     yield mid_seq, continuation_state, seed, send_msgs(init_msgs)
+    # continuing every output resumes from the retained kv cache, anything else starts a new session
+    if not (tab == 2 and continuation_select == 0) or generate_session is None:
+        generate_session = GenerateSession()
+        output_detokenizers = [None] * OUTPUT_BATCH_SIZE
+    # the scores are built as events arrive, finish_run and render_audio only copy them out
+    for j in range(OUTPUT_BATCH_SIZE):
+        if output_detokenizers[j] is None or len(output_detokenizers[j]) != len(mid_seq[j]):
+            output_detokenizers[j] = StreamingDetokenizer(tokenizer)
+            output_detokenizers[j].extend(mid_seq[j])
     model = (model_base, model_token, tokenizer)
     midi_generator = generate(model, mid, batch_size=OUTPUT_BATCH_SIZE, max_len=max_len, temp=temp,
                               top_p=top_p, top_k=top_k, disable_patch_change=disable_patch_change,
                               disable_control_change=not allow_cc, disable_channels=disable_channels,
-                              generator=generator)
+                              generator=generator, session=generate_session)
     events = [list() for i in range(OUTPUT_BATCH_SIZE)]
     t = time.time()
     for i, token_seqs in enumerate(midi_generator):
@@ -344,6 +157,7 @@ def run(model_name, tab, mid_seq, continuation_state, continuation_select, instr
         for j in range(OUTPUT_BATCH_SIZE):
             token_seq = token_seqs[j]
             mid_seq[j].append(token_seq)
+            output_detokenizers[j].append(token_seq)
             events[j].append(tokenizer.tokens2event(token_seq))
         if time.time() - t > 0.2:
             msgs = [create_msg("progress", [i + 1, gen_events])]
@@ -355,6 +169,14 @@ def run(model_name, tab, mid_seq, continuation_state, continuation_select, instr
     yield mid_seq, continuation_state, seed, send_msgs([])
 
 
+def output_score(i, mid_seq):
+    """score of output i, from its detokenizer if that has seen exactly this sequence"""
+    detokenizer = output_detokenizers[i]
+    if detokenizer is not None and len(detokenizer) == len(mid_seq):
+        return detokenizer.score()
+    return tokenizer.detokenize(mid_seq)
+
+
 def finish_run(mid_seq):
     if mid_seq is None:
         outputs = [None] * OUTPUT_BATCH_SIZE
@@ -365,7 +187,7 @@ def finish_run(mid_seq):
         os.mkdir("outputs")
     for i in range(OUTPUT_BATCH_SIZE):
         events = [tokenizer.tokens2event(tokens) for tokens in mid_seq[i]]
-        mid = tokenizer.detokenize(mid_seq[i])
+        mid = output_score(i, mid_seq[i])
         with open(f"outputs/output{i + 1}.mid", 'wb') as f:
             f.write(MIDI.score2midi(mid))
         outputs.append(f"outputs/output{i + 1}.mid")
@@ -387,7 +209,7 @@ def render_audio(mid_seq, should_render_audio):
         os.mkdir("outputs")
     audio_futures = []
     for i in range(OUTPUT_BATCH_SIZE):
-        mid = tokenizer.detokenize(mid_seq[i])
+        mid = output_score(i, mid_seq[i])
         audio_future = thread_pool.submit(synthesis_task, mid)
         audio_futures.append(audio_future)
     for future in audio_futures:
@@ -397,6 +219,35 @@ def render_audio(mid_seq, should_render_audio):
     return tuple(outputs)
 
 
+def load_model(model_name):
+    """ModelRegistry loader: download the files of models_info[model_name] if needed and open them"""
+    model_info = models_info[model_name]
+    model_config, model_config_url = model_info[0]
+    model_base_path, model_base_url = model_info[1]
+    model_token_path, model_token_url = model_info[2]
+    try:
+        if model_config.endswith(".json"):
+            download_if_not_exit(model_config_url, model_config)
+        download_if_not_exit(model_base_url, model_base_path)
+        download_if_not_exit(model_token_url, model_token_path)
+    except Exception as e:
+        print(e)
+        raise gr.Error("Failed to download files.")
+    try:
+        if opt.quantized:
+            from quantize import quantized_model
+            model_base_path = quantized_model(model_base_path)
+            model_token_path = quantized_model(model_token_path)
+        return ModelPair(model_name,
+                         create_session(model_base_path, providers, opt.ort_profile),
+                         create_session(model_token_path, providers, opt.ort_profile),
+                         get_tokenizer(model_config),
+                         model_nbytes(model_base_path, model_token_path))
+    except Exception as e:
+        print(e)
+        raise gr.Error("Failed to load models, maybe you need to delete them and re-download it.")
+
+
 def undo_continuation(mid_seq, continuation_state):
     if mid_seq is None or len(continuation_state) < 2:
         return mid_seq, continuation_state, send_msgs([])
@@ -414,30 +265,6 @@ def undo_continuation(mid_seq, continuation_state):
     return mid_seq, continuation_state, send_msgs(end_msgs)
 
 
-def download(url, output_file):
-    print(f"Downloading {output_file} from {url}")
-    response = requests.get(url, stream=True)
-    file_size = int(response.headers.get("Content-Length", 0))
-    with tqdm.tqdm(total=file_size, unit="B", unit_scale=True, unit_divisor=1024,
-                   desc=f"Downloading {output_file}") as pbar:
-        with open(output_file, "wb") as f:
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
-                    pbar.update(len(chunk))
-
-
-def download_if_not_exit(url, output_file):
-    if os.path.exists(output_file):
-        return
-    try:
-        Path(output_file).parent.mkdir(parents=True, exist_ok=True)
-        download(url, output_file)
-    except Exception as e:
-        print(f"Failed to download {output_file} from {url}")
-        raise e
-
-
 def load_javascript(dir="javascript"):
     scripts_list = glob.glob(f"{dir}/*.js")
     javascript = ""
@@ -458,27 +285,6 @@ def load_javascript(dir="javascript"):
 
     gr.routes.templates.TemplateResponse = template_response
 
-def get_tokenizer(config_name_or_path):
-    if config_name_or_path.endswith(".json"):
-        with open(config_name_or_path, "r") as f:
-            config = json.load(f)
-        tv = config["tokenizer"]["version"]
-        o = config["tokenizer"]["optimise_midi"]
-    else:
-        tv, size = config_name_or_path.split("-")
-        tv = tv[1:]
-        if tv[-1] == "o":
-            o = True
-            tv = tv[:-1]
-        else:
-            o = False
-        if tv not in ["v1", "v2"]:
-            raise ValueError(f"Unknown tokenizer version {tv}")
-    tokenizer = MIDITokenizer(tv)
-    tokenizer.set_optimise_midi(o)
-    return tokenizer
-
-
 def check_update(current_ver):
     v1 = version.parse(current_ver)
     url = f"https://api.github.com/repos/SkyTNT/midi-model/releases/latest"
@@ -507,6 +313,12 @@ if __name__ == "__main__":
     parser.add_argument("--port", type=int, default=-1, help="gradio server port")
     parser.add_argument("--batch", type=int, default=8, help="batch size")
     parser.add_argument("--max-gen", type=int, default=4096, help="max")
+    parser.add_argument("--ort-profile", type=str, default="default", choices=list(SESSION_PROFILES),
+                        help="onnxruntime session profile (optimized graphs are cached next to the models)")
+    parser.add_argument("--quantized", action="store_true", default=False,
+                        help="run the INT8 weight-quantized models (*.int8.onnx, made by quantize.py on first use)")
+    parser.add_argument("--models-memory-mb", type=int, default=4096,
+                        help="memory budget for keeping loaded models resident when switching models")
     parser.add_argument("--soundfont-path", type=str, default="soundfont.sf2", help="soundfont")
     parser.add_argument("--model-config", type=str,
                         default="models/default/config.json",
@@ -578,6 +390,9 @@ if __name__ == "__main__":
         ]
     }
     current_model = list(models_info.keys())[0]
+    model_registry = ModelRegistry(models_info.keys(), load_model, opt.models_memory_mb * 1024 * 1024)
+    generate_session = None
+    output_detokenizers = [None] * OUTPUT_BATCH_SIZE
     try:
         download_if_not_exit(opt.soundfont_url, opt.soundfont_path)
         if opt.model_config.endswith(".json"):
@@ -591,7 +406,6 @@ if __name__ == "__main__":
     soundfont_path = opt.soundfont_path
     synthesizer = MidiSynthesizer(soundfont_path)
     thread_pool = ThreadPoolExecutor(max_workers=OUTPUT_BATCH_SIZE)
-    tokenizer = get_tokenizer(opt.model_config)
     
     # Check if CUDA is available and use it, otherwise fall back to CPU
     available_providers = rt.get_available_providers()
@@ -603,10 +417,11 @@ if __name__ == "__main__":
         providers = ['CPUExecutionProvider']
         device = "cpu"
         print("CUDA not available, using CPU for inference")
+    midi_inference.device = device
     
     try:
-        model_base = rt.InferenceSession(opt.model_base_path, providers=providers)
-        model_token = rt.InferenceSession(opt.model_token_path, providers=providers)
+        with model_registry.use(current_model) as loaded:
+            model_base, model_token, tokenizer = loaded.model
     except Exception as e:
         print(e)
         input("Failed to load models, maybe you need to delete them and re-download it.\nPress any key to continue...")
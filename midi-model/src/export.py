@@ -9,9 +9,12 @@ from midi_model import MIDIModel, config_name_list, MIDIModelConfig
 
 
 class MIDIModelBase(nn.Module):
-    def __init__(self, model):
+    def __init__(self, model, last_hidden_only=False):
         super().__init__()
         self.net = model.net
+        # decoding only reads the hidden state of the last event, the variant without the others
+        # keeps prefill output (batch, 1, n_embd) however long the prompt is
+        self.last_hidden_only = last_hidden_only
 
     def forward(self, x, past_kv):
         cache = DynamicCache.from_legacy_cache(past_kv)
@@ -20,7 +23,10 @@ class MIDIModelBase(nn.Module):
         x = self.net.forward(inputs_embeds=x,
                              past_key_values=cache,
                              use_cache=True)
-        return x.last_hidden_state, cache.to_legacy_cache()
+        hidden = x.last_hidden_state
+        if self.last_hidden_only:
+            hidden = hidden[:, -1:]
+        return hidden, cache.to_legacy_cache()
 
 
 class MIDIModelToken(nn.Module):
@@ -29,7 +35,7 @@ class MIDIModelToken(nn.Module):
         self.net_token = model.net_token
         self.lm_head = model.lm_head
 
-    def forward(self, hidden_state, x, past_kv):
+    def forward(self, hidden_state, x, past_kv, id_range=None):
         cache = DynamicCache.from_legacy_cache(past_kv)
         x = self.net_token.embed_tokens(x)
         x = torch.cat([hidden_state, x], dim=1)
@@ -37,7 +43,40 @@ class MIDIModelToken(nn.Module):
         hidden_state = self.net_token.forward(inputs_embeds=hidden_state,
                                               past_key_values=cache,
                                               use_cache=True).last_hidden_state
-        return self.lm_head(hidden_state), cache.to_legacy_cache()
+        if id_range is None:
+            return self.lm_head(hidden_state), cache.to_legacy_cache()
+        # range head: decoding samples the last position among the ids of one parameter (or the
+        # events), so only the lm_head rows [id_range[0], id_range[1]) are multiplied
+        weight = self.lm_head.weight[id_range[0]:id_range[1]]
+        return hidden_state[:, -1:] @ weight.t(), cache.to_legacy_cache()
+
+
+class MIDIModelTokenSampler(MIDIModelToken):
+    """
+    Range head that also samples: the steps of midi_inference.Sampler and sample_top_p_k in the
+    graph, so decoding moves the grammar mask, sampling params and one uniform draw per row in and
+    the sampled ids out, instead of the logits. The draws come from the caller's generator, which
+    keeps the results reproducible from the seed.
+    id_range is the union of the rows' ranges; row_range (batch, 2) is each row's own [start, end),
+    the softmax of a row only runs over it so its ids do not depend on the other rows of the batch.
+    """
+
+    def forward(self, hidden_state, x, past_kv, id_range, row_range, mask, temp, top_p, top_k,
+                uniform):
+        logits, past_kv = super().forward(hidden_state, x, past_kv, id_range)
+        ids = torch.arange(logits.shape[-1], device=logits.device) + id_range[0]
+        outside = (ids < row_range[:, :1]) | (ids >= row_range[:, 1:])
+        logits = logits[:, -1].masked_fill(outside, float("-inf"))
+        probs = torch.softmax(logits / temp[:, None], dim=-1) * mask.to(logits.dtype)
+        probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
+        cdf = probs_sort.cumsum(dim=-1)
+        rank = torch.arange(probs_sort.shape[-1], device=probs.device)
+        cut = (cdf - probs_sort > top_p[:, None]) | (rank >= top_k.clamp(min=1)[:, None])
+        cdf = probs_sort.masked_fill(cut, 0.0).cumsum(dim=-1).double()
+        # the first id whose cdf exceeds the draw, the last one at most
+        choice = (cdf[:, :-1] <= (uniform * cdf[:, -1])[:, None]).sum(dim=-1)
+        ids = probs_idx.gather(-1, choice[:, None])[:, 0] + id_range[0]
+        return ids, past_kv
 
 
 def export_onnx(model, model_inputs, input_names, output_names, dynamic_axes, meta_data, path):
@@ -87,6 +126,80 @@ def get_past_kv(config: LlamaConfig, batch_size=1, past_seq_len=16, torch_dtype=
     return past_kv, input_names, output_names
 
 
+PAST_KV_SHAPE = {0: "batch", 2: "past_seq"}
+PRESENT_KV_SHAPE = {0: "batch", 2: "present_seq"}
+
+
+def export_model_base(model: MIDIModel, path, meta_data, last_hidden_only=False):
+    """export the model base of `model` to `path`, `meta_data` goes into the ONNX metadata"""
+    config = model.config
+    tokenizer = config.tokenizer
+    model_base = MIDIModelBase(model, last_hidden_only).eval()
+    with torch.no_grad():
+        dynamic_axes = {
+            "x": {0: "batch", 1: "mid_seq", 2: "token_seq"},
+            "hidden": {0: "batch"} if last_hidden_only else {0: "batch", 1: "mid_seq"}
+        }
+        x = torch.randint(tokenizer.vocab_size, (1, 16, tokenizer.max_token_seq), dtype=torch.int64, device="cpu")
+        past_kv, input_names, output_names= get_past_kv(config.net_config, past_seq_len=16,
+                                                        torch_dtype=torch.float32)
+        for name in input_names:
+            dynamic_axes[name] = PAST_KV_SHAPE
+        for name in output_names:
+            dynamic_axes[name] = PRESENT_KV_SHAPE
+        input_names = [ "x"] + input_names
+        output_names = ["hidden"] + output_names
+        export_onnx(model_base, (x, past_kv),
+                    input_names, output_names, dynamic_axes,
+                    {**meta_data, "last_hidden_only": last_hidden_only}, path)
+
+
+def export_model_token(model: MIDIModel, path, meta_data, range_head=False, sample_in_graph=False):
+    """export the model token of `model` to `path`, with a range head or sampling in the graph"""
+    config = model.config
+    tokenizer = config.tokenizer
+    model_token = MIDIModelTokenSampler(model) if sample_in_graph else MIDIModelToken(model)
+    model_token.eval()
+    with torch.no_grad():
+        dynamic_axes = {
+            "x": {0: "batch", 1: "token_seq"},
+            "hidden": {0: "batch", 1: "states"},
+            "y": {0: "batch", 2: "ids"} if range_head else {0: "batch", 1: "token_seq1"}
+        }
+        if sample_in_graph:
+            del dynamic_axes["y"]
+            dynamic_axes.update({"row_range": {0: "batch"}, "mask": {0: "batch", 1: "range"},
+                                 "temp": {0: "batch"}, "top_p": {0: "batch"}, "top_k": {0: "batch"},
+                                 "uniform": {0: "batch"}, "ids": {0: "batch"}})
+        hidden = torch.randn(1, 1, config.n_embd, device="cpu")
+        x = torch.randint(tokenizer.vocab_size, (1, tokenizer.max_token_seq //2), dtype=torch.int64, device="cpu")
+        past_kv, input_names, output_names = get_past_kv(config.net_token_config,
+                                                         past_seq_len=(tokenizer.max_token_seq // 2),
+                                                         torch_dtype=torch.float32)
+        for name in input_names:
+            dynamic_axes[name] = PAST_KV_SHAPE
+        for name in output_names:
+            dynamic_axes[name] = PRESENT_KV_SHAPE
+        input_names = ["hidden", "x"] + input_names
+        output_names = ["ids" if sample_in_graph else "y"] + output_names
+        model_inputs = (hidden, x, past_kv)
+        if range_head or sample_in_graph:
+            pitch_ids = tokenizer.parameter_ids["pitch"]
+            model_inputs += (torch.tensor([pitch_ids[0], pitch_ids[-1] + 1], dtype=torch.int64),)
+            input_names.append("id_range")
+        if sample_in_graph:
+            # one row whose own range is the whole id_range
+            model_inputs += (model_inputs[-1][None],
+                             torch.ones(1, len(pitch_ids), dtype=torch.bool), torch.ones(1),
+                             torch.full((1,), 0.98), torch.full((1,), 20, dtype=torch.int64),
+                             torch.rand(1, dtype=torch.float64))
+            input_names += ["row_range", "mask", "temp", "top_p", "top_k", "uniform"]
+        export_onnx(model_token, model_inputs,
+                    input_names, output_names, dynamic_axes,
+                    {**meta_data, "range_head": range_head or sample_in_graph,
+                     "sample_in_graph": sample_in_graph}, path)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -104,9 +217,27 @@ if __name__ == '__main__':
     parser.add_argument(
         "--model-token-out", type=str, default="model_token.onnx", help="model token output path"
     )
+    parser.add_argument(
+        "--last-hidden-only", action="store_true", default=False,
+        help="export a model base that outputs the hidden state of the last event only"
+    )
+    parser.add_argument(
+        "--range-head", action="store_true", default=False,
+        help="export a model token that takes an id_range input and outputs only the logits of "
+             "those ids at the last position"
+    )
+    parser.add_argument(
+        "--sample-in-graph", action="store_true", default=False,
+        help="export a range head model token that also samples (row_range, mask, temp, top_p, "
+             "top_k and uniform draws in, ids out)"
+    )
+    parser.add_argument(
+        "--quantize", action="store_true", default=False,
+        help="also write INT8 weight-quantized graphs (*.int8.onnx), see quantize.py for the "
+             "parity report"
+    )
     opt = parser.parse_args()
     config = MIDIModelConfig.from_name(opt.config)
-    tokenizer = config.tokenizer
     model = MIDIModel(config).to(device="cpu")
     ckpt = torch.load(opt.ckpt, map_location="cpu")
     state_dict = ckpt.get("state_dict", ckpt)
@@ -114,43 +245,10 @@ if __name__ == '__main__':
     if opt.lora != "":
         model.load_merge_lora(opt.lora)
     model.eval()
-    model_base = MIDIModelBase(model).eval()
-    model_token = MIDIModelToken(model).eval()
     meta_data = {"config_name": opt.config, "config": config}
-    past_kv_shape = {0: "batch", 2: "past_seq"}
-    present_kv_shape = {0: "batch", 2: "present_seq"}
-    with torch.no_grad():
-        dynamic_axes = {
-            "x": {0: "batch", 1: "mid_seq", 2: "token_seq"},
-            "hidden": {0: "batch", 1: "mid_seq"}
-        }
-        x = torch.randint(tokenizer.vocab_size, (1, 16, tokenizer.max_token_seq), dtype=torch.int64, device="cpu")
-        past_kv, input_names, output_names= get_past_kv(config.net_config, past_seq_len=16,
-                                                        torch_dtype=torch.float32)
-        for name in input_names:
-            dynamic_axes[name] = past_kv_shape
-        for name in output_names:
-            dynamic_axes[name] = present_kv_shape
-        input_names = [ "x"] + input_names
-        output_names = ["hidden"] + output_names
-        export_onnx(model_base, (x, past_kv),
-                    input_names, output_names, dynamic_axes, meta_data, opt.model_base_out)
-
-        dynamic_axes = {
-            "x": {0: "batch", 1: "token_seq"},
-            "hidden": {0: "batch", 1: "states"},
-            "y": {0: "batch", 1: "token_seq1"}
-        }
-        hidden = torch.randn(1, 1, config.n_embd, device="cpu")
-        x = torch.randint(tokenizer.vocab_size, (1, tokenizer.max_token_seq //2), dtype=torch.int64, device="cpu")
-        past_kv, input_names, output_names = get_past_kv(config.net_token_config,
-                                                         past_seq_len=(tokenizer.max_token_seq // 2),
-                                                         torch_dtype=torch.float32)
-        for name in input_names:
-            dynamic_axes[name] = past_kv_shape
-        for name in output_names:
-            dynamic_axes[name] = present_kv_shape
-        input_names = ["hidden", "x"] + input_names
-        output_names = ["y"] + output_names
-        export_onnx(model_token, (hidden, x, past_kv),
-                    input_names, output_names, dynamic_axes, meta_data, opt.model_token_out)
+    export_model_base(model, opt.model_base_out, meta_data, opt.last_hidden_only)
+    export_model_token(model, opt.model_token_out, meta_data, opt.range_head, opt.sample_in_graph)
+    if opt.quantize:
+        from quantize import quantize_model
+        for path in (opt.model_base_out, opt.model_token_out):
+            print(f"quantized {path} -> {quantize_model(path)}")
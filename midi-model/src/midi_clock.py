@@ -0,0 +1,150 @@
+TIME_UNITS = ("ticks", "beats", "bars", "seconds")
+
+
+class MIDIClock:
+    """
+    Musical time of a token sequence, tracked one event at a time.
+
+    Positions are counted in 1/16 beats like the tokenizer does (``t1 * 16 + time2`` with ``t1`` the
+    running sum of ``time1``). ``set_tempo`` and ``time_signature`` events update the conversion of
+    positions to seconds and bars, from the point where they occur.
+    """
+
+    ticks_per_beat = 480  # same as detokenize
+
+    def __init__(self, tokenizer, bpm=120):
+        self.tokenizer = tokenizer
+        self.t1 = 0
+        self.position = 0  # of the last event, 1/16 beats
+        self.end = 0  # where the last sounding note ends, 1/16 beats
+        self.bpm = bpm
+        self.tempo_position = 0
+        self.tempo_seconds = 0.0
+        self.bar_length = 64  # 1/16 beats per bar, 4/4 until a time signature says otherwise
+        self.signature_position = 0
+        self.signature_bars = 0.0
+        self.duration_index = {name: params.index("duration") + 1
+                               for name, params in tokenizer.events.items() if "duration" in params}
+
+    def event_position(self, event):
+        """position of an event that would come next, in 1/16 beats"""
+        return max((self.t1 + event[1]) * 16 + event[2], self.position)
+
+    def feed(self, tokens):
+        """advance the clock past one event, return the event or [] if it has no time (bos, eos,
+        pad)"""
+        event = self.tokenizer.tokens2event(tokens)
+        if not event:
+            return event
+        name = event[0]
+        position = self.event_position(event)
+        self.t1 += event[1]
+        if name == "set_tempo":
+            self.tempo_seconds = self.seconds_at(position)
+            self.tempo_position = position
+            self.bpm = max(event[4], 1)
+        elif name == "time_signature":
+            self.signature_bars = self.bars_at(position)
+            self.signature_position = position
+            nn, dd = event[4] + 1, event[5] + 1
+            self.bar_length = max(nn * 64 // 2 ** dd, 1)
+        elif name in self.duration_index:
+            self.end = max(self.end, position + event[self.duration_index[name]])
+        self.position = position
+        self.end = max(self.end, position)
+        return event
+
+    def seconds_at(self, position):
+        """seconds at a position (1/16 beats) not before the last tempo change"""
+        return self.tempo_seconds + (position - self.tempo_position) * 60 / (16 * self.bpm)
+
+    def bars_at(self, position):
+        return self.signature_bars + (position - self.signature_position) / self.bar_length
+
+    def value_at(self, position, unit):
+        """time of a position (1/16 beats) in one of TIME_UNITS, with the current tempo and time
+        signature"""
+        if unit == "ticks":
+            return position * self.ticks_per_beat / 16
+        if unit == "beats":
+            return position / 16
+        if unit == "bars":
+            return self.bars_at(position)
+        if unit == "seconds":
+            return self.seconds_at(position)
+        raise ValueError(f"unknown time unit: {unit}")
+
+    def position_of(self, value, unit):
+        """inverse of value_at"""
+        if unit == "ticks":
+            return value * 16 / self.ticks_per_beat
+        if unit == "beats":
+            return value * 16
+        if unit == "bars":
+            return self.signature_position + (value - self.signature_bars) * self.bar_length
+        if unit == "seconds":
+            return self.tempo_position + (value - self.tempo_seconds) * 16 * self.bpm / 60
+        raise ValueError(f"unknown time unit: {unit}")
+
+    @property
+    def seconds(self):
+        return self.seconds_at(self.position)
+
+    @property
+    def beats(self):
+        return self.position / 16
+
+    @property
+    def bars(self):
+        return self.bars_at(self.position)
+
+    @property
+    def ticks(self):
+        return self.position * self.ticks_per_beat // 16
+
+
+class StopCondition:
+    """
+    Ends generation after `duration` `unit`s of music, counted from `start` (default: where the
+    clock is).
+
+    ``past_end(tokens)`` tells whether the next event would start at or after the end, that event is
+    not part of the requested length. Unless `let_notes_finish`, ``clamp(tokens)`` shortens notes
+    that would sound past the end. The clock is fed by the caller.
+    """
+
+    def __init__(self, clock: MIDIClock, duration, unit="beats", let_notes_finish=True, start=None):
+        if unit not in TIME_UNITS:
+            raise ValueError(f"unknown time unit: {unit}, expected one of {TIME_UNITS}")
+        self.clock = clock
+        self.unit = unit
+        self.let_notes_finish = let_notes_finish
+        if start is None:
+            start = clock.value_at(clock.position, unit)
+        self.start = start
+        self.end = start + float(duration)
+
+    def past_end(self, tokens):
+        event = self.clock.tokenizer.tokens2event(tokens)
+        if not event:
+            return False
+        return self.clock.value_at(self.clock.event_position(event), self.unit) >= self.end
+
+    def clamp(self, tokens):
+        """tokens of the event with its duration cut at the end, unchanged if it fits or notes may
+        finish"""
+        if self.let_notes_finish:
+            return tokens
+        tokenizer = self.clock.tokenizer
+        event = tokenizer.tokens2event(tokens)
+        if not event or event[0] not in self.clock.duration_index:
+            return tokens
+        i = self.clock.duration_index[event[0]]
+        position = self.clock.event_position(event)
+        end = int(self.clock.position_of(self.end, self.unit))
+        duration = max(min(event[i], end - position), 1)
+        if duration == event[i]:
+            return tokens
+        tokens = list(tokens)
+        tokens[i] = tokenizer.parameter_ids["duration"][duration]
+        return tokens
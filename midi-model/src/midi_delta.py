@@ -0,0 +1,133 @@
+import struct
+
+import MIDI
+from midi_tokenizer import StreamingDetokenizer
+
+END_OF_TRACK = b"\x00\xFF\x2F\x00"
+
+
+class _Track:
+    def __init__(self):
+        self.done = 0  # events of the detokenizer track already committed
+        # order of committed events, which score2opus keeps for messages at the same time
+        self.seq = 0
+        self.pending = []  # (seq, note) of committed notes whose note_off is not committed yet
+        self.time = 0  # absolute time of the last committed message
+        self.last = None  # last committed message, for running status
+        self.data = bytearray()  # every committed fragment
+
+
+class DeltaMIDIEncoder:
+    """
+    MIDI snapshots of a growing StreamingDetokenizer score, sent as the track bytes added since the
+    last one.
+
+    Future events start no earlier than the detokenizer's current beat (``t1``), so every MIDI
+    message before it is final: later notes can only shorten notes that still sound after it.
+    ``delta()`` encodes the final messages not sent yet with ``MIDI._encode``, with delta times and
+    running status continuing the previous fragment of their track, plus a `tail` with the rest of
+    the piece so far that is only valid until the next delta. Its cost does not grow with the length
+    of the piece.
+
+    A client keeps the fragments of each track; committed fragments + latest tail of every track,
+    ordered by track index after a standard header (``header(n_tracks)``) is exactly
+    ``MIDI.score2midi`` of the score. ``resync()`` returns all committed bytes at once, to restore a
+    client that lost its copy.
+    """
+
+    def __init__(self, detokenizer: StreamingDetokenizer):
+        self.detokenizer = detokenizer
+        self.seq = 0
+        self.tracks = {}
+
+    @staticmethod
+    def header(n_tracks, ticks=StreamingDetokenizer.ticks_per_beat):
+        fmt = 0 if n_tracks == 1 else 1
+        return b"MThd\x00\x00\x00\x06" + struct.pack('>HHH', fmt, n_tracks, ticks)
+
+    def delta(self):
+        """fragments of every track since the last delta:
+        {"seq", "ticks", "tracks": [(track_idx, data, tail)]}"""
+        frontier = self.detokenizer.t1 * self.detokenizer.ticks_per_beat
+        self.seq += 1
+        tracks = []
+        for track_idx in sorted(self.detokenizer.tracks):
+            track = self.tracks.setdefault(track_idx, _Track())
+            messages = self._commit(track, self.detokenizer.tracks[track_idx], frontier)
+            data = self._encode(track, messages, commit=True)
+            tail = self._encode(track, self._tail(track, self.detokenizer.tracks[track_idx]),
+                                commit=False)
+            tracks.append((track_idx, data, tail + END_OF_TRACK))
+        return {"seq": self.seq, "ticks": self.detokenizer.ticks_per_beat, "tracks": tracks}
+
+    def resync(self):
+        """the committed bytes of every track, what a client holds after applying every delta so
+        far"""
+        return {"seq": self.seq, "ticks": self.detokenizer.ticks_per_beat,
+                "tracks": [(track_idx, bytes(self.tracks[track_idx].data))
+                           for track_idx in sorted(self.tracks)]}
+
+    @staticmethod
+    def _messages(seq, event):
+        """opus messages of a score event, keyed like score2opus orders them"""
+        if event[0] == "note":
+            t, d, c, p, v = event[1:6]
+            return [((t, seq, 0), ['note_on', t, c, p, v]),
+                    ((t + d, seq, 1), ['note_off', t + d, c, p, v])]
+        return [((event[1], seq, 0), list(event))]
+
+    def _commit(self, track: _Track, events, frontier):
+        keyed = []
+        while track.done < len(events) and events[track.done][1] < frontier:
+            event = events[track.done]
+            track.done += 1
+            if event[0] == "note" and event[2] == 0:
+                continue  # left out of the score
+            on = self._messages(track.seq, event)
+            if event[0] == "note":
+                track.pending.append((track.seq, event))
+                on = on[:1]
+            keyed += on
+            track.seq += 1
+        pending = []
+        for seq, note in track.pending:
+            if note[1] + note[2] < frontier:
+                keyed.append(self._messages(seq, note)[1])
+            else:
+                pending.append((seq, note))
+        track.pending = pending
+        keyed.sort(key=lambda it: it[0])
+        return [message for _, message in keyed]
+
+    def _tail(self, track: _Track, events):
+        keyed = [self._messages(seq, note)[1] for seq, note in track.pending]
+        seq = track.seq
+        for event in events[track.done:]:
+            if event[0] == "note" and event[2] == 0:
+                continue
+            keyed += self._messages(seq, event)
+            seq += 1
+        keyed.sort(key=lambda it: it[0])
+        return [message for _, message in keyed]
+
+    @staticmethod
+    def _encode(track: _Track, messages, commit):
+        if not messages:
+            return b""
+        time = track.time
+        opus = []
+        for message in messages:
+            message = list(message)
+            message[1], time = message[1] - time, message[1]
+            opus.append(message)
+        if track.last is None:
+            data = MIDI._encode(opus, never_add_eot=True)
+        else:
+            # encode after the previous message so running status carries over, then cut it off
+            prefix = MIDI._encode([track.last], never_add_eot=True)
+            data = MIDI._encode([track.last] + opus, never_add_eot=True)[len(prefix):]
+        if commit:
+            track.time = time
+            track.last = [messages[-1][0], 0] + messages[-1][2:]
+            track.data += data
+        return data
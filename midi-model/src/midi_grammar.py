@@ -0,0 +1,178 @@
+from functools import lru_cache
+
+import numpy as np
+
+
+class MIDIGrammar:
+    """
+    Decoding grammar of the two-level model, compiled once per tokenizer and decoding options.
+
+    Each token position of an event is constrained to one of a few id sets (event ids, the ids of
+    one parameter or pad). These sets are prebuilt as boolean mask rows, so the mask of a whole
+    batch is a single gather: ``grammar.mask(state, i)``.
+
+    ``state`` holds one token id per batch row: ``bos_id`` while the row still has to choose an
+    event, the sampled event id afterwards, or ``eos_id`` once the row has ended.
+
+    A mask row that allows a single id (pad, or a parameter left with one value such as the only
+    enabled channel) forces that id, ``grammar.forced_ids(state, i)`` returns it so the caller can
+    skip the token model for it.
+
+    The ids a row allows lie in ``grammar.ranges[row]`` = [start, end), a token graph with a range
+    head only computes the logits of that range.
+    """
+
+    def __init__(self, tokenizer, disable_patch_change=False, disable_control_change=False,
+                 disable_channels=None, disable_tracks=None):
+        self.tokenizer = tokenizer
+        vocab_size = tokenizer.vocab_size
+        max_token_seq = tokenizer.max_token_seq
+
+        rows = []
+
+        def add_row(ids):
+            row = np.zeros(vocab_size, dtype=bool)
+            row[ids] = True
+            rows.append(row)
+            return len(rows) - 1
+
+        self.pad_row = add_row([tokenizer.pad_id])
+        event_ids = list(tokenizer.event_ids.values()) + [tokenizer.eos_id]
+        if disable_patch_change:
+            event_ids.remove(tokenizer.event_ids["patch_change"])
+        if disable_control_change:
+            event_ids.remove(tokenizer.event_ids["control_change"])
+        self.event_row = add_row(event_ids)
+        if disable_channels is not None:
+            disable_channels = [tokenizer.parameter_ids["channel"][c] for c in disable_channels]
+        else:
+            disable_channels = []
+        if disable_tracks is not None:
+            disable_tracks = [tokenizer.parameter_ids["track"][t] for t in disable_tracks]
+        else:
+            disable_tracks = []
+        param_rows = {}
+        for param_name, ids in tokenizer.parameter_ids.items():
+            if param_name == "channel":
+                ids = [i for i in ids if i not in disable_channels]
+            elif param_name == "track":
+                ids = [i for i in ids if i not in disable_tracks]
+            param_rows[param_name] = add_row(ids)
+        self.rows = np.stack(rows)
+        self.forced = forced_row_ids(self.rows)
+        self.ranges = row_id_ranges(self.rows)
+
+        # (state, position) -> mask row
+        self.table = np.full((vocab_size, max_token_seq), self.pad_row, dtype=np.int64)
+        self.table[tokenizer.bos_id, 0] = self.event_row
+        # number of parameters that follow the event token, 0 for bos/eos
+        self.num_params = np.zeros(vocab_size, dtype=np.int64)
+        for event_name, param_names in tokenizer.events.items():
+            eid = tokenizer.event_ids[event_name]
+            self.num_params[eid] = len(param_names)
+            for i, param_name in enumerate(param_names):
+                self.table[eid, i + 1] = param_rows[param_name]
+
+    def new_state(self, batch_size):
+        return np.full(batch_size, self.tokenizer.bos_id, dtype=np.int64)
+
+    def row_ids(self, state, i):
+        return self.table[state, i]
+
+    def mask(self, state, i):
+        """
+        :param state: (batch_size,) token ids, see class docstring
+        :param i: position in the token sequence of the event
+        :return: (batch_size, vocab_size) bool
+        """
+        return self.rows[self.table[state, i]]
+
+    def is_complete(self, state, i):
+        """whether every row that has not ended has sampled exactly i parameters"""
+        active = state != self.tokenizer.eos_id
+        return bool(np.all(self.num_params[state[active]] == i))
+
+    def pending(self, state, i):
+        """rows that still have a token to sample at position i (i > 0), the others only get pad"""
+        return self.num_params[state] >= i
+
+    def forced_ids(self, state, i):
+        """the only allowed id of each row at position i, -1 where the row has a choice"""
+        return self.forced[self.table[state, i]]
+
+
+def forced_row_ids(rows):
+    """the id allowed by each mask row that allows exactly one, -1 for the others"""
+    return np.where(rows.sum(axis=1) == 1, rows.argmax(axis=1), -1)
+
+
+def row_id_ranges(rows):
+    """[start, end) of the ids allowed by each mask row, (num_rows, 2)"""
+    allowed = rows.any(axis=1)
+    start = np.where(allowed, rows.argmax(axis=1), 0)
+    end = np.where(allowed, rows.shape[1] - rows[:, ::-1].argmax(axis=1), 0)
+    return np.stack([start, end], axis=1)
+
+
+def id_range(ranges):
+    """the smallest [start, end) covering all `ranges` (n, 2), as the int64 id_range input of a
+    range head"""
+    return np.array([ranges[:, 0].min(), ranges[:, 1].max()], dtype=np.int64)
+
+
+@lru_cache(maxsize=32)
+def _compile_grammar(tokenizer, disable_patch_change, disable_control_change, disable_channels,
+                     disable_tracks):
+    return MIDIGrammar(tokenizer, disable_patch_change, disable_control_change, disable_channels,
+                       disable_tracks)
+
+
+def get_grammar(tokenizer, disable_patch_change=False, disable_control_change=False,
+                disable_channels=None, disable_tracks=None):
+    """return the compiled grammar for these options, compiling it on first use"""
+    if disable_channels is not None:
+        disable_channels = tuple(sorted(set(int(c) for c in disable_channels)))
+    if disable_tracks is not None:
+        disable_tracks = tuple(sorted(set(int(t) for t in disable_tracks)))
+    return _compile_grammar(tokenizer, bool(disable_patch_change), bool(disable_control_change),
+                            disable_channels, disable_tracks)
+
+
+class BatchGrammar:
+    """
+    Grammars of a batch whose rows decode with different options, e.g. sessions merged into one
+    batch.
+
+    The tables of the distinct grammars are stacked once, so the mask is still a single gather per
+    step. It has the same interface as MIDIGrammar.
+    """
+
+    def __init__(self, grammars):
+        unique = list(dict.fromkeys(grammars))
+        self.tokenizer = unique[0].tokenizer
+        offsets = np.cumsum([0] + [len(g.rows) for g in unique[:-1]])
+        self.rows = np.concatenate([g.rows for g in unique])
+        self.table = np.stack([g.table + offset for g, offset in zip(unique, offsets, strict=True)])
+        self.row_grammar = np.array([unique.index(g) for g in grammars], dtype=np.int64)
+        self.num_params = unique[0].num_params
+        self.forced = np.concatenate([g.forced for g in unique])
+        self.ranges = np.concatenate([g.ranges for g in unique])
+
+    def new_state(self, batch_size):
+        return np.full(batch_size, self.tokenizer.bos_id, dtype=np.int64)
+
+    def row_ids(self, state, i):
+        return self.table[self.row_grammar, state, i]
+
+    def mask(self, state, i):
+        return self.rows[self.row_ids(state, i)]
+
+    def is_complete(self, state, i):
+        active = state != self.tokenizer.eos_id
+        return bool(np.all(self.num_params[state[active]] == i))
+
+    def pending(self, state, i):
+        return self.num_params[state] >= i
+
+    def forced_ids(self, state, i):
+        return self.forced[self.row_ids(state, i)]
@@ -0,0 +1,834 @@
+"""
+ONNX inference core of midi-model: kv caches, sampling, generate() and tokenizer loading.
+
+It only needs numpy and onnxruntime, so the streaming server can import it without the Gradio app's
+dependencies; app_onnx re-exports everything here.
+"""
+import hashlib
+import json
+import os.path
+import threading
+import urllib.request
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import onnxruntime as rt
+
+from midi_clock import MIDIClock, StopCondition
+from midi_grammar import get_grammar, id_range
+from midi_tokenizer import MIDITokenizer
+
+try:
+    import tqdm
+except ImportError:
+    tqdm = None
+
+MAX_MID_SEQ = 4096  # max_position_embeddings of the base model
+KV_CACHE_SLIDE = 64  # positions dropped at once when the base kv cache is full
+
+# where the kv caches live, "cuda" when the entry point runs on CUDAExecutionProvider
+device = "cpu"
+
+rt.set_default_logger_severity(3)
+
+# SessionOptions of each session profile, threads left at 0 are sized by ORT (one per physical
+# core).
+# latency: one request at a time as fast as possible, idle intra-op threads spin to pick up work
+# sooner.
+# throughput: several sessions share the cores (generate workers, models), threads sleep when idle.
+# low_memory: no memory arena or memory patterns, buffers are freed after each run.
+SESSION_PROFILES = {
+    "default": {},
+    "latency": {
+        "execution_mode": rt.ExecutionMode.ORT_SEQUENTIAL,
+        "graph_optimization_level": rt.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        "inter_op_num_threads": 1,
+        "configs": {"session.intra_op.allow_spinning": "1"},
+    },
+    "throughput": {
+        "execution_mode": rt.ExecutionMode.ORT_SEQUENTIAL,
+        "graph_optimization_level": rt.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        "inter_op_num_threads": 1,
+        "configs": {"session.intra_op.allow_spinning": "0"},
+    },
+    "low_memory": {
+        "graph_optimization_level": rt.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        "enable_cpu_mem_arena": False,
+        "enable_mem_pattern": False,
+        "configs": {"session.intra_op.allow_spinning": "0"},
+    },
+}
+
+
+def softmax(x, axis):
+    x_max = np.amax(x, axis=axis, keepdims=True)
+    exp_x_shifted = np.exp(x - x_max)
+    return exp_x_shifted / np.sum(exp_x_shifted, axis=axis, keepdims=True)
+
+
+def draw_uniform(generator, n):
+    """n uniform draws in [0, 1), one per row, taken from a single RNG call.
+
+    `generator` may also be a sequence of per-row generators, each row then draws from its own
+    one."""
+    if generator is None:
+        generator = np.random
+    if isinstance(generator, (list, tuple)):
+        return np.array([g.random_sample() for g in generator], dtype=np.float64)
+    return generator.random_sample(n)
+
+
+def sample_top_p_k(probs, p, k, generator=None, uniform=None):
+    """Batched top-p/top-k sampling.
+
+    Only the k most likely ids of each row are selected (argpartition) and sorted, then one uniform
+    draw per row is mapped through the inverse CDF. `p` and `k` may be scalars or per-row arrays.
+    Each row consumes exactly one draw, in row order, so results are reproducible from the seed.
+    """
+    shape = probs.shape
+    probs = probs.reshape(-1, shape[-1])
+    n, vocab_size = probs.shape
+    k = np.clip(np.broadcast_to(np.asarray(k, dtype=np.int64), (n,)), 1, vocab_size)
+    p = np.broadcast_to(np.asarray(p, dtype=probs.dtype), (n,))
+    k_max = int(k.max())
+    if k_max < vocab_size:
+        top_idx = np.argpartition(probs, vocab_size - k_max, axis=-1)[:, vocab_size - k_max:]
+        top = np.take_along_axis(probs, top_idx, -1)
+    else:
+        top_idx = np.broadcast_to(np.arange(vocab_size), (n, vocab_size))
+        top = probs
+    order = np.argsort(-top, axis=-1, kind="stable")
+    probs_idx = np.take_along_axis(top_idx, order, -1)
+    probs_sort = np.take_along_axis(top, order, -1)
+    cdf = np.cumsum(probs_sort, axis=-1)
+    mask = (cdf - probs_sort > p[:, None]) | (np.arange(k_max) >= k[:, None])
+    probs_sort[mask] = 0.0
+    np.cumsum(probs_sort, axis=-1, out=cdf)
+    if uniform is None:
+        uniform = draw_uniform(generator, n)
+    x = uniform * cdf[:, -1]
+    choice = np.minimum(np.count_nonzero(cdf <= x[:, None], axis=-1), k_max - 1)
+    next_token = probs_idx[np.arange(n), choice]
+    return next_token.reshape(*shape[:-1])
+
+
+class Sampler:
+    """Fused temperature, softmax, grammar mask and top-p/top-k sampling for a batch of logits.
+
+    The softmax runs in place on scratch buffers that are allocated once and reused on every step.
+    `temp`, `top_p` and `top_k` may be scalars or per-row arrays.
+    """
+
+    def __init__(self):
+        self.probs = np.empty(0, dtype=np.float32)
+        self.row_stat = np.empty(0, dtype=np.float32)
+
+    def _reserve(self, batch_size, vocab_size):
+        # the logits of a range head are narrower on most steps, the buffers are reused for any
+        # width
+        if self.probs.size < batch_size * vocab_size:
+            self.probs = np.empty(batch_size * vocab_size, dtype=np.float32)
+        if self.row_stat.size < batch_size:
+            self.row_stat = np.empty(batch_size, dtype=np.float32)
+        return (self.probs[:batch_size * vocab_size].reshape(batch_size, vocab_size),
+                self.row_stat[:batch_size].reshape(batch_size, 1))
+
+    def __call__(self, logits, mask, temp, top_p, top_k, generator=None, uniform=None):
+        """
+        :param logits: (batch_size, vocab_size)
+        :param mask: (batch_size, vocab_size) bool
+        :return: (batch_size,) sampled ids
+        """
+        batch_size, vocab_size = logits.shape
+        probs, row_stat = self._reserve(batch_size, vocab_size)
+        temp = np.asarray(temp, dtype=np.float32)
+        if temp.ndim > 0:
+            temp = temp.reshape(-1, 1)
+        np.divide(logits, temp, out=probs)
+        np.amax(probs, axis=-1, keepdims=True, out=row_stat)
+        np.subtract(probs, row_stat, out=probs)
+        np.exp(probs, out=probs)
+        np.sum(probs, axis=-1, keepdims=True, out=row_stat)
+        np.multiply(probs, mask, out=probs)
+        np.divide(probs, row_stat, out=probs)
+        return sample_top_p_k(probs, top_p, top_k, generator, uniform)
+
+
+class KVCache:
+    """Past key/values of one decoder graph, kept in preallocated buffers.
+
+    Every cache entry has two buffers used in turn: the graph reads the past from one and writes the
+    present into the other, so steady-state decoding allocates nothing. The buffers hold `capacity`
+    positions (default `max_len`) and double on demand up to `max_len`, so a cache that is kept to
+    continue a piece later only pays for what it has used. When a step would exceed `max_len`
+    positions the cache slides, dropping the oldest positions `slide` at a time in one copy.
+    """
+
+    def __init__(self, model: rt.InferenceSession, batch_size, max_len, slide=1, capacity=None):
+        self.batch_size = batch_size
+        self.max_batch = batch_size
+        self.max_len = max_len
+        self.capacity = max_len if capacity is None else max(min(capacity, max_len), 1)
+        self.slide = slide
+        self.past_len = 0
+        self.current = 0
+        self.entries = []  # (past name, present name, num heads, head size)
+        for input_ in model.get_inputs():
+            if input_.name.startswith("past_key_values"):
+                self.entries.append((input_.name, input_.name.replace("past_key_values", "present"),
+                                     input_.shape[1], input_.shape[3]))
+        self.buffers = [[self._allocate(batch_size * h * self.capacity * d)
+                         for _, _, h, d in self.entries]
+                        for _ in range(2)]
+
+    @staticmethod
+    def _allocate(size):
+        if device == "cpu":
+            return np.empty(size, dtype=np.float32)
+        return rt.OrtValue.ortvalue_from_shape_and_type((size,), element_type=np.float32,
+                                                        device_type=device)
+
+    @staticmethod
+    def _data_ptr(buffer):
+        if isinstance(buffer, np.ndarray):
+            return buffer.ctypes.data
+        return buffer.data_ptr()
+
+    @property
+    def nbytes(self):
+        return 2 * sum(self.max_batch * self.capacity * h * d * 4 for _, _, h, d in self.entries)
+
+    def reset(self, batch_size=None):
+        """forget the cached positions, optionally reusing the buffers for a smaller batch"""
+        if batch_size is not None:
+            if batch_size > self.max_batch:
+                raise ValueError(f"batch size {batch_size} exceeds the cache capacity")
+            self.batch_size = batch_size
+        self.past_len = 0
+
+    def _grow(self, capacity):
+        buffers = [[None] * len(self.entries) for _ in range(2)]
+        old_buffers = self.buffers[self.current]
+        for j, ((_, _, h, d), old) in enumerate(zip(self.entries, old_buffers, strict=True)):
+            size = self.max_batch * h * capacity * d
+            past_size = self.batch_size * h * self.past_len * d
+            buffers[1 - self.current][j] = self._allocate(size)
+            if isinstance(old, np.ndarray):
+                buffers[self.current][j] = new = np.empty(size, dtype=np.float32)
+                new[:past_size] = old[:past_size]
+            else:
+                host = np.empty(size, dtype=np.float32)
+                host[:past_size] = old.numpy()[:past_size]
+                buffers[self.current][j] = rt.OrtValue.ortvalue_from_numpy(host, device, 0)
+        self.buffers = buffers
+        self.capacity = capacity
+
+    def _slide_to(self, keep):
+        src, dst = self.buffers[self.current], self.buffers[1 - self.current]
+        for (_, _, h, d), s, t in zip(self.entries, src, dst, strict=True):
+            past_shape = (self.batch_size, h, self.past_len, d)
+            past_size = self.batch_size * h * self.past_len * d
+            kept_shape = (self.batch_size, h, keep, d)
+            kept_size = self.batch_size * h * keep * d
+            if isinstance(s, np.ndarray):
+                np.copyto(t[:kept_size].reshape(kept_shape),
+                          s[:past_size].reshape(past_shape)[:, :, self.past_len - keep:])
+            else:
+                # no device-side strided copy in the ORT API, go through the host
+                host = s.numpy()
+                kept = host[:past_size].reshape(past_shape)[:, :, self.past_len - keep:]
+                host[:kept_size] = kept.reshape(-1)
+                t.update_inplace(host)
+        self.current = 1 - self.current
+        self.past_len = keep
+
+    def bind(self, io_binding, new_len):
+        """bind the past key/values and the present outputs of a step that feeds `new_len`
+        positions"""
+        if self.past_len + new_len > self.capacity and self.capacity < self.max_len:
+            self._grow(min(max(2 * self.capacity, self.past_len + new_len), self.max_len))
+        if self.past_len + new_len > self.max_len:
+            self._slide_to(max(self.max_len - new_len - self.slide + 1, 0))
+        cur_len = self.past_len + new_len
+        past, present = self.buffers[self.current], self.buffers[1 - self.current]
+        for (past_name, present_name, h, d), p, q in zip(self.entries, past, present, strict=True):
+            io_binding.bind_input(past_name, device, 0, np.float32,
+                                  [self.batch_size, h, self.past_len, d], self._data_ptr(p))
+            io_binding.bind_output(present_name, device, 0, np.float32,
+                                   [self.batch_size, h, cur_len, d], self._data_ptr(q))
+
+    def advance(self, new_len):
+        """make the present of the last step the past of the next one"""
+        self.current = 1 - self.current
+        self.past_len += new_len
+
+    def export(self):
+        """host copies of the cached key/values of the first batch row, (1, h, past_len, d) per
+        entry"""
+        presents = []
+        for (_, _, h, d), buffer in zip(self.entries, self.buffers[self.current], strict=True):
+            host = buffer if isinstance(buffer, np.ndarray) else buffer.numpy()
+            past = host[:self.batch_size * h * self.past_len * d].reshape(
+                self.batch_size, h, self.past_len, d)
+            presents.append(past[:1].copy())
+        return presents
+
+    def load(self, presents):
+        """replace the cached positions with exported key/values, shared by every batch row"""
+        past_len = presents[0].shape[2]
+        self.past_len = 0
+        if past_len > self.capacity:
+            self._grow(min(max(2 * self.capacity, past_len), self.max_len))
+        buffers = self.buffers[self.current]
+        for (_, _, h, d), buffer, present in zip(self.entries, buffers, presents, strict=True):
+            if isinstance(buffer, np.ndarray):
+                host = buffer
+            else:
+                host = np.empty(buffer.shape()[0], dtype=np.float32)
+            size = self.batch_size * h * past_len * d
+            np.copyto(host[:size].reshape(self.batch_size, h, past_len, d), present)
+            if host is not buffer:
+                buffer.update_inplace(host)
+        self.past_len = past_len
+
+
+class PrefixCache:
+    """Base model key/values and last hidden state after prefilling a prompt, keyed by a hash of its
+    rows.
+
+    Requests that share a prompt header (bos, signatures, tempo, patch changes) load the cached
+    key/values instead of running the prefill. A prompt that extends a cached one only prefills the
+    rows after it.
+    Entries are evicted least recently used first when they exceed `max_bytes`.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (presents, hidden, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def prefix_keys(rows):
+        """hash of every prefix of `rows` (L, max_token_seq), from the shortest to the full
+        prompt"""
+        h = hashlib.sha1()
+        keys = []
+        for row in np.ascontiguousarray(rows, dtype=np.int64):
+            h.update(row.tobytes())
+            keys.append(h.hexdigest())
+        return keys
+
+    def lookup(self, rows):
+        """return (prefix length, presents, last hidden state) of the longest cached prefix of
+        `rows`, (0, None, None) on a miss"""
+        keys = self.prefix_keys(rows)
+        with self.lock:
+            for n in range(len(keys), 0, -1):
+                entry = self.entries.get(keys[n - 1])
+                if entry is not None:
+                    self.entries.move_to_end(keys[n - 1])
+                    if n == len(keys):
+                        self.hits += 1
+                    else:
+                        self.partial_hits += 1
+                    return n, entry[0], entry[1]
+            self.misses += 1
+        return 0, None, None
+
+    def put(self, rows, presents, hidden):
+        """cache the key/values (1, h, L, d) per entry and the last hidden state (emb_size,) of
+        `rows`"""
+        key = self.prefix_keys(rows)[-1]
+        nbytes = sum(p.nbytes for p in presents) + hidden.nbytes
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = (presents, np.array(hidden, dtype=np.float32), nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.nbytes -= evicted
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.nbytes, "hits": self.hits,
+                "partial_hits": self.partial_hits, "misses": self.misses}
+
+
+def apply_io_binding(model: rt.InferenceSession, io_binding, inputs, outputs, kv_cache: KVCache,
+                     new_len):
+    """Rebind a persistent io_binding for one step.
+
+    `inputs` are host numpy arrays, `outputs` are preallocated host numpy arrays that receive the
+    results, the key/values are bound from `kv_cache`.
+    """
+    io_binding.clear_binding_inputs()
+    io_binding.clear_binding_outputs()
+    for name, v in inputs.items():
+        io_binding.bind_cpu_input(name, v)
+    kv_cache.bind(io_binding, new_len)
+    for name, v in outputs.items():
+        io_binding.bind_output(name, "cpu", 0, v.dtype, v.shape, v.ctypes.data)
+    return io_binding
+
+
+def run_with_cache(model: rt.InferenceSession, io_binding, inputs, outputs, kv_cache: KVCache,
+                   new_len):
+    apply_io_binding(model, io_binding, inputs, outputs, kv_cache, new_len)
+    io_binding.synchronize_inputs()
+    model.run_with_iobinding(io_binding)
+    io_binding.synchronize_outputs()
+    kv_cache.advance(new_len)
+
+
+def _per_row(value, n, dtype):
+    """a scalar or per-row sampling param as a contiguous (n,) array"""
+    return np.ascontiguousarray(np.broadcast_to(np.asarray(value, dtype=dtype), (n,)))
+
+
+def _outside_row_ranges(row_ranges, start, end):
+    """(n, end - start) True where an id of [start, end) is outside the row's own [start, end)"""
+    ids = np.arange(start, end)
+    return (ids < row_ranges[:, :1]) | (ids >= row_ranges[:, 1:])
+
+
+def _take_rows(value, rows):
+    """select the rows of a per-row value (array or list), scalars are shared by all rows"""
+    if isinstance(value, (list, tuple)):
+        return [v for v, r in zip(value, rows, strict=True) if r]
+    if np.ndim(value) > 0:
+        return np.asarray(value)[rows]
+    return value
+
+
+def decode_tokens(model: rt.InferenceSession, io_binding, kv_cache: KVCache, hidden, grammar,
+                  sampler: Sampler, logits, temp, top_p, top_k, generator=None, range_head=False,
+                  sampling_graph=False):
+    """Sample the token sequence of one event for every row, starting from the base model's hidden
+    state.
+
+    Rows whose event is already complete are padded without sampling, so they consume no random
+    draws and every row's output only depends on its own params and generator.
+    Tokens the grammar forces (a single allowed id) are emitted without running the token model;
+    they still take their random draw, so the output is the same as if they had been sampled. The
+    token model only runs at positions where some row has a choice, fed every token since its last
+    call at once.
+
+    :param hidden: (batch_size, 1, emb_size)
+    :param grammar: MIDIGrammar or BatchGrammar
+    :param logits: preallocated contiguous output buffer of the token model, (>= batch_size,
+        max_token_seq, vocab_size)
+    :param generator: one generator shared by the batch or a list with one generator per row
+    :param range_head: the token model has a range head (see has_range_head), it then only
+        computes the last position's logits of the ids the sampled rows allow; each row's softmax
+        still only runs over its own grammar range, so rows do not depend on their batch
+    :param sampling_graph: the token model samples in the graph (see has_sampling_graph), only the
+        rows' own ranges, grammar mask, sampling params and random draws go in and the ids come
+        out
+    :return: next_token_seq (batch_size, max_token_seq), grammar state after the event
+    """
+    tokenizer = grammar.tokenizer
+    batch_size, _, emb_size = hidden.shape
+    max_token_seq = tokenizer.max_token_seq
+    vocab_size = tokenizer.vocab_size
+    state = grammar.new_state(batch_size)
+    next_token_seq = np.full((batch_size, max_token_seq), tokenizer.pad_id, dtype=np.int64)
+    logits = logits.reshape(-1)
+    kv_cache.reset(batch_size)
+    fed = 0  # inputs already in the kv cache: the hidden state, then the tokens of the event
+    for i in range(max_token_seq):
+        if i == 0:
+            pending = np.ones(batch_size, dtype=bool)
+        else:
+            pending = grammar.pending(state, i)
+            if not pending.any():
+                break
+        row_ids = grammar.row_ids(state, i)
+        forced = grammar.forced[row_ids]
+        sampled = pending & (forced < 0)
+        if sampled.any():
+            new_len = i + 1 - fed
+            if fed == 0:
+                inputs = {"hidden": hidden, "x": next_token_seq[:, :i].copy()}
+            else:
+                # cached
+                inputs = {"hidden": np.zeros((batch_size, 0, emb_size), dtype=np.float32),
+                          "x": next_token_seq[:, fed - 1:i].copy()}
+            if range_head or sampling_graph:
+                inputs["id_range"] = id_range(grammar.ranges[row_ids[sampled]])
+                start, end = inputs["id_range"].tolist()
+            else:
+                start, end = 0, vocab_size
+            mask = grammar.rows[row_ids, start:end]
+            if sampling_graph:
+                # every row is sampled in the graph from the draw the host sampler would take,
+                # forced rows draw too and their ids are dropped
+                uniform = np.zeros(batch_size, dtype=np.float64)
+                uniform[pending] = draw_uniform(_take_rows(generator, pending), int(pending.sum()))
+                # each row's softmax runs over its own range, the rows that are not sampled take
+                # the whole id_range so their (dropped) ids stay finite
+                row_range = np.tile(inputs["id_range"], (batch_size, 1))
+                row_range[sampled] = grammar.ranges[row_ids[sampled]]
+                inputs.update(row_range=row_range, mask=mask,
+                              temp=_per_row(temp, batch_size, np.float32),
+                              top_p=_per_row(top_p, batch_size, np.float32),
+                              top_k=_per_row(top_k, batch_size, np.int64), uniform=uniform)
+                ids = np.empty(batch_size, dtype=np.int64)
+                run_with_cache(model, io_binding, inputs, {"ids": ids}, kv_cache, new_len)
+                fed = i + 1
+                next_token_seq[sampled, i] = ids[sampled]
+            else:
+                if range_head:
+                    y = logits[:batch_size * (end - start)].reshape(batch_size, 1, end - start)
+                else:
+                    y = logits[:batch_size * new_len * vocab_size].reshape(
+                        batch_size, new_len, vocab_size)
+                run_with_cache(model, io_binding, inputs, {"y": y}, kv_cache, new_len)
+                fed = i + 1
+                y = y[:, -1]
+                if range_head:
+                    y[_outside_row_ranges(grammar.ranges[row_ids], start, end)] = -np.inf
+                if sampled.all():
+                    next_token_seq[:, i] = start + sampler(y, mask, temp, top_p, top_k, generator)
+                else:
+                    # forced rows draw too, in row order, to keep every row's random stream
+                    uniform = draw_uniform(_take_rows(generator, pending), int(pending.sum()))
+                    sampled_pending = sampled[pending]
+                    next_token_seq[sampled, i] = start + sampler(
+                        y[sampled], mask[sampled], _take_rows(temp, sampled),
+                        _take_rows(top_p, sampled), _take_rows(top_k, sampled),
+                        uniform=uniform[sampled_pending])
+        else:
+            draw_uniform(_take_rows(generator, pending), int(pending.sum()))
+        forced_rows = pending & (forced >= 0)
+        next_token_seq[forced_rows, i] = forced[forced_rows]
+        if i == 0:
+            state = next_token_seq[:, 0].copy()
+    return next_token_seq, state
+
+
+def get_emb_size(model_base: rt.InferenceSession):
+    for output in model_base.get_outputs():
+        if output.name == "hidden":
+            return output.shape[2]
+    return 1024
+
+
+def has_range_head(model_token: rt.InferenceSession):
+    """True for a token model exported with --range-head: it takes an "id_range" [start, end) input
+    and outputs the logits of those ids at the last position only, (batch, 1, end - start)"""
+    return any(model_input.name == "id_range" for model_input in model_token.get_inputs())
+
+
+def has_sampling_graph(model_token: rt.InferenceSession):
+    """True for a token model exported with --sample-in-graph: a range head that also takes each
+    row's own range, the grammar mask, temp, top_p, top_k and one uniform draw per row and outputs
+    the sampled "ids" (batch,)"""
+    return any(model_input.name == "uniform" for model_input in model_token.get_inputs())
+
+
+def last_hidden_only(model_base: rt.InferenceSession):
+    """True for a model base exported with --last-hidden-only, whose hidden output is
+    (batch, 1, emb_size) for any number of input events"""
+    if model_base.get_modelmeta().custom_metadata_map.get("last_hidden_only") == "True":
+        return True
+    for output in model_base.get_outputs():
+        if output.name == "hidden":
+            return output.shape[1] == 1
+    return False
+
+
+class GenerateSession:
+    """Decoding state kept after generate() returns, so a continuation of the same sequences resumes
+    from the retained base model kv cache instead of prefilling everything generated so far."""
+
+    def __init__(self):
+        self.cache = None  # base model kv cache
+        self.x = None  # last sampled rows, not fed to the base model yet
+        self.length = 0  # events in the sequences so far, including x
+
+    def can_resume(self, prompt):
+        return (self.cache is not None and self.x is not None
+                and self.cache.batch_size == prompt.shape[0] and self.length == prompt.shape[1]
+                and np.array_equal(self.x[:, -1], prompt[:, -1]))
+
+
+def generate(model, prompt=None, batch_size=1, max_len=512, temp=1.0, top_p=0.98, top_k=20,
+             disable_patch_change=False, disable_control_change=False, disable_channels=None,
+             generator=None, session: GenerateSession = None, prefix_cache: PrefixCache = None,
+             disable_tracks=None, duration=None, duration_unit="beats", let_notes_finish=True,
+             cancel: threading.Event = None):
+    """Yield the next event of every row, (batch_size, max_token_seq) per step.
+
+    Generation stops after `max_len` events including the prompt, when every row emitted eos or,
+    with a `duration` in `duration_unit` (ticks, beats, bars or seconds), when every row reached
+    that much music after the prompt. A row that reached it gets pad rows, the event that crossed
+    the end is dropped and, unless `let_notes_finish`, notes are cut at the end. Once `cancel` is
+    set, generation stops before the next step.
+    """
+    tokenizer = model[2]
+    grammar = get_grammar(tokenizer, disable_patch_change, disable_control_change, disable_channels,
+                          disable_tracks)
+    if generator is None:
+        generator = np.random
+    max_token_seq = tokenizer.max_token_seq
+    if prompt is None:
+        input_tensor = np.full((1, max_token_seq), tokenizer.pad_id, dtype=np.int64)
+        input_tensor[0, 0] = tokenizer.bos_id  # bos
+        input_tensor = input_tensor[None, :, :]
+        input_tensor = np.repeat(input_tensor, repeats=batch_size, axis=0)
+    else:
+        if len(prompt.shape) == 2:
+            prompt = prompt[None, :]
+            prompt = np.repeat(prompt, repeats=batch_size, axis=0)
+        elif prompt.shape[0] == 1:
+            prompt = np.repeat(prompt, repeats=batch_size, axis=0)
+        elif len(prompt.shape) != 3 or prompt.shape[0] != batch_size:
+            raise ValueError(f"invalid shape for prompt, {prompt.shape}")
+        prompt = prompt[..., :max_token_seq]
+        if prompt.shape[-1] < max_token_seq:
+            prompt = np.pad(prompt, ((0, 0), (0, 0), (0, max_token_seq - prompt.shape[-1])),
+                            mode="constant", constant_values=tokenizer.pad_id)
+        input_tensor = prompt
+    resume = session is not None and session.can_resume(input_tensor)
+    stops = None
+    if duration is not None:
+        stops = []
+        for rows in input_tensor.tolist():
+            clock = MIDIClock(tokenizer)
+            for tokens in rows:
+                clock.feed(tokens)
+            stops.append(StopCondition(clock, duration, duration_unit, let_notes_finish))
+        stopped = np.zeros(batch_size, dtype=bool)
+    seq_len = input_tensor.shape[1]
+    input_tensor = np.ascontiguousarray(input_tensor[:, -MAX_MID_SEQ:], dtype=np.int64)
+    cur_len = input_tensor.shape[1]
+    bar = _progress(desc="generating", total=max_len - cur_len)
+    emb_size = get_emb_size(model[0])
+    last_only = last_hidden_only(model[0])
+    range_head = has_range_head(model[1])
+    sampling_graph = has_sampling_graph(model[1])
+
+    # everything below is allocated once and reused by every step
+    if resume:
+        cache0 = session.cache
+        x = session.x
+    else:
+        # a session's cache may be continued later, let it grow up to the full context
+        cache_len = MAX_MID_SEQ if session is not None else min(max_len, MAX_MID_SEQ)
+        cache0 = KVCache(model[0], batch_size, cache_len, slide=KV_CACHE_SLIDE, capacity=max_len)
+        x = input_tensor
+        if session is not None:
+            session.cache = cache0
+            session.x = None
+            session.length = seq_len
+    prompt_rows = None
+    last_hidden = None
+    if prefix_cache is not None and not resume and np.all(x == x[:1]):
+        prompt_rows = x[0]
+        prefix_len, presents, cached_hidden = prefix_cache.lookup(prompt_rows)
+        if prefix_len > 0:
+            cache0.load(presents)
+            x = x[:, prefix_len:]
+            if x.shape[1] == 0:
+                last_hidden = np.repeat(cached_hidden[None, None], batch_size, axis=0)
+                prompt_rows = None
+    cache1 = KVCache(model[1], batch_size, max_token_seq)
+    io_binding0 = model[0].io_binding()
+    io_binding1 = model[1].io_binding()
+    hidden_buffer = np.empty(batch_size * (1 if last_only else max(x.shape[1], 1)) * emb_size,
+                             dtype=np.float32)
+    logits = np.empty((batch_size, max_token_seq, tokenizer.vocab_size), dtype=np.float32)
+    sampler = Sampler()
+    with bar:
+        while cur_len < max_len:
+            if cancel is not None and cancel.is_set():
+                break
+            new_len = x.shape[1]
+            if new_len > 0:
+                hidden_len = 1 if last_only else new_len
+                hidden = hidden_buffer[:batch_size * hidden_len * emb_size].reshape(
+                    batch_size, hidden_len, emb_size)
+                run_with_cache(model[0], io_binding0, {"x": x}, {"hidden": hidden}, cache0, new_len)
+                last_hidden = np.ascontiguousarray(hidden[:, -1:])
+                if prompt_rows is not None:
+                    prefix_cache.put(prompt_rows, cache0.export(), last_hidden[0, 0])
+                    prompt_rows = None
+            next_token_seq, state = decode_tokens(model[1], io_binding1, cache1, last_hidden,
+                                                  grammar, sampler, logits, temp, top_p, top_k,
+                                                  generator, range_head, sampling_graph)
+            ended = state == tokenizer.eos_id
+            if stops is not None:
+                next_token_seq[stopped] = tokenizer.pad_id
+                for b, stop in enumerate(stops):
+                    if stopped[b] or ended[b]:
+                        continue
+                    tokens = next_token_seq[b].tolist()
+                    if stop.past_end(tokens):
+                        stopped[b] = True
+                        next_token_seq[b] = tokenizer.pad_id
+                    else:
+                        tokens = stop.clamp(tokens)
+                        next_token_seq[b] = tokens
+                        stop.clock.feed(tokens)
+                if stopped.any() and session is not None:
+                    session.cache = None  # the rows no longer follow what the model has seen
+                if stopped.all():
+                    break
+                ended |= stopped
+            x = next_token_seq[:, None, :]
+            cur_len += 1
+            if session is not None:
+                session.x = x
+                session.length += 1
+            bar.update(1)
+            yield next_token_seq
+            if np.all(ended):
+                break
+
+
+class _NoProgress:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def update(self, n=1):
+        pass
+
+
+def _progress(**kwargs):
+    """a tqdm progress bar when tqdm is installed"""
+    return _NoProgress() if tqdm is None else tqdm.tqdm(**kwargs)
+
+
+def download(url, output_file):
+    print(f"Downloading {output_file} from {url}")
+    with urllib.request.urlopen(url) as response:
+        file_size = int(response.headers.get("Content-Length", 0))
+        with _progress(total=file_size, unit="B", unit_scale=True, unit_divisor=1024,
+                       desc=f"Downloading {output_file}") as pbar:
+            with open(output_file, "wb") as f:
+                while True:
+                    chunk = response.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    pbar.update(len(chunk))
+
+
+def download_if_not_exit(url, output_file):
+    if os.path.exists(output_file):
+        return
+    try:
+        Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+        download(url, output_file)
+    except Exception as e:
+        print(f"Failed to download {output_file} from {url}")
+        raise e
+
+
+def session_options(profile="default", intra_op_threads=None, inter_op_threads=None):
+    """SessionOptions of a SESSION_PROFILES profile, with thread counts overridden when given"""
+    if profile not in SESSION_PROFILES:
+        raise ValueError(f"Unknown session profile {profile!r}, "
+                         f"available: {list(SESSION_PROFILES)}")
+    options = rt.SessionOptions()
+    for name, value in SESSION_PROFILES[profile].items():
+        if name == "configs":
+            for key, config in value.items():
+                options.add_session_config_entry(key, config)
+        else:
+            setattr(options, name, value)
+    if intra_op_threads is not None:
+        options.intra_op_num_threads = intra_op_threads
+    if inter_op_threads is not None:
+        options.inter_op_num_threads = inter_op_threads
+    return options
+
+
+def quantized_path(path):
+    """where quantize.py writes the INT8 variant of the model at `path`:
+    model_base.onnx -> model_base.int8.onnx"""
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.int8{ext}"
+
+
+def optimized_model_path(path, providers, options: rt.SessionOptions):
+    """Where the graph ORT optimizes from the model at `path` is kept: next to it, keyed by
+    everything the optimized graph depends on (ORT version, providers, optimization level and the
+    model file itself)."""
+    stat = os.stat(path)
+    provider_names = [p[0] if isinstance(p, (list, tuple)) else p for p in providers]
+    key = json.dumps([rt.__version__, provider_names, str(options.graph_optimization_level),
+                      stat.st_size, stat.st_mtime_ns])
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.opt-{hashlib.sha1(key.encode()).hexdigest()[:12]}{ext}"
+
+
+def create_session(path, providers, profile="default", intra_op_threads=None, inter_op_threads=None,
+                   optimized_cache=True):
+    """InferenceSession of the model at `path` with a session profile.
+
+    With `optimized_cache`, the first start saves the graph ORT optimized (see
+    optimized_model_path) and later starts load it without optimizing again. A model directory that
+    cannot be written just runs without the cache.
+    """
+    def options():
+        return session_options(profile, intra_op_threads, inter_op_threads)
+
+    if not optimized_cache:
+        return rt.InferenceSession(path, sess_options=options(), providers=providers)
+    cache_path = optimized_model_path(path, providers, options())
+    if os.path.exists(cache_path):
+        cached = options()
+        # optimized already
+        cached.graph_optimization_level = rt.GraphOptimizationLevel.ORT_DISABLE_ALL
+        try:
+            return rt.InferenceSession(cache_path, sess_options=cached, providers=providers)
+        except Exception as e:
+            print(f"Ignoring optimized model {cache_path}: {e}")
+    # written aside and moved in place once complete, an interrupted start leaves no broken cache
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    saving = options()
+    saving.optimized_model_filepath = tmp_path
+    try:
+        session = rt.InferenceSession(path, sess_options=saving, providers=providers)
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        print(f"Not caching the optimized graph of {path}: {e}")
+        return rt.InferenceSession(path, sess_options=options(), providers=providers)
+    # some providers keep nodes ORT cannot serialize and save nothing, just run uncached then
+    if os.path.exists(tmp_path):
+        os.replace(tmp_path, cache_path)
+    return session
+
+
+def get_tokenizer(config_name_or_path):
+    if config_name_or_path.endswith(".json"):
+        with open(config_name_or_path, "r") as f:
+            config = json.load(f)
+        tv = config["tokenizer"]["version"]
+        o = config["tokenizer"]["optimise_midi"]
+    else:
+        tv, size = config_name_or_path.split("-")
+        tv = tv[1:]
+        if tv[-1] == "o":
+            o = True
+            tv = tv[:-1]
+        else:
+            o = False
+        if tv not in ["v1", "v2"]:
+            raise ValueError(f"Unknown tokenizer version {tv}")
+    tokenizer = MIDITokenizer(tv)
+    tokenizer.set_optimise_midi(o)
+    return tokenizer
@@ -9,6 +9,7 @@ import tqdm
 from peft import PeftConfig, LoraModel, load_peft_weights, set_peft_model_state_dict
 from transformers import LlamaModel, LlamaConfig, DynamicCache, PretrainedConfig, PreTrainedModel
 
+from midi_grammar import get_grammar
 from midi_tokenizer import MIDITokenizerV1, MIDITokenizerV2, MIDITokenizer
 
 config_name_list = ["tv1-medium", "tv2-medium", "tv2o-medium", "tv2-large", "tv2o-large"]
@@ -167,6 +168,8 @@ class MIDIModel(PreTrainedModel):
     @torch.inference_mode()
     def generate(self, prompt=None, batch_size=1, max_len=512, temp=1.0, top_p=0.98, top_k=20, generator=None):
         tokenizer = self.tokenizer
+        grammar = get_grammar(tokenizer)
+        mask_rows = torch.from_numpy(grammar.rows).to(self.device)
         max_token_seq = tokenizer.max_token_seq
         if prompt is None:
             input_tensor = torch.full((1, max_token_seq), tokenizer.pad_id, dtype=torch.long, device=self.device)
@@ -193,26 +196,13 @@ class MIDIModel(PreTrainedModel):
         past_len = 0
         with bar:
             while cur_len < max_len:
-                end = [False] * batch_size
+                state = grammar.new_state(batch_size)
                 hidden = self.forward(input_tensor[:, past_len:], cache=cache1)[:, -1]
                 next_token_seq = None
-                event_names = [""] * batch_size
                 cache2 = DynamicCache()
                 for i in range(max_token_seq):
-                    mask = torch.zeros((batch_size, tokenizer.vocab_size), dtype=torch.int64, device=self.device)
-                    for b in range(batch_size):
-                        if end[b]:
-                            mask[b, tokenizer.pad_id] = 1
-                            continue
-                        if i == 0:
-                            mask[b, list(tokenizer.event_ids.values()) + [tokenizer.eos_id]] = 1
-                        else:
-                            param_names = tokenizer.events[event_names[b]]
-                            if i > len(param_names):
-                                mask[b, tokenizer.pad_id] = 1
-                                continue
-                            mask[b, tokenizer.parameter_ids[param_names[i - 1]]] = 1
-                    mask = mask.unsqueeze(1)
+                    row_ids = torch.from_numpy(grammar.row_ids(state, i)).to(self.device)
+                    mask = mask_rows[row_ids].unsqueeze(1)
                     x = next_token_seq
                     if i != 0:
                         # cached
@@ -223,17 +213,10 @@ class MIDIModel(PreTrainedModel):
                     samples = self.sample_top_p_k(scores, top_p, top_k, generator=generator)
                     if i == 0:
                         next_token_seq = samples
-                        for b in range(batch_size):
-                            if end[b]:
-                                continue
-                            eid = samples[b].item()
-                            if eid == tokenizer.eos_id:
-                                end[b] = True
-                            else:
-                                event_names[b] = tokenizer.id_events[eid]
+                        state = samples[:, 0].cpu().numpy()
                     else:
                         next_token_seq = torch.cat([next_token_seq, samples], dim=1)
-                        if all([len(tokenizer.events[event_names[b]]) == i for b in range(batch_size) if not end[b]]):
+                        if grammar.is_complete(state, i):
                             break
 
                 if next_token_seq.shape[1] < max_token_seq:
@@ -245,6 +228,6 @@ class MIDIModel(PreTrainedModel):
                 cur_len += 1
                 bar.update(1)
 
-                if all(end):
+                if np.all(state == tokenizer.eos_id):
                     break
         return input_tensor.cpu().numpy()
@@ -1,3 +1,4 @@
+import bisect
 import random
 from typing import Dict, Any
 
@@ -297,27 +298,36 @@ class MIDITokenizerV1:
         event = [name] + params
         return event
 
+    def detokenize_event(self, tokens, t1):
+        """score event of one token row, returns (t1, track_idx, event), event is None if the row
+        has none"""
+        ticks_per_beat = 480
+        if tokens[0] not in self.id_events:
+            return t1, None, None
+        event = self.tokens2event(tokens)
+        if not event:
+            return t1, None, None
+        name = event[0]
+        if name == "set_tempo":
+            event[4] = self.bpm2tempo(event[4])
+        if event[0] == "note":
+            event[4] = int(event[4] * ticks_per_beat / 16)
+        t1 += event[1]
+        t = t1 * 16 + event[2]
+        t = int(t * ticks_per_beat / 16)
+        return t1, event[3], [event[0], t] + event[4:]
+
     def detokenize(self, midi_seq):
         ticks_per_beat = 480
         tracks_dict = {}
         t1 = 0
         for tokens in midi_seq:
-            if tokens[0] in self.id_events:
-                event = self.tokens2event(tokens)
-                if not event:
-                    continue
-                name = event[0]
-                if name == "set_tempo":
-                    event[4] = self.bpm2tempo(event[4])
-                if event[0] == "note":
-                    event[4] = int(event[4] * ticks_per_beat / 16)
-                t1 += event[1]
-                t = t1 * 16 + event[2]
-                t = int(t * ticks_per_beat / 16)
-                track_idx = event[3]
-                if track_idx not in tracks_dict:
-                    tracks_dict[track_idx] = []
-                tracks_dict[track_idx].append([event[0], t] + event[4:])
+            t1, track_idx, event = self.detokenize_event(tokens, t1)
+            if event is None:
+                continue
+            if track_idx not in tracks_dict:
+                tracks_dict[track_idx] = []
+            tracks_dict[track_idx].append(event)
         tracks = [tr for idx, tr in sorted(list(tracks_dict.items()), key=lambda it: it[0])]
 
         for i in range(len(tracks)):  # to eliminate note overlap
@@ -940,54 +950,64 @@ class MIDITokenizerV2:
         event = [name] + params
         return event
 
+    def detokenize_event(self, tokens, t1):
+        """score event of one token row, returns (t1, track_idx, event), event is None if the row
+        has none"""
+        ticks_per_beat = 480
+        # Normalize tokens to a flat list of Python ints to avoid unhashable numpy types
+        try:
+            import numpy as _np  # local import to avoid hard dependency at module import
+            tokens = _np.array(tokens).reshape(-1).tolist()
+        except Exception:
+            try:
+                tokens = [int(x) for x in tokens]
+            except Exception:
+                # If still not iterable/int-convertible, skip this record
+                return t1, None, None
+
+        if not (tokens and tokens[0] in self.id_events):
+            return t1, None, None
+        event = self.tokens2event(tokens)
+        if not event:
+            return t1, None, None
+        name = event[0]
+        t1 += event[1]
+        t = t1 * 16 + event[2]
+        t = int(t * ticks_per_beat / 16)
+        track_idx = event[3]
+        event_new = [name, t]
+        if name == "note":
+            c, p, v, d = event[4:]
+            d = int(d * ticks_per_beat / 16)
+            event_new += [d, c, p, v]
+        elif name == "control_change" or name == "patch_change":
+            event_new += event[4:]
+        elif name == "set_tempo":
+            event_new += [self.bpm2tempo(event[4])]
+        elif name == "time_signature":
+            nn, dd = event[4:]
+            nn += 1
+            dd += 1
+            event_new += [nn, dd, 24, 8]  # usually cc, bb = 24, 8
+        elif name == "key_signature":
+            sf, mi = event[4:]
+            sf -= 7
+            event_new += [sf, mi]
+        else:  # should not go here
+            return t1, None, None
+        return t1, track_idx, event_new
+
     def detokenize(self, midi_seq):
         ticks_per_beat = 480
         tracks_dict = {}
         t1 = 0
         for tokens in midi_seq:
-            # Normalize tokens to a flat list of Python ints to avoid unhashable numpy types
-            try:
-                import numpy as _np  # local import to avoid hard dependency at module import
-                tokens = _np.array(tokens).reshape(-1).tolist()
-            except Exception:
-                try:
-                    tokens = [int(x) for x in tokens]
-                except Exception:
-                    # If still not iterable/int-convertible, skip this record
-                    continue
-
-            if tokens and tokens[0] in self.id_events:
-                event = self.tokens2event(tokens)
-                if not event:
-                    continue
-                name = event[0]
-                t1 += event[1]
-                t = t1 * 16 + event[2]
-                t = int(t * ticks_per_beat / 16)
-                track_idx = event[3]
-                event_new = [name, t]
-                if name == "note":
-                    c, p, v, d = event[4:]
-                    d = int(d * ticks_per_beat / 16)
-                    event_new += [d, c, p, v]
-                elif name == "control_change" or name == "patch_change":
-                    event_new += event[4:]
-                elif name == "set_tempo":
-                    event_new += [self.bpm2tempo(event[4])]
-                elif name == "time_signature":
-                    nn, dd = event[4:]
-                    nn += 1
-                    dd += 1
-                    event_new += [nn, dd, 24, 8]  # usually cc, bb = 24, 8
-                elif name == "key_signature":
-                    sf, mi = event[4:]
-                    sf -= 7
-                    event_new += [sf, mi]
-                else:  # should not go here
-                    continue
-                if track_idx not in tracks_dict:
-                    tracks_dict[track_idx] = []
-                tracks_dict[track_idx].append(event_new)
+            t1, track_idx, event = self.detokenize_event(tokens, t1)
+            if event is None:
+                continue
+            if track_idx not in tracks_dict:
+                tracks_dict[track_idx] = []
+            tracks_dict[track_idx].append(event)
         tracks = [tr for idx, tr in sorted(list(tracks_dict.items()), key=lambda it: it[0])]
 
         for i in range(len(tracks)):  # to eliminate note overlap
@@ -1197,6 +1217,66 @@ class MIDITokenizerV2:
         return not reasons, reasons
 
 
+class StreamingDetokenizer:
+    """
+    Incremental ``detokenize``: token rows are appended as they are generated and ``score()``
+    returns the same score as ``tokenizer.detokenize`` of all rows so far.
+
+    Events are kept sorted by time in their track, ties in arrival order, and the notes of each
+    (track, channel, pitch) keep their overlap-free duration up to date as later notes arrive.
+    Events come mostly in time order, so appending a row costs O(1) amortized and ``score()`` only
+    copies the tracks out.
+    """
+
+    ticks_per_beat = 480
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.t1 = 0
+        self.rows = 0
+        self.tracks = {}  # track_idx -> events sorted by time
+        self.times = {}  # track_idx -> times of those events
+        # (track_idx, channel, pitch) -> (times, events, durations before overlap removal)
+        self.notes = {}
+
+    def __len__(self):
+        return self.rows
+
+    def append(self, tokens):
+        self.rows += 1
+        self.t1, track_idx, event = self.tokenizer.detokenize_event(tokens, self.t1)
+        if event is None:
+            return
+        t = event[1]
+        times = self.times.setdefault(track_idx, [])
+        track = self.tracks.setdefault(track_idx, [])
+        i = bisect.bisect_right(times, t)
+        times.insert(i, t)
+        track.insert(i, event)
+        if event[0] == "note":
+            # a note ends where the next note of the same channel and pitch starts
+            d, c, p = event[2:5]
+            note_times, notes, durations = self.notes.setdefault((track_idx, c, p), ([], [], []))
+            i = bisect.bisect_right(note_times, t)
+            note_times.insert(i, t)
+            notes.insert(i, event)
+            durations.insert(i, d)
+            if i + 1 < len(notes):
+                event[2] = min(d, max(note_times[i + 1] - t, 0))
+            if i > 0:
+                notes[i - 1][2] = min(durations[i - 1], max(t - note_times[i - 1], 0))
+
+    def extend(self, midi_seq):
+        for tokens in midi_seq:
+            self.append(tokens)
+
+    def score(self):
+        """the score of every row so far, zero-length notes left out"""
+        tracks = [[list(e) for e in track if e[0] != "note" or e[2] != 0]
+                  for _, track in sorted(self.tracks.items(), key=lambda it: it[0])]
+        return [self.ticks_per_beat, *tracks]
+
+
 class MIDITokenizer:
     def __new__(cls, version="v2"):
         if version == "v1":
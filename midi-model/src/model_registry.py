@@ -0,0 +1,135 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def model_nbytes(*paths):
+    """memory estimate of the ONNX files at `paths`: their weights are loaded whole, so their
+    size"""
+    total = 0
+    for path in paths:
+        total += os.path.getsize(path)
+        data = path + ".data"  # external weights of models over 2GB
+        if os.path.exists(data):
+            total += os.path.getsize(data)
+    return total
+
+
+class ModelPair:
+    """model_base and model_token sessions of one model with its tokenizer"""
+
+    def __init__(self, name, model_base, model_token, tokenizer, nbytes):
+        self.name = name
+        self.model_base = model_base
+        self.model_token = model_token
+        self.tokenizer = tokenizer
+        self.nbytes = nbytes
+
+    @property
+    def model(self):
+        """the (model_base, model_token, tokenizer) tuple generate() takes"""
+        return self.model_base, self.model_token, self.tokenizer
+
+    def close(self):
+        """called once the registry evicted the model, the sessions are freed with the last
+        reference"""
+        pass
+
+
+class ModelRegistry:
+    """
+    Named models, loaded on first use by ``load(name)`` and kept resident while they fit in
+    `max_bytes`.
+
+    Before a model loads, the least recently used models that no request holds (``acquire`` ..
+    ``release``) are evicted until its ``size(name)`` fits next to the others, so the budget holds
+    while it loads too. Models in use are never evicted, so the budget may be exceeded while they
+    run. A model loads outside the registry lock: other models stay usable meanwhile and concurrent
+    requests for the same model wait for one load.
+    """
+
+    def __init__(self, names, load, max_bytes, size=None):
+        self.names = list(names)
+        self.load = load
+        self.size = size  # name -> expected bytes of the model, known before it loads
+        self.max_bytes = max_bytes
+        self.models = OrderedDict()  # name -> loaded model, least recently used first
+        self.users = {}  # name -> requests holding the model
+        self.loading = {}  # name -> lock held while the model loads
+        self.reserved = {}  # name -> expected bytes of a model that is loading
+        self.lock = threading.Lock()
+
+    def nbytes(self):
+        return sum(model.nbytes for model in self.models.values())
+
+    def _use(self, name):
+        model = self.models.get(name)
+        if model is not None:
+            self.models.move_to_end(name)
+            self.users[name] = self.users.get(name, 0) + 1
+        return model
+
+    def acquire(self, name):
+        """the model `name`, loading it if it is not resident; hand it back with release(name)"""
+        if name not in self.names:
+            raise ValueError(f"Unknown model {name!r}, available: {self.names}")
+        with self.lock:
+            model = self._use(name)
+            if model is not None:
+                return model
+            load_lock = self.loading.setdefault(name, threading.Lock())
+        with load_lock:
+            with self.lock:
+                model = self._use(name)
+            if model is not None:
+                return model
+            expected = self.size(name) if self.size is not None else 0
+            with self.lock:
+                self.reserved[name] = expected
+                evicted = self._evict()
+            for old in evicted:
+                old.close()
+            try:
+                model = self.load(name)
+            finally:
+                with self.lock:
+                    del self.reserved[name]
+            with self.lock:
+                self.models[name] = model
+                self.users[name] = self.users.get(name, 0) + 1
+                evicted = self._evict()
+        for old in evicted:
+            old.close()
+        return model
+
+    def release(self, name):
+        with self.lock:
+            self.users[name] -= 1
+            evicted = self._evict()
+        for old in evicted:
+            old.close()
+
+    @contextmanager
+    def use(self, name):
+        """``with registry.use(name) as model:``"""
+        model = self.acquire(name)
+        try:
+            yield model
+        finally:
+            self.release(name)
+
+    def _evict(self):
+        evicted = []
+        while self.nbytes() + sum(self.reserved.values()) > self.max_bytes:
+            name = next((name for name in self.models if not self.users.get(name)), None)
+            if name is None:
+                break
+            evicted.append(self.models.pop(name))
+        return evicted
+
+    def stats(self):
+        with self.lock:
+            return {"resident": list(self.models), "bytes": self.nbytes(),
+                    "max_bytes": self.max_bytes}
+
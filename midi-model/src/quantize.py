@@ -0,0 +1,167 @@
+"""
+INT8 variants of exported model_base/model_token graphs and a parity report against fp32.
+
+Weights of every MatMul, the lm_head included, are quantized to int8 ahead of time; activations
+are quantized dynamically at run time (onnxruntime.quantization.quantize_dynamic). Needs the `onnx`
+package besides onnxruntime. The runtimes run the pair with --quantized, quantizing models that have
+no *.int8.onnx next to them on first load (quantized_model).
+"""
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+import onnxruntime as rt
+
+import MIDI
+from midi_inference import get_tokenizer, has_range_head, last_hidden_only, quantized_path, softmax
+
+
+def quantize_model(path, out_path=None, per_channel=True, reduce_range=False):
+    """write the weight-quantized INT8 graph of the ONNX model at `path`, returns its path"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    out_path = out_path or quantized_path(path)
+    quantize_dynamic(path, out_path, op_types_to_quantize=["MatMul", "Gemm"],
+                     per_channel=per_channel, reduce_range=reduce_range,
+                     weight_type=QuantType.QInt8)
+    return out_path
+
+
+def quantized_model(path):
+    """path of the INT8 variant of the model at `path`, quantized once if it does not exist yet"""
+    out_path = quantized_path(path)
+    if not os.path.exists(out_path):
+        print(f"Quantizing {path} -> {out_path}")
+        # written aside and moved in place once complete, like the optimized graph cache
+        tmp_path = f"{os.path.splitext(out_path)[0]}.{os.getpid()}.tmp.onnx"
+        try:
+            quantize_model(path, tmp_path)
+        except ImportError as e:
+            raise RuntimeError(f"{out_path} is missing and quantizing needs the onnx package "
+                               f"({e}), install it or run quantize.py where it is installed") from e
+        os.replace(tmp_path, out_path)
+    return out_path
+
+
+def _empty_past(model: rt.InferenceSession, batch_size):
+    past = {}
+    for model_input in model.get_inputs():
+        if model_input.name.startswith("past_key_values."):
+            _, heads, _, head_size = model_input.shape
+            past[model_input.name] = np.zeros((batch_size, heads, 0, head_size), dtype=np.float32)
+    return past
+
+
+def teacher_forced_logits(model, events):
+    """logits the model gives each token of `events` (n, max_token_seq) knowing everything before
+    it, (n, max_token_seq, vocab), with the time spent in each graph"""
+    model_base, model_token, _ = model
+    if last_hidden_only(model_base) or has_range_head(model_token):
+        raise ValueError("the parity report needs the logits of every position, export the models "
+                         "without --last-hidden-only and --range-head")
+    start = time.perf_counter()
+    hidden = model_base.run(["hidden"], {"x": events[None], **_empty_past(model_base, 1)})[0][0]
+    base_time = time.perf_counter() - start
+    # each event's tokens are predicted from the hidden state of the events before it
+    hidden = hidden[:-1, None]
+    start = time.perf_counter()
+    logits = model_token.run(["y"], {"hidden": hidden, "x": events[1:, :-1],
+                                     **_empty_past(model_token, len(hidden))})[0]
+    token_time = time.perf_counter() - start
+    return logits, base_time, token_time
+
+
+def parity_report(model_fp32, model_int8, midi_paths, max_events=256):
+    """Compare the next-token distributions of both model pairs on held-out MIDI, teacher forced.
+
+    Only the positions decoding actually samples are compared: the event type and its parameters.
+    kl is KL(fp32 || int8) in nats per token, nll the negative log likelihood of the real tokens.
+    """
+    tokenizer = model_fp32[2]
+    kl, agree, nll32, nll8 = [], [], [], []
+    times = {"fp32": [0.0, 0.0], "int8": [0.0, 0.0]}
+    events_total = 0
+    for path in midi_paths:
+        with open(path, "rb") as f:
+            events = tokenizer.tokenize(MIDI.midi2score(f.read()))
+        events = np.asarray(events, dtype=np.int64)[:max_events]
+        if len(events) < 2:
+            continue
+        targets = events[1:]
+        mask = targets != tokenizer.pad_id
+        mask[:, 0] = True
+        results = {}
+        for name, model in (("fp32", model_fp32), ("int8", model_int8)):
+            logits, base_time, token_time = teacher_forced_logits(model, events)
+            results[name] = softmax(logits.astype(np.float64), -1)[mask]
+            times[name][0] += base_time
+            times[name][1] += token_time
+        p, q = results["fp32"], results["int8"]
+        real = targets[mask]
+        eps = 1e-12
+        kl.append(np.sum(p * (np.log(p + eps) - np.log(q + eps)), axis=-1))
+        agree.append(np.argmax(p, -1) == np.argmax(q, -1))
+        nll32.append(-np.log(p[np.arange(len(real)), real] + eps))
+        nll8.append(-np.log(q[np.arange(len(real)), real] + eps))
+        events_total += len(targets)
+    if not kl:
+        raise ValueError("no usable MIDI files for the parity report")
+    kl, agree = np.concatenate(kl), np.concatenate(agree)
+    nll32, nll8 = np.concatenate(nll32), np.concatenate(nll8)
+    return {
+        "files": len(midi_paths),
+        "events": events_total,
+        "tokens": int(len(kl)),
+        "kl_mean": float(kl.mean()),
+        "kl_p99": float(np.percentile(kl, 99)),
+        "kl_max": float(kl.max()),
+        "top1_agreement": float(agree.mean()),
+        "nll_fp32": float(nll32.mean()),
+        "nll_int8": float(nll8.mean()),
+        "ms_per_event": {name: {"base": 1000 * t[0] / events_total,
+                                "token": 1000 * t[1] / events_total}
+                         for name, t in times.items()},
+    }
+
+
+def load_pair(model_base_path, model_token_path, tokenizer):
+    providers = ["CPUExecutionProvider"]
+    return (rt.InferenceSession(model_base_path, providers=providers),
+            rt.InferenceSession(model_token_path, providers=providers), tokenizer)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="tv2o-medium",
+                        help="model config name or config.json path")
+    parser.add_argument("--model-base", type=str, default="model_base.onnx",
+                        help="fp32 model base")
+    parser.add_argument("--model-token", type=str, default="model_token.onnx",
+                        help="fp32 model token")
+    parser.add_argument("--no-per-channel", action="store_true", default=False,
+                        help="one scale per weight matrix instead of per output channel")
+    parser.add_argument("--reduce-range", action="store_true", default=False,
+                        help="7 bit weights, avoids saturation on CPUs without VNNI")
+    parser.add_argument("--midi", type=str, nargs="*", default=[],
+                        help="held-out MIDI files (globs) for the parity report")
+    parser.add_argument("--max-events", type=int, default=256,
+                        help="events of each MIDI file compared")
+    parser.add_argument("--report", type=str, default="", help="write the parity report json here")
+    opt = parser.parse_args()
+    for path in (opt.model_base, opt.model_token):
+        out = quantize_model(path, per_channel=not opt.no_per_channel,
+                             reduce_range=opt.reduce_range)
+        print(f"quantized {path} -> {out}")
+    midi_paths = sorted(set(p for pattern in opt.midi for p in glob.glob(pattern)))
+    if midi_paths:
+        tokenizer = get_tokenizer(opt.config)
+        report = parity_report(load_pair(opt.model_base, opt.model_token, tokenizer),
+                               load_pair(quantized_path(opt.model_base),
+                                         quantized_path(opt.model_token), tokenizer),
+                               midi_paths, opt.max_events)
+        print(json.dumps(report, indent=2))
+        if opt.report:
+            with open(opt.report, "w") as f:
+                json.dump(report, f, indent=2)
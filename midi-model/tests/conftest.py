@@ -0,0 +1,242 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.join(ROOT, "websocket"))
+
+onnx = pytest.importorskip("onnx")
+rt = pytest.importorskip("onnxruntime")
+
+from onnx import TensorProto, numpy_helper  # noqa: E402
+from onnx import helper as oh  # noqa: E402
+
+import midi_inference  # noqa: E402
+
+midi_inference.device = "cpu"
+
+EMB_SIZE = 16
+HEADS = 2
+
+
+class GraphBuilder:
+    """Small random decoder graphs with the inputs and outputs of the exported model_base and
+    model_token, so decoding runs end to end without a checkpoint.
+
+    Each layer writes its keys/values to the kv cache and adds the causal mean of the present keys
+    to the hidden state, so outputs depend on every cached position like attention does.
+    """
+
+    def __init__(self, seed):
+        self.rng = np.random.RandomState(seed)
+        self.nodes = []
+        self.initializers = []
+        self.inputs = []
+        self.outputs = []
+        self.count = 0
+
+    def const(self, value, dtype=np.int64):
+        self.count += 1
+        name = f"c{self.count}"
+        self.initializers.append(numpy_helper.from_array(np.asarray(value, dtype=dtype), name))
+        return name
+
+    def weight(self, *shape, scale=0.5):
+        self.count += 1
+        name = f"w{self.count}"
+        value = (self.rng.randn(*shape) * scale).astype(np.float32)
+        self.initializers.append(numpy_helper.from_array(value, name))
+        return name
+
+    def node(self, op, inputs, n_outputs=1, **attrs):
+        self.count += 1
+        outputs = [f"n{self.count}_{i}" for i in range(n_outputs)]
+        self.nodes.append(oh.make_node(op, inputs, outputs, **attrs))
+        return outputs[0] if n_outputs == 1 else outputs
+
+    def input(self, name, dtype, shape):
+        self.inputs.append(oh.make_tensor_value_info(name, dtype, shape))
+        return name
+
+    def output(self, value, name, dtype, shape):
+        self.nodes.append(oh.make_node("Identity", [value], [name]))
+        self.outputs.append(oh.make_tensor_value_info(name, dtype, shape))
+
+    def layers(self, h, n_layers):
+        head_size = EMB_SIZE // HEADS
+        one = self.const(1)
+        for layer in range(n_layers):
+            for kv in ("key", "value"):
+                past = self.input(f"past_key_values.{layer}.{kv}", TensorProto.FLOAT,
+                                  ["batch", HEADS, "past_seq", head_size])
+                proj = self.node("MatMul", [h, self.weight(EMB_SIZE, EMB_SIZE, scale=0.3)])
+                proj = self.node("Reshape", [proj, self.const([0, 0, HEADS, head_size])])
+                proj = self.node("Transpose", [proj], perm=[0, 2, 1, 3])
+                present = self.node("Concat", [past, proj], axis=2)
+                self.output(present, f"present.{layer}.{kv}", TensorProto.FLOAT,
+                            ["batch", HEADS, "present_seq", head_size])
+                if kv == "key":
+                    keys = present
+            # causal mean over the cached positions, the last len(h) of them feed the new positions
+            keys = self.node("ReduceMean", [keys], axes=[1], keepdims=0)
+            total = self.node("CumSum", [keys, one])
+            n = self.node("Cast", [self.node("Gather", [self.node("Shape", [keys]), one], axis=0)],
+                          to=TensorProto.FLOAT)
+            count = self.node("Range", [self.const(1.0, np.float32),
+                                        self.node("Add", [n, self.const(1.0, np.float32)]),
+                                        self.const(1.0, np.float32)])
+            mean = self.node("Div", [total, self.node("Reshape", [count, self.const([1, -1, 1])])])
+            new_len = self.node("Gather", [self.node("Shape", [h]), one], axis=0)
+            start = self.node("Unsqueeze", [self.node("Neg", [new_len]), self.const([0])])
+            mean = self.node("Slice", [mean, start, self.const([2 ** 62]), self.const([1])])
+            h = self.node("Add", [h, self.node("Tile", [mean, self.const([1, 1, HEADS])])])
+        return h
+
+    def last_position(self, h):
+        return self.node("Slice", [h, self.const([-1]), self.const([2 ** 62]), self.const([1])])
+
+    def save(self, path):
+        graph = oh.make_graph(self.nodes, "g", self.inputs, self.outputs, self.initializers)
+        model = oh.make_model(graph, opset_imports=[oh.make_opsetid("", 14)])
+        model.ir_version = 8
+        onnx.checker.check_model(model)
+        onnx.save(model, path)
+
+
+def build_model_base(path, tokenizer, last_hidden_only=False, seed=0):
+    vocab_size = tokenizer.vocab_size
+    g = GraphBuilder(seed)
+    x = g.input("x", TensorProto.INT64, ["batch", "mid_seq", "token_seq"])
+    h = g.node("ReduceSum", [g.node("Gather", [g.weight(vocab_size, EMB_SIZE), x]), g.const([2])],
+               keepdims=0)
+    h = g.layers(h, 2)
+    if last_hidden_only:
+        g.output(g.last_position(h), "hidden", TensorProto.FLOAT, ["batch", 1, EMB_SIZE])
+    else:
+        g.output(h, "hidden", TensorProto.FLOAT, ["batch", "mid_seq", EMB_SIZE])
+    g.save(path)
+
+
+def build_model_token(path, tokenizer, head="full", seed=1):
+    """head: "full" logits of every position, "range" the logits of id_range at the last position
+    (--range-head), "sample" the range head sampling in the graph (--sample-in-graph). eos is
+    unlikely, so sequences run to their max_len."""
+    vocab_size = tokenizer.vocab_size
+    g = GraphBuilder(seed)
+    hidden = g.input("hidden", TensorProto.FLOAT, ["batch", "states", EMB_SIZE])
+    x = g.input("x", TensorProto.INT64, ["batch", "token_seq"])
+    h = g.node("Concat", [hidden, g.node("Gather", [g.weight(vocab_size, EMB_SIZE), x])], axis=1)
+    h = g.layers(h, 1)
+    lm_head = g.weight(EMB_SIZE, vocab_size, scale=0.8)
+    bias = np.zeros(vocab_size, dtype=np.float32)
+    bias[tokenizer.eos_id] = -30
+    bias = g.const(bias, np.float32)
+    if head == "full":
+        g.output(g.node("Add", [g.node("MatMul", [h, lm_head]), bias]), "y", TensorProto.FLOAT,
+                 ["batch", "token_seq1", vocab_size])
+        g.save(path)
+        return
+    id_range = g.input("id_range", TensorProto.INT64, [2])
+    start = g.node("Slice", [id_range, g.const([0]), g.const([1])])
+    end = g.node("Slice", [id_range, g.const([1]), g.const([2])])
+    y = g.node("MatMul", [g.last_position(h), g.node("Slice", [lm_head, start, end, g.const([1])])])
+    y = g.node("Add", [y, g.node("Slice", [bias, start, end])])
+    if head == "range":
+        g.output(y, "y", TensorProto.FLOAT, ["batch", 1, "ids"])
+        g.save(path)
+        return
+    # MIDIModelTokenSampler of export.py
+    row_range = g.input("row_range", TensorProto.INT64, ["batch", 2])
+    mask = g.input("mask", TensorProto.BOOL, ["batch", "ids"])
+    temp = g.input("temp", TensorProto.FLOAT, ["batch"])
+    top_p = g.input("top_p", TensorProto.FLOAT, ["batch"])
+    top_k = g.input("top_k", TensorProto.INT64, ["batch"])
+    uniform = g.input("uniform", TensorProto.DOUBLE, ["batch"])
+    zero, one, axis1 = g.const(0), g.const(1), g.const([1])
+    logits = g.node("Squeeze", [y, axis1])
+    n_ids = g.node("Gather", [g.node("Shape", [logits]), one], axis=0)
+    ids = g.node("Add", [g.node("Range", [zero, n_ids, one]), g.node("Gather", [id_range, zero])])
+    row_start = g.node("Slice", [row_range, g.const([0]), g.const([1]), axis1])
+    row_end = g.node("Slice", [row_range, g.const([1]), g.const([2]), axis1])
+    outside = g.node("Or", [g.node("Less", [ids, row_start]),
+                            g.node("GreaterOrEqual", [ids, row_end])])
+    logits = g.node("Where", [outside, g.const(-np.inf, np.float32), logits])
+    probs = g.node("Softmax", [g.node("Div", [logits, g.node("Unsqueeze", [temp, axis1])])],
+                   axis=-1)
+    probs = g.node("Mul", [probs, g.node("Cast", [mask], to=TensorProto.FLOAT)])
+    probs_sort, probs_idx = g.node("TopK", [probs, g.node("Unsqueeze", [n_ids, g.const([0])])],
+                                   n_outputs=2, axis=-1, largest=1, sorted=1)
+    cdf = g.node("CumSum", [probs_sort, one])
+    rank = g.node("Range", [zero, n_ids, one])
+    cut = g.node("Or", [
+        g.node("Greater", [g.node("Sub", [cdf, probs_sort]), g.node("Unsqueeze", [top_p, axis1])]),
+        g.node("GreaterOrEqual", [rank, g.node("Unsqueeze", [g.node("Max", [top_k, one]), axis1])]),
+    ])
+    probs_sort = g.node("Where", [cut, g.const(0.0, np.float32), probs_sort])
+    cdf = g.node("Cast", [g.node("CumSum", [probs_sort, one])], to=TensorProto.DOUBLE)
+    total = g.node("Slice", [cdf, g.const([-1]), g.const([2 ** 62]), axis1])
+    threshold = g.node("Mul", [g.node("Unsqueeze", [uniform, axis1]), total])
+    below = g.node("LessOrEqual", [g.node("Slice", [cdf, g.const([0]), g.const([-1]), axis1]),
+                                   threshold])
+    choice = g.node("ReduceSum", [g.node("Cast", [below], to=TensorProto.INT64), axis1], keepdims=1)
+    sampled = g.node("Squeeze", [g.node("GatherElements", [probs_idx, choice], axis=1), axis1])
+    g.output(g.node("Add", [sampled, g.node("Gather", [id_range, zero])]), "ids",
+             TensorProto.INT64, ["batch"])
+    g.save(path)
+
+
+@pytest.fixture(scope="session")
+def model_files(tmp_path_factory):
+    path = tmp_path_factory.mktemp("models")
+    config = str(path / "config.json")
+    with open(config, "w") as f:
+        json.dump({"tokenizer": {"version": "v2", "optimise_midi": True}}, f)
+    tokenizer = midi_inference.get_tokenizer(config)
+    files = {"config": config}
+    for name, build, kwargs in [
+        ("base", build_model_base, {}),
+        ("base_last", build_model_base, {"last_hidden_only": True}),
+        ("token", build_model_token, {}),
+        ("token_range", build_model_token, {"head": "range"}),
+        ("token_sample", build_model_token, {"head": "sample"}),
+    ]:
+        files[name] = str(path / f"model_{name}.onnx")
+        build(files[name], tokenizer, **kwargs)
+    return files
+
+
+@pytest.fixture(scope="session")
+def tokenizer(model_files):
+    return midi_inference.get_tokenizer(model_files["config"])
+
+
+@pytest.fixture(scope="session")
+def load_model(model_files, tokenizer):
+    """(model_base, model_token, tokenizer) of the synthetic graphs, e.g.
+    load_model(token="token_range")"""
+    sessions = {}
+
+    def session(name):
+        if name not in sessions:
+            sessions[name] = rt.InferenceSession(model_files[name],
+                                                 providers=["CPUExecutionProvider"])
+        return sessions[name]
+
+    def load(base="base", token="token"):
+        return session(base), session(token), tokenizer
+
+    return load
+
+
+@pytest.fixture
+def prompt(tokenizer):
+    rows = [[tokenizer.bos_id] + [tokenizer.pad_id] * (tokenizer.max_token_seq - 1)]
+    for event in (["patch_change", 0, 0, 1, 0, 0], ["patch_change", 0, 0, 2, 9, 0],
+                  ["set_tempo", 0, 0, 0, 120]):
+        tokens = tokenizer.event2tokens(event)
+        rows.append(tokens + [tokenizer.pad_id] * (tokenizer.max_token_seq - len(tokens)))
+    return np.asarray(rows, dtype=np.int64)
@@ -0,0 +1,161 @@
+import gc
+import math
+import queue
+import threading
+import weakref
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from batch_scheduler import BatchScheduler, GeneratePool, ServerBusy, StreamSession
+
+from midi_grammar import MIDIGrammar
+
+PARAMS = [
+    {"seed": 1, "gen_events": 30, "temp": 0.9, "top_p": 0.9, "top_k": 20},
+    {"seed": 2, "gen_events": 24, "temp": 1.1, "top_p": 0.8, "top_k": 50,
+     "disable_channels": list(range(1, 16)), "disable_patch_change": True},
+    {"seed": 3, "gen_events": 18, "temp": 1.0, "top_p": 0.95, "top_k": 5},
+    {"seed": 4, "gen_events": 27, "temp": 0.8, "top_p": 0.7, "top_k": 30,
+     "disable_control_change": True},
+]
+
+
+def decode(scheduler, tokenizer, prompt, params_list):
+    """submit a session per params and return the events each one decoded"""
+    queues = []
+    for params in params_list:
+        events = queue.Queue()
+        queues.append(events)
+        scheduler.submit(StreamSession(tokenizer, prompt, params,
+                                       lambda msg_type, data, events=events:
+                                       events.put((msg_type, data))))
+    outputs = []
+    for events in queues:
+        rows = []
+        while True:
+            msg_type, data = events.get(timeout=60)
+            if msg_type == "event":
+                rows.append(data[0].tolist())
+            elif msg_type == "complete":
+                break
+            else:
+                raise RuntimeError(data)
+        outputs.append(np.array(rows))
+    return outputs
+
+
+@pytest.mark.parametrize("token", ["token", "token_range", "token_sample"])
+def test_session_decodes_the_same_alone_and_batched(load_model, tokenizer, prompt, token):
+    scheduler = BatchScheduler(load_model(token=token), max_batch=len(PARAMS))
+    scheduler.start()
+    try:
+        alone = [decode(scheduler, tokenizer, prompt, [params])[0] for params in PARAMS]
+        batched = decode(scheduler, tokenizer, prompt, PARAMS)
+    finally:
+        scheduler.stop()
+    for params, a, b in zip(PARAMS, alone, batched, strict=True):
+        assert a.shape == (params["gen_events"], tokenizer.max_token_seq)
+        np.testing.assert_array_equal(a, b)
+
+
+def test_batch_grammar_cache(load_model, tokenizer):
+    scheduler = BatchScheduler(load_model(), max_batch=2)
+    drums = MIDIGrammar(tokenizer, disable_channels=list(range(9)) + list(range(10, 16)))
+    batch = [SimpleNamespace(grammar=MIDIGrammar(tokenizer)), SimpleNamespace(grammar=drums)]
+    grammar = scheduler._batch_grammar(batch)
+    assert scheduler._batch_grammar(batch) is grammar
+    assert scheduler._batch_grammar(batch[::-1]) is not grammar
+    grammar = scheduler._batch_grammar(batch)
+    # the cache keeps its grammars alive, a new grammar cannot reuse the id of a cached one
+    cached = weakref.ref(batch[0].grammar)
+    batch[0].grammar = MIDIGrammar(tokenizer)
+    gc.collect()
+    assert cached() is not None
+    assert scheduler._batch_grammar(batch) is not grammar
+
+
+def paced_session(tokenizer, prompt, **params):
+    """a session of the prompt followed by a note two seconds in, at 120 bpm"""
+    session = StreamSession(tokenizer, prompt, dict(PARAMS[0], **params), lambda *_: None)
+    session.clock.feed(tokenizer.event2tokens(["note", 4, 0, 0, 0, 60, 80, 4]))
+    return session
+
+
+def test_session_paced_against_the_playhead(tokenizer, prompt):
+    session = paced_session(tokenizer, prompt)
+    assert session.lead(0.0) == session.pacing_delay(0.0) == 0.0
+    session = paced_session(tokenizer, prompt, lookahead=0.5)
+    now = session.playhead_at
+    # stopped at the start, it waits for a playhead report
+    assert session.lead(now + 10) == 2.0
+    assert session.pacing_delay(now + 10) == math.inf
+    session.set_playhead(1.8, playing=False)
+    assert session.pacing_delay(session.playhead_at + 10) == 0.0
+    session.set_playhead(1.0)
+    now = session.playhead_at
+    # playing, the playhead catches up 0.25 seconds later
+    assert session.lead(now + 0.25) == 0.75
+    assert session.pacing_delay(now + 0.25) == 0.25
+    assert session.pacing_delay(now + 0.5) == 0.0
+
+
+def test_session_waits_for_its_backlog(tokenizer, prompt):
+    session = paced_session(tokenizer, prompt, max_backlog=2)
+    event = tokenizer.event2tokens(["note", 0, 1, 0, 0, 62, 80, 4])
+    session.tokens += [event, event]
+    assert session.backlogged() and session.pacing_delay(0.0) == math.inf
+    session.delivered += 1
+    assert not session.backlogged() and session.pacing_delay(0.0) == 0.0
+    session.set_backlog(0)
+    assert session.max_backlog == 1 and session.backlogged()
+    session.set_backlog(None)
+    assert not session.backlogged()
+
+
+def test_generate_pool_admission():
+    pool = GeneratePool(workers=2, max_queue=2)
+    release = threading.Event()
+    try:
+        positions = [pool.submit(lambda: release.wait(30))[0] for _ in range(4)]
+        assert positions == [0, 0, 1, 2]
+        # no job finished yet, there is no estimate of the wait
+        with pytest.raises(ServerBusy) as busy:
+            pool.submit(lambda: None)
+        assert busy.value.retry_after is None
+    finally:
+        release.set()
+        pool.executor.shutdown(wait=True)
+    assert pool.stats()["running"] == pool.stats()["waiting"] == 0
+    assert pool.avg_seconds is not None
+
+
+def test_generate_pool_cancel_and_retry_after():
+    pool = GeneratePool(workers=1, max_queue=1)
+    started, release = threading.Event(), threading.Event()
+    try:
+        pool.submit(lambda: None)[1].result(30)
+        pool.avg_seconds = 2.0
+        assert pool.submit(lambda: started.set() or release.wait(30))[0] == 0
+        assert started.wait(30)
+        position, waiting = pool.submit(lambda: None)
+        assert position == 1
+        with pytest.raises(ServerBusy) as busy:
+            pool.submit(lambda: None)
+        assert busy.value.retry_after == pool.expected_wait(2) == 4.0
+        assert pool.cancel(waiting)
+        assert pool.stats()["waiting"] == 0
+        assert pool.submit(lambda: None)[0] == 1
+    finally:
+        release.set()
+        pool.executor.shutdown(wait=True)
+
+
+def test_generate_pool_expected_wait():
+    pool = GeneratePool(workers=3)
+    assert pool.expected_wait(0) == 0.0
+    assert pool.expected_wait(1) is None
+    pool.avg_seconds = 1.26
+    assert pool.expected_wait(-1) == 0.0
+    # each round of `workers` jobs ahead takes one average job
+    assert [pool.expected_wait(position) for position in (1, 3, 4, 7)] == [1.3, 1.3, 2.5, 3.8]
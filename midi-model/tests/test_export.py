@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose, assert_array_equal
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("peft")
+pytest.importorskip("onnxsim")
+
+import onnxruntime as rt  # noqa: E402
+
+from export import export_model_base, export_model_token  # noqa: E402
+from midi_inference import Sampler  # noqa: E402
+from midi_model import MIDIModel, MIDIModelConfig  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def exported(tmp_path_factory):
+    """(config, sessions) of a tiny random MIDIModel exported with every model base and model
+    token variant of export.py"""
+    torch.manual_seed(0)
+    config = MIDIModelConfig.get_config("v2", True, n_layer=4, n_head=4, n_embd=32, n_inner=64)
+    model = MIDIModel(config).eval()
+    path = tmp_path_factory.mktemp("export")
+    meta_data = {"config_name": "tiny", "config": config}
+    sessions = {}
+    for name, export, kwargs in [
+        ("base", export_model_base, {}),
+        ("base_last", export_model_base, {"last_hidden_only": True}),
+        ("token", export_model_token, {}),
+        ("token_range", export_model_token, {"range_head": True}),
+        ("token_sample", export_model_token, {"sample_in_graph": True}),
+    ]:
+        model_path = str(path / f"model_{name}.onnx")
+        export(model, model_path, meta_data, **kwargs)
+        sessions[name] = rt.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+    return config, sessions
+
+
+def run(session, output, **inputs):
+    """one output of a run with an empty kv cache"""
+    batch_size = len(inputs["x"])
+    for model_input in session.get_inputs():
+        if model_input.name.startswith("past_key_values"):
+            _, heads, _, head_size = model_input.shape
+            inputs[model_input.name] = np.zeros((batch_size, heads, 0, head_size), np.float32)
+    return session.run([output], inputs)[0]
+
+
+def test_last_hidden_only(exported):
+    config, sessions = exported
+    tokenizer = config.tokenizer
+    rng = np.random.RandomState(0)
+    x = rng.randint(0, tokenizer.vocab_size, (2, 5, tokenizer.max_token_seq)).astype(np.int64)
+    hidden = run(sessions["base"], "hidden", x=x)
+    last = run(sessions["base_last"], "hidden", x=x)
+    assert last.shape == (2, 1, config.n_embd)
+    assert_allclose(last, hidden[:, -1:], rtol=1e-4, atol=1e-5)
+
+
+def test_range_head_matches_full_logits(exported):
+    config, sessions = exported
+    tokenizer = config.tokenizer
+    rng = np.random.RandomState(1)
+    hidden = rng.randn(2, 1, config.n_embd).astype(np.float32)
+    x = rng.randint(0, tokenizer.vocab_size, (2, 3)).astype(np.int64)
+    y = run(sessions["token"], "y", hidden=hidden, x=x)
+    pitch_ids = tokenizer.parameter_ids["pitch"]
+    for start, end in [(pitch_ids[0], pitch_ids[-1] + 1), (0, tokenizer.vocab_size)]:
+        y_range = run(sessions["token_range"], "y", hidden=hidden, x=x,
+                      id_range=np.array([start, end], dtype=np.int64))
+        assert y_range.shape == (2, 1, end - start)
+        assert_allclose(y_range, y[:, -1:, start:end], rtol=1e-4, atol=1e-5)
+
+
+def test_sampling_graph_matches_host_sampler(exported):
+    config, sessions = exported
+    tokenizer = config.tokenizer
+    rng = np.random.RandomState(2)
+    pitch_ids = tokenizer.parameter_ids["pitch"]
+    start, end = pitch_ids[0], pitch_ids[-1] + 1
+    row_range = np.array([[start, start + 40], [start + 20, end], [start, end],
+                          [start + 60, start + 61]], dtype=np.int64)
+    batch_size = len(row_range)
+    mask = rng.rand(batch_size, end - start) < 0.7
+    mask[np.arange(batch_size), row_range[:, 0] - start] = True
+    temp = np.array([1.0, 0.8, 1.2, 1.0], dtype=np.float32)
+    top_p = np.array([0.9, 1.0, 0.5, 0.95], dtype=np.float32)
+    top_k = np.array([20, 50, 5, 1], dtype=np.int64)
+    hidden = rng.randn(batch_size, 1, config.n_embd).astype(np.float32)
+    x = np.zeros((batch_size, 0), dtype=np.int64)
+    sampler = Sampler()
+    for _ in range(10):
+        uniform = rng.random_sample(batch_size)
+        ids = run(sessions["token_sample"], "ids", hidden=hidden, x=x,
+                  id_range=np.array([start, end], dtype=np.int64), row_range=row_range, mask=mask,
+                  temp=temp, top_p=top_p, top_k=top_k, uniform=uniform)
+        # the host sampler with each row alone, over its own range of the range head
+        expected = []
+        for row, (row_start, row_end) in enumerate(row_range):
+            y = run(sessions["token_range"], "y", hidden=hidden[row:row + 1], x=x[row:row + 1],
+                    id_range=row_range[row])[:, -1]
+            expected.append(row_start + sampler(
+                y, mask[row:row + 1, row_start - start:row_end - start], temp[row], top_p[row],
+                top_k[row], uniform=uniform[row:row + 1])[0])
+        assert_array_equal(ids, expected)
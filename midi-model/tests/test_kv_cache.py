@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose, assert_array_equal
+
+from midi_inference import GenerateSession, KVCache, PrefixCache, generate, run_with_cache
+
+
+def collect(model, **kwargs):
+    """every event generate() yields, (batch_size, events, max_token_seq)"""
+    return np.stack(list(generate(model, **kwargs)), axis=1)
+
+
+@pytest.mark.parametrize("base", ["base", "base_last"])
+def test_prefix_cache_hit_matches_no_cache(load_model, prompt, base):
+    model = load_model(base=base)
+    max_len = len(prompt) + 24
+    reference = collect(model, prompt=prompt, batch_size=2, max_len=max_len,
+                        generator=np.random.RandomState(3))
+    cache = PrefixCache(2 ** 24)
+    for _ in range(2):
+        out = collect(model, prompt=prompt, batch_size=2, max_len=max_len, prefix_cache=cache,
+                      generator=np.random.RandomState(3))
+        assert_array_equal(out, reference)
+    assert (cache.misses, cache.hits) == (1, 1)
+
+    # a prompt that extends a cached one only prefills the rows after it
+    longer = np.concatenate([prompt, reference[0, :4]])
+    reference = collect(model, prompt=longer, batch_size=2, max_len=max_len + 4,
+                        generator=np.random.RandomState(4))
+    out = collect(model, prompt=longer, batch_size=2, max_len=max_len + 4, prefix_cache=cache,
+                  generator=np.random.RandomState(4))
+    assert cache.partial_hits == 1
+    assert_array_equal(out, reference)
+
+
+def test_resume_matches_fresh_prefill(load_model, prompt):
+    model = load_model()
+    session = GenerateSession()
+    generator = np.random.RandomState(5)
+    first = collect(model, prompt=prompt, batch_size=2, max_len=len(prompt) + 12,
+                    generator=generator, session=session)
+    sequences = np.concatenate([np.repeat(prompt[None], 2, axis=0), first], axis=1)
+    assert session.can_resume(sequences)
+
+    state = generator.get_state()
+    resumed = collect(model, prompt=sequences, batch_size=2, max_len=sequences.shape[1] + 12,
+                      generator=generator, session=session)
+    fresh_generator = np.random.RandomState()
+    fresh_generator.set_state(state)
+    fresh = collect(model, prompt=sequences, batch_size=2, max_len=sequences.shape[1] + 12,
+                    generator=fresh_generator)
+    assert_array_equal(resumed, fresh)
+
+
+def test_kv_cache_grows_and_slides(load_model, tokenizer):
+    model_base = load_model()[0]
+    io_binding = model_base.io_binding()
+    cache = KVCache(model_base, 1, max_len=6, slide=2, capacity=2)
+    past_names = [past_name for past_name, _, _, _ in cache.entries]
+    present_names = [present_name for _, present_name, _, _ in cache.entries]
+    rng = np.random.RandomState(0)
+    x = rng.randint(0, tokenizer.vocab_size, (1, 20, tokenizer.max_token_seq)).astype(np.int64)
+    position = 0
+    slid = False
+    for new_len in [1, 2, 1, 1, 3, 1, 1, 1, 2, 1, 1, 1, 1]:
+        past = cache.export()
+        rows = x[:, position:position + new_len]
+        position += new_len
+        hidden = np.empty((1, new_len, 16), dtype=np.float32)
+        run_with_cache(model_base, io_binding, {"x": rows}, {"hidden": hidden}, cache, new_len)
+        assert cache.past_len <= cache.max_len
+        kept = cache.past_len - new_len
+        slid |= kept < past[0].shape[2]
+        # the step saw the newest `kept` positions of the past, in order
+        kept_past = {name: p[:, :, p.shape[2] - kept:]
+                     for name, p in zip(past_names, past, strict=True)}
+        expected = model_base.run(["hidden"] + present_names, {"x": rows, **kept_past})
+        assert_allclose(hidden, expected[0], rtol=1e-5, atol=1e-6)
+        for present, expected_present in zip(cache.export(), expected[1:], strict=True):
+            assert_allclose(present, expected_present, rtol=1e-5, atol=1e-6)
+    assert slid
+    assert cache.capacity == cache.max_len
+
+
+def test_kv_cache_export_load(load_model, tokenizer):
+    model_base = load_model()[0]
+    io_binding = model_base.io_binding()
+    rng = np.random.RandomState(1)
+    x = rng.randint(0, tokenizer.vocab_size, (1, 6, tokenizer.max_token_seq)).astype(np.int64)
+    source = KVCache(model_base, 1, max_len=16)
+    hidden = np.empty((1, 5, 16), dtype=np.float32)
+    run_with_cache(model_base, io_binding, {"x": x[:, :5]}, {"hidden": hidden}, source, 5)
+    expected = np.empty((1, 1, 16), dtype=np.float32)
+    presents = source.export()
+    run_with_cache(model_base, io_binding, {"x": x[:, 5:]}, {"hidden": expected}, source, 1)
+
+    # loaded into a smaller cache it grows, and every batch row shares the loaded positions
+    target = KVCache(model_base, 2, max_len=16, capacity=2)
+    target.load(presents)
+    assert target.past_len == 5
+    hidden = np.empty((2, 1, 16), dtype=np.float32)
+    run_with_cache(model_base, io_binding, {"x": np.repeat(x[:, 5:], 2, axis=0)},
+                   {"hidden": hidden}, target, 1)
+    assert_allclose(hidden, np.repeat(expected, 2, axis=0), rtol=1e-5, atol=1e-6)
@@ -0,0 +1,84 @@
+import pytest
+
+from midi_clock import TIME_UNITS, MIDIClock, StopCondition
+
+
+def note(time1, time2, duration, pitch=60):
+    return ["note", time1, time2, 0, 0, pitch, 80, duration]
+
+
+def feed(tokenizer, clock, *events):
+    for event in events:
+        clock.feed(tokenizer.event2tokens(event))
+
+
+def test_positions_and_end(tokenizer):
+    clock = MIDIClock(tokenizer)
+    bos = [tokenizer.bos_id] + [tokenizer.pad_id] * (tokenizer.max_token_seq - 1)
+    assert clock.feed(bos) == []
+    feed(tokenizer, clock, note(0, 4, 8))
+    assert (clock.position, clock.end) == (4, 12)
+    feed(tokenizer, clock, note(1, 0, 40), note(0, 2, 4))
+    assert (clock.position, clock.end) == (18, 56)
+    # an event placed before the last one does not move the clock back
+    assert clock.event_position(note(0, 0, 4)) == 18
+    feed(tokenizer, clock, note(0, 0, 4))
+    assert clock.position == 18
+    assert (clock.beats, clock.ticks, clock.seconds) == (1.125, 540, 0.5625)
+
+
+def test_tempo_change(tokenizer):
+    clock = MIDIClock(tokenizer)
+    feed(tokenizer, clock, ["set_tempo", 2, 0, 0, 60])
+    assert (clock.position, clock.seconds) == (32, 1.0)
+    feed(tokenizer, clock, note(2, 0, 4))
+    # two beats at 60 bpm after one second at 120 bpm
+    assert clock.seconds == 3.0
+    assert clock.position_of(3.0, "seconds") == 64
+
+
+def test_time_signature_change(tokenizer):
+    clock = MIDIClock(tokenizer)
+    # 3/4 from the second 4/4 bar
+    feed(tokenizer, clock, ["time_signature", 4, 0, 0, 2, 1], note(6, 0, 4))
+    assert clock.bar_length == 48
+    assert clock.bars == 3.0
+    assert clock.position_of(3.0, "bars") == 160
+
+
+@pytest.mark.parametrize("unit", TIME_UNITS)
+def test_position_of_inverts_value_at(tokenizer, unit):
+    clock = MIDIClock(tokenizer)
+    feed(tokenizer, clock, ["set_tempo", 1, 0, 0, 90], ["time_signature", 3, 0, 0, 5, 2],
+         note(2, 8, 4))
+    for position in (clock.position, clock.position + 5, clock.position + 100):
+        assert clock.position_of(clock.value_at(position, unit), unit) == pytest.approx(position)
+
+
+def test_stop_after_duration(tokenizer):
+    clock = MIDIClock(tokenizer)
+    feed(tokenizer, clock, note(1, 0, 4))
+    stop = StopCondition(clock, 2, "beats")
+    assert (stop.start, stop.end) == (1.0, 3.0)
+    assert not stop.past_end(tokenizer.event2tokens(note(1, 15, 4)))
+    assert stop.past_end(tokenizer.event2tokens(note(2, 0, 4)))
+    eos = [tokenizer.eos_id] + [tokenizer.pad_id] * (tokenizer.max_token_seq - 1)
+    assert not stop.past_end(eos)
+    # a continuation counts from where the previous request ended
+    assert StopCondition(clock, 1, "bars", start=2.0).end == 3.0
+    with pytest.raises(ValueError):
+        StopCondition(clock, 1, "minutes")
+
+
+def test_clamp_notes_at_the_end(tokenizer):
+    clock = MIDIClock(tokenizer)
+    feed(tokenizer, clock, note(1, 0, 4))
+    tokens = tokenizer.event2tokens(note(1, 8, 20))
+    assert StopCondition(clock, 2, "beats").clamp(tokens) == tokens
+    stop = StopCondition(clock, 2, "beats", let_notes_finish=False)
+    # ends at 3 beats, 8/16 after the note starts
+    assert tokenizer.tokens2event(stop.clamp(tokens)) == note(1, 8, 8)
+    short = tokenizer.event2tokens(note(1, 8, 4))
+    assert stop.clamp(short) == short
+    tempo = tokenizer.event2tokens(["set_tempo", 1, 8, 0, 100])
+    assert stop.clamp(tempo) == tempo
@@ -0,0 +1,42 @@
+import struct
+
+import numpy as np
+import pytest
+
+import MIDI
+from midi_delta import DeltaMIDIEncoder
+from midi_inference import generate
+from midi_tokenizer import StreamingDetokenizer
+
+
+def assemble(committed, tails):
+    """the MIDI file a client builds from the committed fragments and latest tail of every track"""
+    midi = DeltaMIDIEncoder.header(len(tails))
+    for track_idx in sorted(tails):
+        body = committed.get(track_idx, b"") + tails[track_idx]
+        midi += b"MTrk" + struct.pack(">I", len(body)) + body
+    return midi
+
+
+@pytest.mark.parametrize("every", [1, 7, 40])
+def test_delta_snapshots_equal_score2midi(load_model, tokenizer, prompt, every):
+    model = load_model()
+    events = np.stack(list(generate(model, prompt=prompt, max_len=len(prompt) + 160,
+                                    generator=np.random.RandomState(every))), axis=1)
+    rows = prompt.tolist() + events[0].tolist()
+    detokenizer = StreamingDetokenizer(tokenizer)
+    encoder = DeltaMIDIEncoder(detokenizer)
+    committed = {}
+    for i, tokens in enumerate(rows, start=1):
+        detokenizer.append(tokens)
+        # snapshots follow events, score2midi of a score without tracks has a default header
+        if not detokenizer.tracks or (i % every and i != len(rows)):
+            continue
+        delta = encoder.delta()
+        tails = {}
+        for track_idx, data, tail in delta["tracks"]:
+            committed[track_idx] = committed.get(track_idx, b"") + data
+            tails[track_idx] = tail
+        assert assemble(committed, tails) == MIDI.score2midi(tokenizer.detokenize(rows[:i]))
+    assert len(committed) > 1
+    assert dict(encoder.resync()["tracks"]) == committed
@@ -0,0 +1,50 @@
+import os
+import shutil
+
+import numpy as np
+import onnxruntime as rt
+from numpy.testing import assert_allclose
+
+import midi_inference
+from midi_inference import create_session, optimized_model_path, session_options
+
+
+def run(session, tokenizer):
+    x = np.full((1, 2, tokenizer.max_token_seq), tokenizer.pad_id, dtype=np.int64)
+    inputs = {"x": x}
+    for model_input in session.get_inputs():
+        if model_input.name.startswith("past"):
+            inputs[model_input.name] = np.zeros((1, 2, 0, 8), dtype=np.float32)
+    return session.run(["hidden"], inputs)[0]
+
+
+def test_optimized_graph_is_cached(model_files, tokenizer, tmp_path):
+    path = str(tmp_path / "model_base.onnx")
+    shutil.copy(model_files["base"], path)
+    providers = ["CPUExecutionProvider"]
+    cache_path = optimized_model_path(path, providers, session_options("default"))
+    reference = run(rt.InferenceSession(path, providers=providers), tokenizer)
+    assert_allclose(run(create_session(path, providers), tokenizer), reference, rtol=1e-5)
+    assert os.path.exists(cache_path)
+    assert_allclose(run(create_session(path, providers), tokenizer), reference, rtol=1e-5)
+    assert sorted(os.listdir(tmp_path)) == sorted(["model_base.onnx",
+                                                   os.path.basename(cache_path)])
+
+
+def test_unsaved_optimized_graph_runs_uncached(model_files, tokenizer, tmp_path, monkeypatch):
+    path = str(tmp_path / "model_base.onnx")
+    shutil.copy(model_files["base"], path)
+    providers = ["CPUExecutionProvider"]
+    InferenceSession = rt.InferenceSession
+
+    def inference_session(model_path, sess_options=None, providers=None):
+        session = InferenceSession(model_path, sess_options=sess_options, providers=providers)
+        # like a provider whose graph ORT cannot save
+        if sess_options is not None and os.path.exists(sess_options.optimized_model_filepath):
+            os.remove(sess_options.optimized_model_filepath)
+        return session
+
+    monkeypatch.setattr(midi_inference.rt, "InferenceSession", inference_session)
+    session = create_session(path, providers)
+    assert session.get_inputs()[0].name == "x"
+    assert os.listdir(tmp_path) == ["model_base.onnx"]
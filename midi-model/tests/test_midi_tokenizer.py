@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from midi_tokenizer import StreamingDetokenizer
+
+
+def token_rows(tokenizer, events):
+    rows = [[tokenizer.bos_id]]
+    rows += [tokenizer.event2tokens(event) for event in events]
+    return [row + [tokenizer.pad_id] * (tokenizer.max_token_seq - len(row)) for row in rows]
+
+
+def assert_streams_like_detokenize(tokenizer, rows):
+    detokenizer = StreamingDetokenizer(tokenizer)
+    for i, row in enumerate(rows, start=1):
+        detokenizer.append(row)
+        assert detokenizer.score() == tokenizer.detokenize(rows[:i])
+    assert len(detokenizer) == len(rows)
+
+
+def test_out_of_order_and_overlapping_notes(tokenizer):
+    events = [
+        ["patch_change", 0, 0, 1, 0, 0],
+        ["note", 0, 8, 1, 0, 60, 90, 16],
+        # earlier in the same beat, cut where the note above starts
+        ["note", 0, 4, 1, 0, 60, 80, 12],
+        ["note", 0, 2, 2, 9, 36, 100, 4],
+        # starts while the first note still plays, which then ends here
+        ["note", 1, 0, 1, 0, 60, 70, 8],
+        # same start as the note above and later in the stream, it cuts it to zero length
+        ["note", 0, 0, 1, 0, 60, 50, 4],
+        ["control_change", 0, 3, 1, 0, 64, 127],
+        ["note", 0, 1, 1, 0, 64, 70, 0],
+        ["set_tempo", 0, 0, 0, 100],
+        ["note", 2, 5, 1, 0, 60, 70, 4],
+        ["note", 0, 5, 1, 0, 62, 70, 4],
+    ]
+    assert_streams_like_detokenize(tokenizer, token_rows(tokenizer, events))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_events(tokenizer, seed):
+    rng = np.random.RandomState(seed)
+    events = []
+    for _ in range(300):
+        time1, time2, track = int(rng.rand() < 0.2), rng.randint(16), rng.randint(3)
+        kind = rng.choice(["note"] * 6 + ["control_change", "patch_change", "set_tempo"])
+        if kind == "note":
+            events.append(["note", time1, time2, track, rng.randint(2), rng.randint(60, 63),
+                           rng.randint(1, 128), rng.randint(0, 40)])
+        elif kind == "control_change":
+            events.append([kind, time1, time2, track, rng.randint(2), 64, rng.randint(128)])
+        elif kind == "patch_change":
+            events.append([kind, time1, time2, track, rng.randint(2), rng.randint(128)])
+        else:
+            events.append([kind, time1, time2, 0, rng.randint(60, 180)])
+    assert_streams_like_detokenize(tokenizer, token_rows(tokenizer, events))
@@ -0,0 +1,104 @@
+import threading
+
+import pytest
+
+from model_registry import ModelPair, ModelRegistry
+
+SIZES = {"a": 60, "b": 60, "c": 40, "d": 40}
+
+
+class Model(ModelPair):
+    def __init__(self, name):
+        super().__init__(name, None, None, None, SIZES[name])
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Loader:
+    """load(name) of the registry, records what was resident when each model started loading"""
+
+    def __init__(self, gate=None, error=None):
+        self.registry = None
+        self.gate = gate  # loads wait for it
+        self.error = error  # loads raise it
+        self.loaded = {}
+        self.resident = {}
+        self.calls = 0
+
+    def __call__(self, name):
+        self.calls += 1
+        if self.gate is not None:
+            assert self.gate.wait(30)
+        if self.error is not None:
+            raise self.error
+        self.resident[name] = list(self.registry.models)
+        self.loaded[name] = Model(name)
+        return self.loaded[name]
+
+
+def make_registry(max_bytes=100, **loader):
+    load = Loader(**loader)
+    registry = ModelRegistry(SIZES, load, max_bytes, size=SIZES.get)
+    load.registry = registry
+    return registry, load
+
+
+def test_evicts_before_loading():
+    registry, load = make_registry()
+    with registry.use("a"):
+        pass
+    with registry.use("b") as model:
+        assert model is load.loaded["b"]
+    # a was closed before b loaded, both never were resident together
+    assert load.resident["b"] == []
+    assert load.loaded["a"].closed
+    assert registry.stats() == {"resident": ["b"], "bytes": 60, "max_bytes": 100}
+
+
+def test_never_evicts_a_model_in_use():
+    registry, load = make_registry()
+    a = registry.acquire("a")
+    b = registry.acquire("b")
+    # over budget while both run
+    assert load.resident["b"] == ["a"]
+    assert not a.closed and registry.nbytes() == 120
+    registry.release("a")
+    assert a.closed and list(registry.models) == ["b"]
+    registry.release("b")
+    assert not b.closed and list(registry.models) == ["b"]
+
+
+def test_evicts_the_least_recently_used():
+    registry, load = make_registry()
+    for name in ("c", "d", "c"):
+        with registry.use(name):
+            pass
+    with registry.use("b"):
+        assert list(registry.models) == ["c", "b"]
+    assert load.loaded["d"].closed and not load.loaded["c"].closed
+
+
+def test_concurrent_requests_load_once():
+    loading = threading.Event()
+    registry, load = make_registry(gate=loading)
+    models = []
+    threads = [threading.Thread(target=lambda: models.append(registry.acquire("a")))
+               for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    loading.set()
+    for thread in threads:
+        thread.join(30)
+    assert load.calls == 1 and models == [load.loaded["a"]] * 3
+    assert registry.users["a"] == 3
+
+
+def test_failed_load_frees_its_reservation():
+    registry, _ = make_registry(error=RuntimeError("no such file"))
+    with pytest.raises(RuntimeError):
+        registry.acquire("a")
+    assert registry.reserved == {} and registry.models == {}
+    with pytest.raises(ValueError):
+        registry.acquire("e")
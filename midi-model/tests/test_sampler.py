@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal
+
+from midi_inference import Sampler, generate
+
+
+def collect(model, **kwargs):
+    """every event generate() yields, (batch_size, events, max_token_seq)"""
+    return np.stack(list(generate(model, **kwargs)), axis=1)
+
+
+def test_sampling_graph_step_matches_host_sampler(load_model, tokenizer):
+    _, model_range, _ = load_model(token="token_range")
+    _, model_sample, _ = load_model(token="token_sample")
+    rng = np.random.RandomState(0)
+    batch_size = 6
+    # rows with their own ranges inside the union the graph is run with
+    row_range = np.array([[10, 40], [25, 90], [10, 90], [60, 61], [30, 70], [80, 90]])
+    start, end = 10, 90
+    mask = rng.rand(batch_size, end - start) < 0.7
+    # every row allows at least its first id
+    mask[np.arange(batch_size), row_range[:, 0] - start] = True
+    temp = rng.uniform(0.7, 1.3, batch_size).astype(np.float32)
+    top_p = np.array([1.0, 0.9, 0.5, 0.95, 0.8, 0.7], dtype=np.float32)
+    top_k = np.array([20, 5, 50, 1, 10, 3], dtype=np.int64)
+    past = {model_input.name: np.zeros((batch_size, 2, 0, 8), dtype=np.float32)
+            for model_input in model_sample.get_inputs() if model_input.name.startswith("past")}
+    hidden = rng.randn(batch_size, 1, 16).astype(np.float32)
+    x = np.zeros((batch_size, 0), dtype=np.int64)
+    sampler = Sampler()
+    for _ in range(20):
+        uniform = rng.random_sample(batch_size)
+        ids = model_sample.run(["ids"], {
+            "hidden": hidden, "x": x, **past, "id_range": np.array([start, end]),
+            "row_range": row_range, "mask": mask, "temp": temp, "top_p": top_p, "top_k": top_k,
+            "uniform": uniform})[0]
+        # the host sampler with each row alone, over its own range
+        expected = []
+        for row, (row_start, row_end) in enumerate(row_range):
+            y = model_range.run(["y"], {
+                "hidden": hidden[row:row + 1], "x": x[row:row + 1],
+                **{name: p[row:row + 1] for name, p in past.items()},
+                "id_range": np.array([row_start, row_end])})[0][:, -1]
+            expected.append(row_start + sampler(
+                y, mask[row:row + 1, row_start - start:row_end - start], temp[row], top_p[row],
+                top_k[row], uniform=uniform[row:row + 1])[0])
+        assert_array_equal(ids, expected)
+
+
+@pytest.mark.parametrize("params", [
+    {"temp": 1.0, "top_p": 0.98, "top_k": 20},
+    {"temp": 0.8, "top_p": 0.6, "top_k": 50, "disable_patch_change": True},
+    {"temp": 1.2, "top_p": 0.9, "top_k": 3, "disable_channels": list(range(2, 16))},
+])
+def test_sampling_graph_matches_host_sampler(load_model, prompt, params):
+    max_len = len(prompt) + 40
+    host = collect(load_model(token="token_range"), prompt=prompt, batch_size=3, max_len=max_len,
+                   generator=np.random.RandomState(7), **params)
+    in_graph = collect(load_model(token="token_sample"), prompt=prompt, batch_size=3,
+                       max_len=max_len, generator=np.random.RandomState(7), **params)
+    assert_array_equal(in_graph, host)
@@ -0,0 +1,121 @@
+import importlib
+import os
+import sys
+
+import numpy as np
+import pytest
+from wire_protocol import PROTOBUF, encode, encode_batch, encode_batch_item
+
+WEBSOCKET_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             "websocket")
+
+
+@pytest.fixture(scope="module")
+def pb(tmp_path_factory):
+    """the classes protoc generates from midi_stream.proto"""
+    protoc = pytest.importorskip("grpc_tools.protoc")
+    pytest.importorskip("google.protobuf")
+    out = str(tmp_path_factory.mktemp("proto"))
+    assert protoc.main(["protoc", f"-I{WEBSOCKET_DIR}", f"--python_out={out}",
+                        "midi_stream.proto"]) == 0
+    sys.path.insert(0, out)
+    try:
+        return importlib.import_module("midi_stream_pb2")
+    finally:
+        sys.path.remove(out)
+
+
+def decode(pb, msg):
+    data = encode(msg, PROTOBUF)
+    assert isinstance(data, bytes)
+    message = pb.ServerMessage()
+    message.ParseFromString(data)
+    return message
+
+
+def test_start(pb):
+    message = decode(pb, {"type": "start", "session_id": "abc", "params": {
+        "seed": 0, "gen_events": 200, "temp": 0.85, "instruments": ["Violin", "Cello"],
+        "model": "default"}})
+    start = message.start
+    assert start.session_id == "abc"
+    assert start.HasField("seed") and start.seed == 0
+    assert start.gen_events == 200
+    assert start.temp == pytest.approx(0.85)
+    assert list(start.instruments) == ["Violin", "Cello"]
+    assert not start.HasField("continued_from")
+    assert start.model == "default"
+
+
+def test_event(pb, tokenizer):
+    event = ["note", 1, 3, 2, 0, 60, 100, 8]
+    tokens = tokenizer.event2tokens(event)
+    message = decode(pb, {"type": "event", "index": 7, "event": event, "tokens": tokens,
+                          "stream_id": "s1"})
+    assert message.WhichOneof("body") == "event"
+    assert message.stream_id == "s1"
+    assert message.event.index == 7
+    assert pb.EventType.Name(message.event.type) == "NOTE"
+    assert list(message.event.params) == event[1:]
+    assert np.frombuffer(message.event.tokens, dtype="<i2").tolist() == tokens
+
+
+def test_event_batch(pb, tokenizer):
+    events = [["patch_change", 0, 0, 1, 0, 5], ["set_tempo", 2, 0, 0, 90]]
+    items = [encode_batch_item({"type": "event", "index": i, "event": event,
+                                "tokens": tokenizer.event2tokens(event)}, PROTOBUF)
+             for i, event in enumerate(events)]
+    message = pb.ServerMessage()
+    message.ParseFromString(encode_batch(items, PROTOBUF, "s2"))
+    assert message.stream_id == "s2"
+    assert [pb.EventType.Name(e.type) for e in message.events.events] == [
+        "PATCH_CHANGE", "SET_TEMPO"]
+    assert [list(e.params) for e in message.events.events] == [e[1:] for e in events]
+    assert [e.index for e in message.events.events] == [0, 1]
+
+
+def test_snapshots(pb):
+    message = decode(pb, {"type": "snapshot", "index": 20, "total_events": 24,
+                          "midi_b64": b"MThd\x00", "size_bytes": 5})
+    assert (message.snapshot.index, message.snapshot.total_events) == (20, 24)
+    assert message.snapshot.midi == b"MThd\x00"
+
+    tracks = [{"track": 0, "data_b64": b"\x00\x90", "tail_b64": b"\x00\xff/\x00"},
+              {"track": 3, "data_b64": b"", "tail_b64": b"\x00\xff/\x00"}]
+    message = decode(pb, {"type": "snapshot_delta", "seq": 2, "index": 40, "total_events": 44,
+                          "ticks": 480, "tracks": tracks})
+    delta = message.snapshot_delta
+    assert (delta.seq, delta.index, delta.total_events, delta.ticks) == (2, 40, 44, 480)
+    assert [(t.track, t.data, t.tail) for t in delta.tracks] == [
+        (t["track"], t["data_b64"], t["tail_b64"]) for t in tracks]
+
+    message = decode(pb, {"type": "snapshot_resync", "total_events": 44, "midi_b64": b"MThd",
+                          "seq": 2, "ticks": 480, "tracks": [{"track": 1, "data_b64": b"\x01"}]})
+    resync = message.snapshot_resync
+    assert (resync.total_events, resync.midi, resync.seq, resync.ticks) == (44, b"MThd", 2, 480)
+    assert [(t.track, t.data, t.tail) for t in resync.tracks] == [(1, b"\x01", b"")]
+
+
+def test_complete_and_queued(pb):
+    message = decode(pb, {"type": "complete", "total_events": 80, "session_id": "abc",
+                          "can_continue": True, "reason": "duration", "prefix_cached_events": 3})
+    complete = message.complete
+    assert (complete.total_events, complete.session_id, complete.can_continue, complete.reason,
+            complete.prefix_cached_events) == (80, "abc", True, "duration", 3)
+
+    queued = decode(pb, {"type": "queued", "position": 2, "expected_wait": None}).queued
+    assert queued.position == 2 and not queued.HasField("expected_wait")
+    queued = decode(pb, {"type": "queued", "position": 1, "expected_wait": 0.0}).queued
+    assert queued.HasField("expected_wait") and queued.expected_wait == 0.0
+
+
+def test_status_and_protocol(pb):
+    status = decode(pb, {"status": "error", "error": "busy", "retry_after": 2.5}).status
+    assert (status.status, status.error, status.retry_after) == ("error", "busy", 2.5)
+    status = decode(pb, {"status": "ok", "events": 80, "midi_b64": b"MThd",
+                         "size_bytes": 4}).status
+    assert (status.status, status.events, status.midi) == ("ok", 80, b"MThd")
+    assert not status.HasField("retry_after")
+
+    message = decode(pb, {"type": "protocol", "format": "protobuf"})
+    assert message.protocol.format == "protobuf"
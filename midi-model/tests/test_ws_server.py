@@ -0,0 +1,179 @@
+import asyncio
+import json
+import threading
+
+import pytest
+import ws_server_true_streaming as server
+from batch_scheduler import GeneratePool, SessionStore
+
+import midi_inference
+from model_registry import ModelRegistry
+
+# importing the server sets the device of its --device default
+midi_inference.device = "cpu"
+
+
+class Connection:
+    """the server side of a client connection, collects the JSON messages sent to it"""
+
+    def __init__(self):
+        self.messages = asyncio.Queue()
+
+    async def send(self, frame):
+        await self.messages.put(json.loads(frame))
+
+
+@pytest.fixture
+def loading(load_model, monkeypatch):
+    """set while models may load, clear it to hold requests in acquire_model"""
+    loading = threading.Event()
+    loading.set()
+
+    def load(name):
+        assert loading.wait(30)
+        model_base, model_token, tokenizer = load_model()
+        return server.ServedModel(name, model_base, model_token, tokenizer, 0)
+
+    registry = ModelRegistry([server.default_model], load, 2 ** 40)
+    monkeypatch.setattr(server, "model_registry", registry)
+    monkeypatch.setattr(server, "session_store", SessionStore(2 ** 30, 60))
+    monkeypatch.setattr(server, "generate_pool", GeneratePool(1, 4))
+    yield loading
+    loading.set()
+    for model in registry.models.values():
+        model.close()
+
+
+def run(scenario):
+    asyncio.run(asyncio.wait_for(scenario(), 60))
+
+
+async def route(connection, streams, **request):
+    await server.route_message(connection, json.dumps(request), streams)
+
+
+async def finish(streams):
+    """wait until every stream ran its requests"""
+    while streams:
+        await asyncio.gather(*[stream.task for stream in list(streams.values())])
+
+
+def received(connection):
+    messages = []
+    while not connection.messages.empty():
+        messages.append(connection.messages.get_nowait())
+    return messages
+
+
+def stream_events(seed, gen_events=8, params=None, **request):
+    return dict(request, action="stream-events",
+                params={"seed": seed, "gen_events": gen_events, **(params or {})})
+
+
+def test_cancel_while_the_model_loads(loading):
+    async def scenario():
+        connection, streams = Connection(), {}
+        loading.clear()
+        await route(connection, streams, **stream_events(1))
+        await asyncio.sleep(0.05)
+        await route(connection, streams, action="cancel")
+        loading.set()
+        await finish(streams)
+        messages = received(connection)
+        assert [m.get("type") for m in messages] == ["start", "complete"]
+        assert messages[1]["reason"] == "cancelled" and messages[1]["total_events"] == 0
+
+        loading.clear()
+        await route(connection, streams, action="generate-midi", params={"seed": 2})
+        await asyncio.sleep(0.05)
+        await route(connection, streams, action="cancel")
+        loading.set()
+        await finish(streams)
+        assert received(connection) == [{"status": "cancelled"}]
+    run(scenario)
+
+
+def test_superseding_request_drops_waiting_requests(loading):
+    async def scenario():
+        connection, streams = Connection(), {}
+        loading.clear()
+        await route(connection, streams, **stream_events(1))
+        await asyncio.sleep(0.05)
+        await route(connection, streams, **stream_events(2, supersede=False))
+        await route(connection, streams, **stream_events(3))
+        loading.set()
+        await finish(streams)
+        messages = received(connection)
+        starts = [m["params"]["seed"] for m in messages if m.get("type") == "start"]
+        completes = [m for m in messages if m.get("type") == "complete"]
+        assert starts == [1, 3]
+        assert [m["reason"] for m in completes] == ["cancelled", "gen_events"]
+        assert completes[1]["total_events"] == 8
+    run(scenario)
+
+
+def test_cancel_stops_a_running_stream(loading):
+    async def scenario():
+        connection, streams = Connection(), {}
+        # paced with a stopped playhead, it waits after the first event that takes time
+        await route(connection, streams, **stream_events(1, 200, {"lookahead": 0.0}))
+        await asyncio.sleep(0.3)
+        await route(connection, streams, action="cancel")
+        await finish(streams)
+        complete = received(connection)[-1]
+        assert complete["type"] == "complete" and complete["reason"] == "cancelled"
+        assert 0 < complete["total_events"] < 200
+    run(scenario)
+
+
+def test_playhead_reaches_the_running_stream(loading):
+    async def scenario():
+        connection, streams = Connection(), {}
+        await route(connection, streams, stream_id="a",
+                    **stream_events(1, 40, {"lookahead": 0.0}))
+        await asyncio.sleep(0.3)
+        assert not any(m.get("type") == "complete" for m in received(connection))
+        await route(connection, streams, stream_id="a", action="playhead", seconds=1e6,
+                    playing=True)
+        await finish(streams)
+        complete = received(connection)[-1]
+        assert complete["stream_id"] == "a" and complete["type"] == "complete"
+        assert complete["reason"] == "gen_events" and complete["total_events"] == 40
+    run(scenario)
+
+
+def test_waiting_requests_are_capped(loading, monkeypatch):
+    monkeypatch.setattr(server, "max_stream_requests", 2)
+
+    async def scenario():
+        connection, streams = Connection(), {}
+        loading.clear()
+        await route(connection, streams, **stream_events(1))
+        await asyncio.sleep(0.05)
+        for seed in (2, 3, 4):
+            await route(connection, streams, **stream_events(seed, supersede=False))
+        assert [len(stream.requests) for stream in streams.values()] == [2]
+        assert received(connection) == [{
+            "status": "error", "error": "Too many requests waiting on this stream (max 2)"}]
+        loading.set()
+        await finish(streams)
+        starts = [m["params"]["seed"] for m in received(connection) if m.get("type") == "start"]
+        assert starts == [1, 2, 3]
+    run(scenario)
+
+
+def test_generate_midi_reports_the_events_generated(loading):
+    async def scenario():
+        connection, streams = Connection(), {}
+        await route(connection, streams, action="generate-midi",
+                    params={"seed": 1, "gen_events": 5})
+        # the test model jumps far ahead in time, 1000 beats stop before gen_events
+        await route(connection, streams, action="generate-midi", supersede=False,
+                    params={"seed": 1, "gen_events": 200, "duration": 1000})
+        await finish(streams)
+        # the second request does not find the first one's job still running
+        responses = received(connection)
+        assert [m.get("status") for m in responses] == ["ok", "ok"]
+        assert responses[0]["events"] == 5
+        assert 0 < responses[1]["events"] < 200
+    run(scenario)
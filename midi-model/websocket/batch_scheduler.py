@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+"""
+Continuous batching for the streaming server.
+Active stream sessions are merged into one batched token-model step per event; sessions join and
+leave the batch between events. Finished sessions keep their kv cache in a SessionStore, so a
+`continue` request resumes decoding without prefilling the music generated so far.
+Whole-piece requests run on a GeneratePool, a bounded set of worker threads with admission control.
+"""
+import math
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from midi_clock import MIDIClock, StopCondition
+from midi_grammar import BatchGrammar, get_grammar
+from midi_inference import (
+    KV_CACHE_SLIDE,
+    MAX_MID_SEQ,
+    KVCache,
+    PrefixCache,
+    Sampler,
+    decode_tokens,
+    get_emb_size,
+    has_range_head,
+    has_sampling_graph,
+    last_hidden_only,
+    run_with_cache,
+)
+
+
+class StreamSession:
+    """One stream of events, decoded as a row of the scheduler's batch.
+
+    `on_event(msg_type, data)` is called from the scheduler thread with ('event', token_seq),
+    ('complete', None) or ('error', message).
+
+    ``cancel()`` ends the request at the next step with stop_reason "cancelled" and drops the kv
+    cache.
+
+    The session outlives its request: it owns the token history, the base model kv cache and the
+    last sampled event (not fed yet), so `resume` picks up exactly where decoding stopped.
+
+    A request ends after `gen_events` events, at eos or, with a `duration` in `duration_unit`, at
+    that much music; the event that crossed the end is held back and opens the next continuation.
+
+    With a `lookahead` (seconds) the session is paced: it only decodes while its music is less than
+    `lookahead` seconds ahead of the client's playhead, which advances in real time between reports.
+
+    With a `max_backlog` (events) it also waits while that many of its events are not sent to the
+    client yet; the server advances `delivered` as it sends them and wakes the scheduler.
+    """
+
+    def __init__(self, tokenizer, prompt, params, on_event):
+        self.session_id = uuid.uuid4().hex
+        self.tokenizer = tokenizer
+        self.model_name = None  # the server's name of the model that decodes the session
+        self.scheduler = None  # the BatchScheduler it was last submitted to
+        prompt = np.asarray(prompt, dtype=np.int64)
+        self.tokens = prompt.tolist()  # every event of the piece so far
+        self.request_start = len(self.tokens)  # events before the current request
+        # the server's StreamingDetokenizer of the piece, kept between requests
+        self.detokenizer = None
+        # the server's DeltaMIDIEncoder while the client takes delta snapshots
+        self.snapshots = None
+        prompt = prompt[-MAX_MID_SEQ:]
+        self.gen_events = int(params['gen_events'])
+        self.temp = float(params['temp'])
+        self.top_p = float(params['top_p'])
+        self.top_k = int(params['top_k'])
+        self.grammar = get_grammar(
+            tokenizer,
+            disable_patch_change=bool(params.get('disable_patch_change', False)),
+            disable_control_change=bool(params.get('disable_control_change', False)),
+            disable_channels=params.get('disable_channels', None),
+            disable_tracks=params.get('disable_tracks', None))
+        self.generator = np.random.RandomState(params['seed'])
+        self.on_event = on_event
+        self.max_len = min(len(prompt) + self.gen_events, MAX_MID_SEQ)
+        self.x = prompt[None]  # rows that have not been fed to the base model yet
+        self.cache = None  # base model kv cache, allocated when the session joins the batch
+        self.emitted = 0
+        self.prefix_len = 0  # prompt rows whose prefill came from the prefix cache
+        # the model emitted eos, the session was cancelled or failed, there is nothing to continue
+        self.finished = False
+        self.cancelled = threading.Event()
+        self.last_used = time.monotonic()
+        self.last_step = 0.0
+        self.clock = MIDIClock(tokenizer)
+        for tokens in self.tokens:
+            self.clock.feed(tokens)
+        self.stop = None
+        # why the last request ended: eos, gen_events, duration, cancelled or error
+        self.stop_reason = None
+        self.held = None  # event decoded past the end of the last request, not emitted yet
+        self.set_stop(params)
+        self.lookahead = None
+        self.set_pacing(params.get('lookahead'))
+        self.delivered = self.request_start  # events the client has been sent
+        self.max_backlog = None
+        self.set_backlog(params.get('max_backlog'))
+
+    def set_stop(self, params):
+        """end the request after params['duration'] of music, a continuation in the same unit picks
+        up at the previous end"""
+        duration = params.get('duration')
+        if duration is None:
+            self.stop = None
+            return
+        unit = params.get('duration_unit', 'beats')
+        start = self.stop.end if self.stop is not None and self.stop.unit == unit else None
+        let_notes_finish = bool(params.get('let_notes_finish', True))
+        self.stop = StopCondition(self.clock, duration, unit, let_notes_finish, start)
+
+    def set_pacing(self, lookahead):
+        """pace decoding `lookahead` seconds ahead of the playhead, None decodes as fast as
+        possible"""
+        self.lookahead = None if lookahead is None else float(lookahead)
+        self.playhead = 0.0
+        self.playhead_at = time.monotonic()
+        self.playing = False
+
+    def set_backlog(self, max_backlog):
+        """pause decoding while `max_backlog` events wait to be sent, None never waits"""
+        self.max_backlog = None if max_backlog is None else max(int(max_backlog), 1)
+
+    def backlogged(self):
+        return (self.max_backlog is not None
+                and len(self.tokens) - self.delivered >= self.max_backlog)
+
+    def set_playhead(self, seconds, playing=True):
+        """client playback position in seconds since the start of the piece"""
+        self.playhead = float(seconds)
+        self.playhead_at = time.monotonic()
+        self.playing = bool(playing)
+
+    def lead(self, now):
+        """seconds of music decoded ahead of the playhead, 0 when the session is not paced"""
+        if self.lookahead is None:
+            return 0.0
+        playhead = self.playhead
+        if self.playing:
+            playhead += now - self.playhead_at
+        return self.clock.seconds - playhead
+
+    def pacing_delay(self, now):
+        """seconds until the session may decode again, inf while it waits for a playhead report or
+        for its backlog to be sent"""
+        if self.backlogged():
+            return math.inf
+        if self.lookahead is None:
+            return 0.0
+        ahead = self.lead(now) - self.lookahead
+        if ahead <= 0:
+            return 0.0
+        return ahead if self.playing else math.inf
+
+    def resume(self, params, on_event):
+        """prepare another request on this session, sampling params not given are kept.
+
+        Returns False if the request is already complete (the held event reached the new end)."""
+        self.gen_events = int(params['gen_events'])
+        self.temp = float(params.get('temp', self.temp))
+        self.top_p = float(params.get('top_p', self.top_p))
+        self.top_k = int(params.get('top_k', self.top_k))
+        if params.get('seed') is not None:
+            self.generator = np.random.RandomState(params['seed'])
+        self.on_event = on_event
+        self.emitted = 0
+        self.prefix_len = 0
+        self.request_start = len(self.tokens)
+        self.delivered = self.request_start
+        if 'lookahead' in params:
+            self.set_pacing(params['lookahead'])
+        if 'max_backlog' in params:
+            self.set_backlog(params['max_backlog'])
+        self.set_stop(params)
+        self.stop_reason = None
+        if self.held is not None:
+            token_seq, self.held = self.held, None
+            if self.accept(token_seq, False):
+                self.on_event('complete', None)
+                return False
+        return True
+
+    def cancel(self):
+        """stop decoding, the scheduler drops the session before its next step (call wake())"""
+        self.cancelled.set()
+
+    def wake(self):
+        """have the scheduler re-check the session, e.g. after a playhead report"""
+        if self.scheduler is not None:
+            self.scheduler.wake()
+
+    def accept(self, token_seq, eos):
+        """record a decoded event and pass it on, return whether the request is complete"""
+        if not eos and self.stop is not None:
+            tokens = token_seq[0].tolist()
+            if self.stop.past_end(tokens):
+                self.held = token_seq
+                self.stop_reason = "duration"
+                return True
+            token_seq[0] = self.stop.clamp(tokens)
+        self.tokens.append(token_seq[0].tolist())
+        self.clock.feed(self.tokens[-1])
+        self.emitted += 1
+        self.on_event('event', token_seq)
+        if eos:
+            self.finished = True
+            self.cache = None
+            self.stop_reason = "eos"
+            return True
+        if self.emitted >= self.gen_events:
+            self.stop_reason = "gen_events"
+            return True
+        return False
+
+    @property
+    def nbytes(self):
+        return 0 if self.cache is None else self.cache.nbytes
+
+
+class SessionStore:
+    """Idle sessions kept for continuation, evicted after `ttl` seconds or least recently used first
+    when their kv caches exceed `max_bytes`.
+
+    A session is taken out of the store while it decodes, so it cannot be continued twice at once.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return sum(session.nbytes for session in self.sessions.values())
+
+    def _evict(self):
+        now = time.monotonic()
+        for session_id, session in list(self.sessions.items()):
+            if now - session.last_used > self.ttl:
+                del self.sessions[session_id]
+        nbytes = self.nbytes
+        while self.sessions and nbytes > self.max_bytes:
+            _, session = self.sessions.popitem(last=False)
+            nbytes -= session.nbytes
+
+    def put(self, session: StreamSession):
+        if session.finished or session.cancelled.is_set():
+            return
+        session.last_used = time.monotonic()
+        with self.lock:
+            self.sessions[session.session_id] = session
+            self._evict()
+
+    def take(self, session_id):
+        """remove and return an idle session, None if it is unknown, expired or evicted"""
+        with self.lock:
+            self._evict()
+            return self.sessions.pop(session_id, None)
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+class BatchScheduler:
+    """Runs every active StreamSession of one model pair in a single decoding thread.
+
+    Each iteration feeds every session's new rows through the base model with the session's own kv
+    cache (rows with different past lengths cannot share a base step, the graph has no attention
+    mask), then samples the next event of all sessions with one batched token-model call per token
+    position, each row with its own sampling params, grammar, RNG and stop condition. With a
+    `prefix_cache`, a session's first base step loads the prefill of a known prompt instead of
+    running it.
+
+    Each step takes up to `max_batch` sessions that may decode now, the ones furthest behind their
+    client's playhead first, then the ones that waited longest. Paced sessions that are far enough
+    ahead sit out until their playhead catches up. Cancelled sessions are dropped before the next
+    step.
+    """
+
+    def __init__(self, model, max_batch=8, prefix_cache: PrefixCache = None):
+        self.model_base, self.model_token, self.tokenizer = model
+        self.max_batch = max_batch
+        self.prefix_cache = prefix_cache
+        self.active = []
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+
+        self.emb_size = get_emb_size(self.model_base)
+        self.last_hidden_only = last_hidden_only(self.model_base)
+        self.range_head = has_range_head(self.model_token)
+        self.sampling_graph = has_sampling_graph(self.model_token)
+        self.io_binding_base = self.model_base.io_binding()
+        self.io_binding_token = self.model_token.io_binding()
+        self.token_cache = KVCache(self.model_token, max_batch, self.tokenizer.max_token_seq)
+        self.logits = np.empty((max_batch, self.tokenizer.max_token_seq, self.tokenizer.vocab_size),
+                               dtype=np.float32)
+        self.hidden = np.empty((max_batch, 1, self.emb_size), dtype=np.float32)
+        self.hidden_buffer = np.empty(0, dtype=np.float32)
+        self.sampler = Sampler()
+        self._grammar_key = None
+        self._grammar = None
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """end the decoding thread once the sessions of its current step are done, sessions still
+        active then get an error"""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def submit(self, session: StreamSession):
+        with self.cond:
+            if self.stopped:
+                self._fail(session, "the scheduler is stopped")
+                return
+            session.scheduler = self
+            self.active.append(session)
+            self.cond.notify()
+
+    def wake(self):
+        """re-check paced sessions, e.g. after a playhead report or when a backlog was sent"""
+        with self.cond:
+            self.cond.notify()
+
+    def _next_batch(self):
+        """wait until some sessions may decode, return up to max_batch of them (None once
+        stopped)"""
+        while not self.stopped:
+            now = time.monotonic()
+            ready = []
+            timeout = None
+            for session in list(self.active):
+                if session.cancelled.is_set():
+                    self._drop(session)
+                    continue
+                delay = session.pacing_delay(now)
+                if delay <= 0:
+                    ready.append(session)
+                elif delay != math.inf:
+                    timeout = delay if timeout is None else min(timeout, delay)
+            if ready:
+                ready.sort(key=lambda session: (session.lead(now), session.last_step))
+                return ready[:self.max_batch]
+            self.cond.wait(timeout)
+        return None
+
+    def _drop(self, session):
+        """end a cancelled session and free its kv cache"""
+        self.active.remove(session)
+        session.finished = True
+        session.cache = None
+        session.stop_reason = "cancelled"
+        session.on_event('complete', None)
+
+    def _finish(self, session):
+        """remove the session from the active ones, return False if it was not active anymore"""
+        with self.cond:
+            if session not in self.active:
+                return False
+            self.active.remove(session)
+            return True
+
+    @staticmethod
+    def _fail(session, message):
+        """end a session whose kv cache can no longer be trusted and report the error"""
+        session.finished = True
+        session.cache = None
+        session.stop_reason = "error"
+        session.on_event('error', message)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                batch = self._next_batch()
+            if batch is None:
+                break
+            try:
+                self._step(batch)
+            except Exception as e:
+                # sessions the step already completed got their event, the others end here
+                for session in batch:
+                    if not session.finished and self._finish(session):
+                        try:
+                            self._fail(session, str(e))
+                        except Exception:
+                            traceback.print_exc()
+        with self.cond:
+            remaining, self.active = self.active, []
+        for session in remaining:
+            try:
+                self._fail(session, "the scheduler was stopped")
+            except Exception:
+                traceback.print_exc()
+
+    def _base_step(self, session: StreamSession, b):
+        prompt_rows = None
+        if session.cache is None:
+            # sized for this request, the buffers grow if the session is continued later
+            session.cache = KVCache(self.model_base, 1, MAX_MID_SEQ, slide=KV_CACHE_SLIDE,
+                                    capacity=session.max_len)
+            if self.prefix_cache is not None:
+                prompt_rows = session.x[0]
+                prefix_len, presents, hidden = self.prefix_cache.lookup(prompt_rows)
+                session.prefix_len = prefix_len
+                if prefix_len > 0:
+                    session.cache.load(presents)
+                    session.x = session.x[:, prefix_len:]
+                    if session.x.shape[1] == 0:
+                        self.hidden[b, 0] = hidden
+                        return
+        new_len = session.x.shape[1]
+        if self.last_hidden_only:
+            hidden = self.hidden[b:b + 1]  # the model writes the row decode_tokens reads
+        else:
+            size = new_len * self.emb_size
+            if self.hidden_buffer.size < size:
+                self.hidden_buffer = np.empty(size, dtype=np.float32)
+            hidden = self.hidden_buffer[:size].reshape(1, new_len, self.emb_size)
+        run_with_cache(self.model_base, self.io_binding_base, {"x": session.x}, {"hidden": hidden},
+                       session.cache, new_len)
+        if not self.last_hidden_only:
+            self.hidden[b] = hidden[0, -1:]
+        if prompt_rows is not None:
+            self.prefix_cache.put(prompt_rows, session.cache.export(), hidden[0, -1])
+
+    def _batch_grammar(self, batch):
+        # the grammars themselves, not their ids: a grammar the lru cache dropped could leave its id
+        # to a new one while the key still names it
+        key = tuple(session.grammar for session in batch)
+        if key != self._grammar_key:
+            self._grammar = BatchGrammar([session.grammar for session in batch])
+            self._grammar_key = key
+        return self._grammar
+
+    def _step(self, batch):
+        batch_size = len(batch)
+        for b, session in enumerate(batch):
+            self._base_step(session, b)
+        next_token_seq, state = decode_tokens(
+            self.model_token, self.io_binding_token, self.token_cache, self.hidden[:batch_size],
+            self._batch_grammar(batch), self.sampler, self.logits,
+            np.array([session.temp for session in batch]),
+            np.array([session.top_p for session in batch]),
+            np.array([session.top_k for session in batch]),
+            [session.generator for session in batch], self.range_head, self.sampling_graph)
+
+        now = time.monotonic()
+        for b, session in enumerate(batch):
+            token_seq = next_token_seq[b:b + 1]
+            session.x = token_seq[:, None, :]
+            session.last_step = now
+            if session.accept(token_seq, state[b] == self.tokenizer.eos_id):
+                session.last_used = now
+                self._finish(session)
+                session.on_event('complete', None)
+
+
+class ServerBusy(Exception):
+    """The GeneratePool queue is full, `retry_after` is the expected wait in seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__("Server busy, try again later")
+        self.retry_after = retry_after
+
+
+class GeneratePool:
+    """`workers` threads for blocking generate() calls, with at most `max_queue` jobs waiting for
+    one.
+
+    ``submit`` returns the job's queue position (0 when a worker is free) and its future, or raises
+    ServerBusy; ``cancel(future)`` drops a job that is still waiting. Expected waits are estimated
+    from a running average of recent job durations.
+    """
+
+    def __init__(self, workers=2, max_queue=8):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="generate")
+        self.waiting = 0
+        self.running = 0
+        self.avg_seconds = None
+        self.lock = threading.Lock()
+
+    def expected_wait(self, position):
+        """seconds until the job at `position` starts, None before any job has finished"""
+        if position <= 0:
+            return 0.0
+        if self.avg_seconds is None:
+            return None
+        return round(self.avg_seconds * math.ceil(position / self.workers), 1)
+
+    def submit(self, fn):
+        with self.lock:
+            position = max(self.waiting + self.running + 1 - self.workers, 0)
+            if position > self.max_queue:
+                raise ServerBusy(self.expected_wait(position))
+            self.waiting += 1
+        return position, self.executor.submit(self._job, fn)
+
+    def cancel(self, future):
+        """drop a job no worker has started yet, return whether it was dropped"""
+        if not future.cancel():
+            return False
+        with self.lock:
+            self.waiting -= 1
+        return True
+
+    def _job(self, fn):
+        with self.lock:
+            self.waiting -= 1
+            self.running += 1
+        start = time.monotonic()
+        try:
+            fn()
+        finally:
+            seconds = time.monotonic() - start
+            with self.lock:
+                self.running -= 1
+                if self.avg_seconds is None:
+                    self.avg_seconds = seconds
+                else:
+                    self.avg_seconds = 0.8 * self.avg_seconds + 0.2 * seconds
+
+    def stats(self):
+        return {"workers": self.workers, "running": self.running, "waiting": self.waiting,
+                "avg_seconds": round(self.avg_seconds or 0.0, 3)}
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Wire formats of the streaming server: JSON text frames (default) or binary protobuf frames.
+The protobuf schema is midi_stream.proto; messages are encoded here by hand from the same dicts the
+JSON path sends, so the server needs no generated code or protobuf runtime.
+"""
+import base64
+import json
+import struct
+
+import numpy as np
+
+JSON = "json"
+PROTOBUF = "protobuf"
+FORMATS = (JSON, PROTOBUF)
+PROTOBUF_SUBPROTOCOL = "midi-stream.protobuf"
+
+EVENT_TYPES = {name: i for i, name in enumerate(
+    ["note", "patch_change", "control_change", "set_tempo", "time_signature", "key_signature"])}
+
+
+def json_default(value):
+    """bytes (MIDI data) go out as base64 in JSON"""
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode('utf-8')
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def select_subprotocol(*args):
+    """Accept the protobuf subprotocol when the client offers it, continue without one otherwise.
+
+    websockets calls this with (connection, offered) or, in its legacy server, (offered,
+    supported)."""
+    offered = args[0] if isinstance(args[0], (list, tuple)) else args[1]
+    return PROTOBUF_SUBPROTOCOL if PROTOBUF_SUBPROTOCOL in (offered or ()) else None
+
+
+def _varint(n):
+    out = bytearray()
+    n = int(n)
+    if n < 0:
+        n += 1 << 64
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _uint(field, value, optional=False):
+    if value is None or (not value and not optional):
+        return b""
+    return _varint(field << 3) + _varint(value)
+
+
+def _float(field, value, optional=False):
+    if value is None or (not value and not optional):
+        return b""
+    return _varint(field << 3 | 5) + struct.pack('<f', value)
+
+
+def _bytes(field, value):
+    if not value:
+        return b""
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return _varint(field << 3 | 2) + _varint(len(value)) + bytes(value)
+
+
+def _packed(field, values):
+    if not values:
+        return b""
+    return _bytes(field, b"".join(_varint(v) for v in values))
+
+
+def _tracks(field, tracks):
+    return b"".join(_bytes(field, _uint(1, t["track"]) + _bytes(2, t.get("data_b64"))
+                           + _bytes(3, t.get("tail_b64")))
+                    for t in tracks)
+
+
+def _start(msg):
+    params = msg.get("params", {})
+    return (_bytes(1, msg.get("session_id")) + _uint(2, params.get("seed"), optional=True)
+            + _uint(3, params.get("gen_events")) + _float(4, params.get("temp"))
+            + b"".join(_bytes(5, name) for name in params.get("instruments") or [])
+            + _uint(6, params.get("continued_from"), optional=True)
+            + _bytes(7, params.get("model")))
+
+
+def _event(msg):
+    event = msg.get("event") or []
+    tokens = np.asarray(msg.get("tokens", []), dtype='<i2').tobytes()
+    return (_uint(1, msg.get("index")) + (_uint(2, EVENT_TYPES[event[0]]) if event else b"")
+            + _packed(3, event[1:]) + _bytes(4, tokens))
+
+
+def _snapshot(msg):
+    return (_uint(1, msg.get("index")) + _uint(2, msg.get("total_events"))
+            + _bytes(3, msg.get("midi_b64")))
+
+
+def _snapshot_delta(msg):
+    return (_uint(1, msg.get("seq")) + _uint(2, msg.get("index"))
+            + _uint(3, msg.get("total_events")) + _uint(4, msg.get("ticks"))
+            + _tracks(5, msg.get("tracks", [])))
+
+
+def _snapshot_resync(msg):
+    return (_uint(1, msg.get("total_events")) + _bytes(2, msg.get("midi_b64"))
+            + _uint(3, msg.get("seq")) + _uint(4, msg.get("ticks"))
+            + _tracks(5, msg.get("tracks", [])))
+
+
+def _complete(msg):
+    return (_uint(1, msg.get("total_events")) + _bytes(2, msg.get("session_id"))
+            + _uint(3, msg.get("can_continue")) + _bytes(4, msg.get("reason"))
+            + _uint(5, msg.get("prefix_cached_events")))
+
+
+def _queued(msg):
+    return _uint(1, msg.get("position")) + _float(2, msg.get("expected_wait"), optional=True)
+
+
+def _status(msg):
+    return (_bytes(1, msg.get("status")) + _bytes(2, msg.get("error"))
+            + _float(3, msg.get("retry_after"), optional=True) + _uint(4, msg.get("events"))
+            + _bytes(5, msg.get("midi_b64")))
+
+
+def _protocol(msg):
+    return _bytes(1, msg.get("format"))
+
+
+# ServerMessage oneof field of each "type"
+_BODIES = {
+    "start": (1, _start),
+    "event": (2, _event),
+    "snapshot": (3, _snapshot),
+    "snapshot_delta": (4, _snapshot_delta),
+    "snapshot_resync": (5, _snapshot_resync),
+    "complete": (6, _complete),
+    "queued": (7, _queued),
+    "protocol": (9, _protocol),
+}
+
+
+def encode_batch_item(msg, wire_format=JSON):
+    """one event message of an "events" frame, encoded ahead so the frame size is known"""
+    if wire_format == PROTOBUF:
+        data = _event(msg)
+        return _varint(1 << 3 | 2) + _varint(len(data)) + data
+    return json.dumps(msg, default=json_default)
+
+
+def encode_batch(items, wire_format=JSON, stream_id=None):
+    """an "events" frame (EventBatch) of items from encode_batch_item"""
+    if wire_format == PROTOBUF:
+        data = b"".join(items)
+        return _varint(10 << 3 | 2) + _varint(len(data)) + data + _stream_id(stream_id)
+    tag = "" if stream_id is None else f'"stream_id": {json.dumps(stream_id)}, '
+    return '{"type": "events", ' + tag + '"events": [' + ", ".join(items) + ']}'
+
+
+def _stream_id(stream_id):
+    """ServerMessage.stream_id, set on the messages of a multiplexed stream"""
+    return b"" if stream_id is None else _bytes(15, str(stream_id))
+
+
+def encode_protobuf(msg):
+    """ServerMessage bytes of a server message dict"""
+    if "type" in msg:
+        field, body = _BODIES[msg["type"]]
+    else:
+        field, body = 8, _status
+    data = body(msg)
+    return _varint(field << 3 | 2) + _varint(len(data)) + data + _stream_id(msg.get("stream_id"))
+
+
+def encode(msg, wire_format=JSON):
+    """a server message dict as a websocket frame: str for JSON, bytes for protobuf"""
+    if wire_format == PROTOBUF:
+        return encode_protobuf(msg)
+    return json.dumps(msg, default=json_default)
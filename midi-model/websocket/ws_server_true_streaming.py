@@ -6,7 +6,6 @@ Streams MIDI tokens as they're generated - no waiting for complete chunks!
 import asyncio
 import websockets
 import json
-import base64
 import argparse
 import sys
 import os
@@ -14,26 +13,50 @@ import numpy as np
 import onnxruntime as rt
 from pathlib import Path
 from pathlib import PurePosixPath
-from concurrent.futures import ThreadPoolExecutor
-import queue
 import threading
+import time
+import weakref
+from http import HTTPStatus
+from collections import deque
 
 # Add src directory to path for imports
 sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
 
-# Import from app_onnx.py
-import app_onnx
-from app_onnx import generate, get_tokenizer, apply_io_binding, sample_top_p_k, softmax
+# The inference core only, the Gradio app (app_onnx) and its UI dependencies are not needed here
+import midi_inference
+from midi_inference import (create_session, generate, get_tokenizer, PrefixCache, quantized_path,
+                            SESSION_PROFILES)
 import MIDI
+from midi_clock import TIME_UNITS
+from midi_delta import DeltaMIDIEncoder
+from midi_tokenizer import StreamingDetokenizer
+import wire_protocol
+from batch_scheduler import BatchScheduler, GeneratePool, ServerBusy, SessionStore, StreamSession
+from model_registry import ModelPair, ModelRegistry, model_nbytes
 
 # Global model state
-model_base = None
-model_token = None
-tokenizer = None
+model_registry = None  # name -> ServedModel, loaded on first request
+model_specs = {}  # name -> files and download urls of the model (same fields as the --model-* args)
+default_model = "default"
+providers = None
+# create_session arguments: ORT session profile, thread counts, optimized model cache
+session_settings = {}
+max_batch = 8
+prefix_cache_bytes = 0
+session_store = None
+generate_pool = None
+max_streams = 4  # concurrent streams per connection
+max_stream_requests = 4  # requests waiting on one stream (supersede: false)
+warmup_batch_sizes = []  # batch sizes x past lengths (events) each model decodes before it serves
+warmup_past_lengths = []
+warmup_events = 4
+ready = False  # the default model is loaded and warm, see health_check
+# connection -> wire_protocol format, JSON unless negotiated
+wire_formats = weakref.WeakKeyDictionary()
 device = "cuda"
 
-# Inject device into app_onnx module so generate() can access it
-app_onnx.device = device
+# Inject device into midi_inference so its kv caches are allocated there
+midi_inference.device = device
 
 
 number2drum_kits = {
@@ -187,51 +210,195 @@ def _ensure_model_files(args, *, force: bool = False):
             _maybe_remove(args.model_config, min_bytes=32)
             if not os.path.exists(args.model_config):
                 log(f"⬇️  Downloading model config → {args.model_config}")
-            app_onnx.download_if_not_exit(args.model_config_url, args.model_config)
+            midi_inference.download_if_not_exit(args.model_config_url, args.model_config)
 
         if args.model_base_url:
             # Heuristic: a valid ONNX model will be far larger than 1MB.
             _maybe_remove(args.model_base, min_bytes=1_000_000)
             if not os.path.exists(args.model_base):
                 log(f"⬇️  Downloading model base → {args.model_base}")
-            app_onnx.download_if_not_exit(args.model_base_url, args.model_base)
+            midi_inference.download_if_not_exit(args.model_base_url, args.model_base)
 
         if args.model_token_url:
             _maybe_remove(args.model_token, min_bytes=1_000_000)
             if not os.path.exists(args.model_token):
                 log(f"⬇️  Downloading model token → {args.model_token}")
-            app_onnx.download_if_not_exit(args.model_token_url, args.model_token)
+            midi_inference.download_if_not_exit(args.model_token_url, args.model_token)
 
     except Exception as e:
         log(f"❌ Failed to download model files: {e}")
         raise
 
-def generate_in_thread(model, prompt, params, event_queue):
-    """Run generate() in a background thread and put events in queue."""
+def _model_specs(args):
+    """The models the server can serve: the --model-* files as `args.model_name`, plus the models of
+    the --models JSON file, {name: {"model_config", "model_base", "model_token", and optionally the
+    "*_url" of each and "quantized"}}."""
+    specs = {args.model_name: argparse.Namespace(
+        model_config=args.model_config, model_base=args.model_base, model_token=args.model_token,
+        model_config_url=args.model_config_url, model_base_url=args.model_base_url,
+        model_token_url=args.model_token_url, quantized=args.quantized,
+        no_download=args.no_download)}
+    if args.models:
+        with open(args.models, "r") as f:
+            models = json.load(f)
+        for name, spec in models.items():
+            spec = argparse.Namespace(**{"model_config_url": None, "model_base_url": None,
+                                         "model_token_url": None, "quantized": False, **spec,
+                                         "no_download": args.no_download})
+            spec.model_config = _resolve_model_path(spec.model_config)
+            spec.model_base = _resolve_model_path(spec.model_base)
+            spec.model_token = _resolve_model_path(spec.model_token)
+            specs[name] = spec
+    return specs
+
+
+def _session_paths(spec, *, force: bool = False):
+    """The model_base/model_token files to run: the downloaded ones, or their INT8 variants for a
+    quantized spec (quantized from them on first use, again after a re-download when `force`)."""
+    if not spec.quantized:
+        return spec.model_base, spec.model_token
+    from quantize import quantized_model
+    if force:
+        for path in (quantized_path(spec.model_base), quantized_path(spec.model_token)):
+            if os.path.exists(path):
+                os.remove(path)
+    return quantized_model(spec.model_base), quantized_model(spec.model_token)
+
+
+class ServedModel(ModelPair):
+    """A loaded model with its own batch scheduler and prefix cache (kv caches only fit their
+    model)."""
+
+    def __init__(self, name, model_base, model_token, tokenizer, nbytes):
+        super().__init__(name, model_base, model_token, tokenizer, nbytes)
+        self.prefix_cache = PrefixCache(prefix_cache_bytes) if prefix_cache_bytes > 0 else None
+        self.scheduler = BatchScheduler(self.model, max_batch=max_batch,
+                                        prefix_cache=self.prefix_cache)
+        self.scheduler.start()
+
+    def close(self):
+        self.scheduler.stop()
+        log(f"Unloaded model {self.name!r}")
+
+
+def model_size(name):
+    """ModelRegistry size: bytes of the files load_model(name) will load, fetched if needed."""
+    spec = model_specs[name]
+    _ensure_model_files(spec)
+    return model_nbytes(*_session_paths(spec))
+
+
+def load_model(name):
+    """ModelRegistry loader: download the model's files if needed and start serving it."""
+    spec = model_specs[name]
+    log(f"Loading model {name!r}: {spec.model_base}, {spec.model_token}")
+    start = time.monotonic()
+    _ensure_model_files(spec)
     try:
-        generator = np.random.RandomState(params['seed'])
-        prompt_len = int(getattr(prompt, "shape", [0])[0]) if prompt is not None else 0
-        max_len = int(params['gen_events']) + prompt_len
-        for token_seq in generate(
-            model,
-            prompt=prompt,
-            batch_size=1,
-            max_len=max_len,
-            temp=params['temp'],
-            top_p=params['top_p'],
-            top_k=params['top_k'],
-            disable_patch_change=bool(params.get('disable_patch_change', False)),
-            disable_control_change=bool(params.get('disable_control_change', False)),
-            disable_channels=params.get('disable_channels', None),
-            generator=generator
-        ):
-            # Put event in queue for async handler to consume
-            event_queue.put(('event', token_seq))
-        
-        # Signal completion
-        event_queue.put(('complete', None))
+        model_base_path, model_token_path = _session_paths(spec)
+        model_base = create_session(model_base_path, providers, **session_settings)
+        model_token = create_session(model_token_path, providers, **session_settings)
     except Exception as e:
-        event_queue.put(('error', str(e)))
+        # Common when a previous run was interrupted mid-download leaving a partial file.
+        msg = str(e)
+        if (not spec.no_download) and (
+            "INVALID_PROTOBUF" in msg
+            or "Protobuf parsing failed" in msg
+            or "NO_SUCHFILE" in msg
+            or "File doesn't exist" in msg
+        ):
+            log(f"⚠️  Model load failed ({e}); forcing re-download and retrying once...")
+            _ensure_model_files(spec, force=True)
+            model_base_path, model_token_path = _session_paths(spec, force=True)
+            model_base = create_session(model_base_path, providers, **session_settings)
+            model_token = create_session(model_token_path, providers, **session_settings)
+        else:
+            raise
+    tokenizer = get_tokenizer(spec.model_config)
+    model = ServedModel(name, model_base, model_token, tokenizer,
+                        model_nbytes(model_base_path, model_token_path))
+    log(f"✅ Model {name!r} loaded in {time.monotonic() - start:.1f}s "
+        f"(tokenizer {tokenizer.version}, vocab {tokenizer.vocab_size}, "
+        f"{model.nbytes / 2 ** 20:.0f} MB{', int8' if spec.quantized else ''})")
+    warmup_model(model)
+    return model
+
+
+def warmup_model(model: ServedModel):
+    """Decode synthetic sessions through the model's scheduler at each warmup batch size and past
+    length.
+
+    The first runs of an ORT session grow its memory arena and pick kernels for the new shapes;
+    doing that here keeps the cost away from the first requests.
+    """
+    if not warmup_batch_sizes or not warmup_past_lengths:
+        return
+    scheduler = model.scheduler
+    prompt = build_initial_prompt(model.tokenizer)
+    # Synthetic prompts must not take up prefix cache memory
+    prefix_cache, scheduler.prefix_cache = scheduler.prefix_cache, None
+    start = time.monotonic()
+    try:
+        for past in warmup_past_lengths:
+            filler = np.repeat(prompt[-1:], max(past - len(prompt), 0), axis=0)
+            rows = np.concatenate([prompt, filler])
+            for batch_size in warmup_batch_sizes:
+                batch_size = min(batch_size, scheduler.max_batch)
+                step_start = time.monotonic()
+                done = threading.Semaphore(0)
+                errors = []
+
+                def on_event(msg_type, data, done=done, errors=errors):
+                    if msg_type == 'error':
+                        errors.append(data)
+                    if msg_type in ('complete', 'error'):
+                        done.release()
+
+                params = {"seed": 0, "gen_events": warmup_events, "temp": 1.0, "top_p": 0.98,
+                          "top_k": 20}
+                for i in range(batch_size):
+                    scheduler.submit(StreamSession(model.tokenizer, rows, dict(params, seed=i),
+                                                   on_event))
+                for _ in range(batch_size):
+                    done.acquire()
+                if errors:
+                    raise RuntimeError(f"Warmup of {model.name!r} failed: {errors[0]}")
+                log(f"   Warmup {model.name!r}: batch {batch_size}, past {len(rows)} events, "
+                    f"{warmup_events} events in {time.monotonic() - step_start:.2f}s")
+    finally:
+        scheduler.prefix_cache = prefix_cache
+    log(f"🔥 Warmup of {model.name!r} done in {time.monotonic() - start:.2f}s")
+
+
+def health_check(*args):
+    """websockets process_request hook: GET /health answers 200 once the server is ready and 503
+    while it loads and warms up the default model; until then websocket handshakes are refused with
+    503 too.
+
+    websockets calls this with (connection, request) or, in its legacy server, (path,
+    request_headers)."""
+    if isinstance(args[0], str):
+        connection, path = None, args[0]
+    else:
+        connection, path = args[0], args[1].path
+    if path.split("?")[0] == "/health":
+        status = HTTPStatus.OK if ready else HTTPStatus.SERVICE_UNAVAILABLE
+        body = "ready\n" if ready else "warming up\n"
+    elif not ready:
+        status, body = HTTPStatus.SERVICE_UNAVAILABLE, "warming up, retry shortly\n"
+    else:
+        return None
+    if connection is None:
+        return status, [("Content-Type", "text/plain")], body.encode()
+    return connection.respond(status, body)
+
+
+async def acquire_model(name):
+    """The ServedModel `name` (the default model if None) for a request, loaded off the event loop
+    if it is not resident. Hand it back with model_registry.release(model.name)."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, model_registry.acquire, name or default_model)
+
 
 def build_initial_prompt(
     tokenizer,
@@ -271,7 +438,8 @@ def build_initial_prompt(
             patches[i] = patch2number[instr]
             i = (i + 1) if i != 8 else 10
 
-    if drum_kit and isinstance(drum_kit, str) and drum_kit != "None" and drum_kit in drum_kits2number:
+    if (drum_kit and isinstance(drum_kit, str) and drum_kit != "None"
+            and drum_kit in drum_kits2number):
         patches[9] = drum_kits2number[drum_kit]
     
     for idx, (c, p) in enumerate(patches.items()):
@@ -280,6 +448,819 @@ def build_initial_prompt(
     return np.array(mid, dtype=np.int64)
 
 
+def _parse_duration(params):
+    """Stop criterion in musical time, as keyword arguments for generate / StreamSession params.
+
+    `duration` with `duration_unit` one of ticks, beats, bars or seconds (default beats), and
+    `let_notes_finish` (default true) to keep notes that sound past the end.
+    """
+    if params.get("duration") is None:
+        return {}
+    unit = params.get("duration_unit", "beats")
+    if unit not in TIME_UNITS:
+        raise ValueError(f"Invalid duration_unit: {unit}, expected one of {', '.join(TIME_UNITS)}")
+    return {
+        "duration": float(params["duration"]),
+        "duration_unit": unit,
+        "let_notes_finish": bool(params.get("let_notes_finish", True)),
+    }
+
+
+def _flush_policy(params):
+    """Event coalescing of a stream: flush_events, flush_bytes and flush_ms request params, each
+    optional.
+
+    Returns EventBatcher keyword arguments, {} (one message per event) when none is given.
+    """
+    policy = {}
+    if params.get("flush_events") is not None:
+        policy["max_events"] = max(int(params["flush_events"]), 1)
+    if params.get("flush_bytes") is not None:
+        policy["max_bytes"] = max(int(params["flush_bytes"]), 1)
+    if params.get("flush_ms") is not None:
+        policy["max_delay"] = max(float(params["flush_ms"]), 0.0) / 1000
+    return policy
+
+
+def _snapshot_mode(params):
+    """'full' (default): every snapshot is the whole MIDI file, 'delta': only what changed since the
+    last one"""
+    mode = params.get("snapshot_mode", "full")
+    if mode not in ("full", "delta"):
+        raise ValueError(f"snapshot_mode must be 'full' or 'delta', got {mode!r}")
+    return mode
+
+
+def _disabled_tracks(tokenizer, prompt, params):
+    """Tracks the decoding grammar disallows.
+
+    Either given as `disable_tracks`, or with `restrict_tracks` every track that has no patch_change
+    in the prompt. With a single instrument the track is then forced and never sampled.
+    """
+    if "disable_tracks" in params:
+        return params["disable_tracks"]
+    if not params.get("restrict_tracks", False):
+        return None
+    patch_change_id = tokenizer.event_ids["patch_change"]
+    tracks = set()
+    for tokens in prompt.tolist():
+        if tokens[0] == patch_change_id:
+            tracks.add(tokenizer.tokens2event(tokens)[3])
+    if not tracks:
+        return None
+    return [t for t in range(len(tokenizer.parameter_ids["track"])) if t not in tracks]
+
+
+def _prompt_and_constraints(tokenizer, params):
+    """Initial prompt of a stream-events or generate-midi request and its decoding constraints.
+
+    Returns (prompt, instruments, constraints) with constraints the disable_* keyword arguments of
+    generate() and StreamSession. Constraints the client did not choose mirror app.py: when
+    instruments or drums are given, patch changes are disabled and the channels restricted to
+    theirs.
+    """
+    instruments = params.get("instruments", ["Acoustic Grand"])
+    drum_kit = params.get("drum_kit", "None")
+    prompt = build_initial_prompt(
+        tokenizer,
+        bpm=int(params.get("bpm", 120)),
+        instruments=instruments,
+        drum_kit=drum_kit,
+        time_sig=params.get("time_sig", None),
+        key_sig=params.get("key_sig", None),
+    )
+
+    allow_cc = params.get("allow_cc", True)
+    disable_control_change = bool(params.get("disable_control_change", not allow_cc))
+    disable_patch_change = None
+    if "disable_patch_change" in params:
+        disable_patch_change = bool(params["disable_patch_change"])
+    disable_channels = params.get("disable_channels", None)
+
+    if disable_patch_change is None or disable_channels is None:
+        used_channels = []
+        if isinstance(instruments, list) and len(instruments) > 0:
+            # Channels assigned in build_initial_prompt: 0..8 then 10.. as needed
+            ch = 0
+            for _ in instruments:
+                used_channels.append(ch)
+                ch = (ch + 1) if ch != 8 else 10
+        if isinstance(drum_kit, str) and drum_kit != "None":
+            used_channels.append(9)
+
+        if len(used_channels) > 0:
+            if disable_patch_change is None:
+                disable_patch_change = True
+            if disable_channels is None:
+                disable_channels = [c for c in range(16) if c not in set(used_channels)]
+
+    return prompt, instruments, {
+        "disable_patch_change": bool(disable_patch_change),
+        "disable_control_change": disable_control_change,
+        "disable_channels": disable_channels,
+        "disable_tracks": _disabled_tracks(tokenizer, prompt, params),
+    }
+
+
+def wire_format_of(websocket):
+    """wire format of a connection, or of the connection of a StreamChannel"""
+    return wire_formats.get(getattr(websocket, "websocket", websocket), wire_protocol.JSON)
+
+
+async def send_msg(websocket, msg):
+    """Send a server message in the connection's wire format (JSON text or protobuf binary
+    frames)."""
+    stream_id = getattr(websocket, "stream_id", None)
+    if stream_id is not None:
+        msg = dict(msg, stream_id=stream_id)
+    await websocket.send(wire_protocol.encode(msg, wire_format_of(websocket)))
+
+
+class EventBatcher:
+    """Coalesces the event messages of one stream into "events" frames.
+
+    A frame goes out once it holds `max_events` events or `max_bytes` bytes, or `max_delay` seconds
+    after its first event, and before any other message so the order is kept. The first event of a
+    stream is sent at once. Without a policy every event is its own "event" message.
+    """
+
+    def __init__(self, websocket, max_events=None, max_bytes=None, max_delay=None):
+        self.websocket = websocket
+        self.wire_format = wire_format_of(websocket)
+        self.stream_id = getattr(websocket, "stream_id", None)
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.enabled = any(v is not None for v in (max_events, max_bytes, max_delay))
+        self.items = []
+        self.nbytes = 0
+        self.deadline = None
+        self.sent = 0
+
+    def timeout(self):
+        """seconds until the pending frame is due, None when nothing waits for a deadline"""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    async def add(self, msg):
+        if not self.enabled:
+            await send_msg(self.websocket, msg)
+            self.sent += 1
+            return
+        item = wire_protocol.encode_batch_item(msg, self.wire_format)
+        self.items.append(item)
+        self.nbytes += len(item)
+        if self.deadline is None and self.max_delay is not None:
+            self.deadline = time.monotonic() + self.max_delay
+        if (self.sent == 0
+                or (self.max_events is not None and len(self.items) >= self.max_events)
+                or (self.max_bytes is not None and self.nbytes >= self.max_bytes)):
+            await self.flush()
+
+    async def flush(self):
+        if not self.items:
+            return
+        items, self.items, self.nbytes, self.deadline = self.items, [], 0, None
+        self.sent += len(items)
+        await self.websocket.send(wire_protocol.encode_batch(items, self.wire_format,
+                                                             self.stream_id))
+
+
+async def send_snapshot(websocket, detokenizer, event_count):
+    """Send the whole piece so far as a MIDI file."""
+    try:
+        # The detokenizer already holds the score of every event so far
+        mid_seq = detokenizer.score()
+        midi_bytes = MIDI.score2midi(mid_seq)
+
+        # Send MIDI snapshot
+        snapshot_msg = {
+            "type": "snapshot",
+            "index": event_count,
+            "total_events": len(detokenizer),
+            "midi_b64": midi_bytes,
+            "size_bytes": len(midi_bytes)
+        }
+        await send_msg(websocket, snapshot_msg)
+
+        log(f"📦 Sent snapshot at {event_count} events: {len(midi_bytes)} bytes")
+    except websockets.exceptions.ConnectionClosed:
+        raise
+    except Exception as e:
+        log(f"Snapshot error at {event_count}: {e}")
+
+
+async def send_delta_snapshot(websocket, encoder, event_count):
+    """Send the MIDI track bytes added since the last delta snapshot (see DeltaMIDIEncoder)."""
+    try:
+        delta = encoder.delta()
+        tracks = [{
+            "track": track_idx,
+            "data_b64": data,
+            "tail_b64": tail
+        } for track_idx, data, tail in delta["tracks"]]
+        await send_msg(websocket, {
+            "type": "snapshot_delta",
+            "seq": delta["seq"],
+            "index": event_count,
+            "total_events": len(encoder.detokenizer),
+            "ticks": delta["ticks"],
+            "tracks": tracks
+        })
+
+        size = sum(len(data) + len(tail) for _, data, tail in delta["tracks"])
+        log(f"📦 Sent delta snapshot #{delta['seq']} at {event_count} events: {size} bytes")
+    except websockets.exceptions.ConnectionClosed:
+        raise
+    except Exception as e:
+        log(f"Delta snapshot error at {event_count}: {e}")
+
+
+async def send_resync(websocket, session):
+    """Send the whole piece of a running stream, with the committed delta state when it streams
+    deltas."""
+    detokenizer = session.detokenizer
+    if detokenizer is None:
+        return
+    midi_bytes = MIDI.score2midi(detokenizer.score())
+    msg = {
+        "type": "snapshot_resync",
+        "total_events": len(detokenizer),
+        "midi_b64": midi_bytes,
+        "size_bytes": len(midi_bytes)
+    }
+    if session.snapshots is not None:
+        state = session.snapshots.resync()
+        msg["seq"] = state["seq"]
+        msg["ticks"] = state["ticks"]
+        msg["tracks"] = [{"track": track_idx, "data_b64": data}
+                         for track_idx, data in state["tracks"]]
+    await send_msg(websocket, msg)
+    log(f"🔁 Sent resync: {len(detokenizer)} events, {len(midi_bytes)} bytes")
+
+
+def event_sink(event_queue: asyncio.Queue):
+    """Callback for generation threads that hands (msg_type, data) to the event loop without
+    blocking it."""
+    loop = asyncio.get_running_loop()
+
+    def put(msg_type, data):
+        try:
+            loop.call_soon_threadsafe(event_queue.put_nowait, (msg_type, data))
+        except RuntimeError:
+            pass  # loop closed, nobody is listening anymore
+
+    return put
+
+
+def generate_async(*args, **kwargs):
+    """Queue midi_inference.generate on the generate pool.
+
+    Returns (queue position, async iterator over the generated events, dequeue), raises ServerBusy
+    when the pool queue is full. The event loop stays free while the job waits and runs; dequeue()
+    drops the job if it is still waiting, its events then end right away.
+    """
+    event_queue = asyncio.Queue()
+    put = event_sink(event_queue)
+
+    def run():
+        try:
+            for token_seq in generate(*args, **kwargs):
+                put('event', token_seq)
+        except Exception as e:
+            put('error', e)
+
+    position, future = generate_pool.submit(run)
+    # once the pool counts the job as done, so the next request does not find it still running
+    future.add_done_callback(lambda _: put('complete', None))
+
+    def dequeue():
+        generate_pool.cancel(future)
+
+    return position, _iter_events(event_queue), dequeue
+
+
+async def _iter_events(event_queue):
+    while True:
+        msg_type, data = await event_queue.get()
+        if msg_type == 'complete':
+            return
+        if msg_type == 'error':
+            raise data
+        yield data
+
+
+async def stream_session(websocket, session, event_queue, snapshot_mode="full", flush=None):
+    """Forward the events of a submitted session to the client until it completes or fails.
+
+    Snapshots are full MIDI files, or with snapshot_mode "delta" the track bytes added since the
+    previous one; a delta stream that continues a delta stream carries on its sequence numbers,
+    otherwise they restart at 1. `flush` is the EventBatcher policy of the request (see
+    _flush_policy).
+    """
+    batcher = EventBatcher(websocket, **(flush or {}))
+    # Stream events as they arrive from queue
+    event_count = 0
+    # Score of the piece so far, kept on the session so a continuation does not rebuild it
+    detokenizer = session.detokenizer
+    if detokenizer is None or len(detokenizer) != session.request_start:
+        detokenizer = StreamingDetokenizer(session.tokenizer)
+        detokenizer.extend(session.tokens[:session.request_start])
+    session.detokenizer = detokenizer
+    encoder = None
+    if snapshot_mode == "delta":
+        encoder = session.snapshots
+        if encoder is None or encoder.detokenizer is not detokenizer:
+            encoder = DeltaMIDIEncoder(detokenizer)
+    session.snapshots = encoder
+
+    async def deliver(msg=None):
+        # Sent events no longer count towards the session's max_backlog, a held back session may
+        # decode again
+        if msg is not None:
+            await batcher.add(msg)
+        if session.backlogged():
+            await batcher.flush()
+        backlogged = session.backlogged()
+        session.delivered = session.request_start + batcher.sent
+        if backlogged:
+            session.wake()
+
+    async def snapshot():
+        await batcher.flush()
+        if encoder is not None:
+            await send_delta_snapshot(websocket, encoder, event_count)
+        else:
+            await send_snapshot(websocket, detokenizer, event_count)
+    gen_events = session.gen_events
+    snapshot_at = 0
+    running = True
+    
+    while running:
+        # Wakes as soon as the scheduler thread hands over an event, costs nothing while waiting
+        timeout = batcher.timeout()
+        if timeout is None:
+            msg_type, data = await event_queue.get()
+        else:
+            try:
+                msg_type, data = await asyncio.wait_for(event_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                # Coalesced events waited long enough
+                await batcher.flush()
+                await deliver()
+                continue
+
+        if msg_type == 'event':
+            # Got one event token sequence!
+            token_seq = data
+            event_count += 1
+            
+            # Convert token sequence to event
+            try:
+                # token_seq is (1, max_token_seq) - get the first row
+                token_list = token_seq[0].tolist() if token_seq.ndim > 1 else token_seq.tolist()
+                event = session.tokenizer.tokens2event(token_list)
+                detokenizer.append(token_list)
+                
+                # Send event immediately, or coalesced with the next ones by the request's flush
+                # policy
+                event_msg = {
+                    "type": "event",
+                    "index": event_count,
+                    "event": event,
+                    "tokens": token_list
+                }
+                await deliver(event_msg)
+                
+                if event_count % 10 == 0:  # Log every 10 events to reduce spam
+                    log(f"→ Sent event #{event_count}: {event}")
+                
+                # Every 20 events, send a MIDI snapshot
+                if event_count % 20 == 0 or event_count == gen_events:
+                    await snapshot()
+                    snapshot_at = event_count
+            
+            except Exception as e:
+                log(f"Event decode error: {e}")
+                continue
+        
+        elif msg_type == 'complete':
+            # Generation finished
+            running = False
+
+            await batcher.flush()
+
+            # Stopped early (duration or eos): the last events are not in a snapshot yet
+            if snapshot_at != event_count and session.stop_reason != "cancelled":
+                await snapshot()
+            
+            # Send completion message
+            complete_msg = {
+                "type": "complete",
+                "total_events": event_count,
+                "session_id": session.session_id,
+                "can_continue": not session.finished,
+                "reason": session.stop_reason,
+                "prefix_cached_events": session.prefix_len
+            }
+            await send_msg(websocket, complete_msg)
+            
+            log(f"✅ Stream complete: {event_count} events sent")
+            log(f"   - Total snapshots: {event_count // 20}")
+            log(f"   - Buffer final size: {len(detokenizer)}")
+            if session.scheduler is not None and session.scheduler.prefix_cache is not None:
+                log(f"   - Prefix cache: {session.scheduler.prefix_cache.stats()}")
+
+            # Keep the kv cache so the client can continue this piece without prefill
+            session_store.put(session)
+        
+        elif msg_type == 'error':
+            # Error in generation thread
+            running = False
+            error_msg = str(data)
+            log(f"❌ Generation error: {error_msg}")
+            await batcher.flush()
+            await send_msg(websocket, {
+                "status": "error",
+                "error": error_msg
+            })
+
+
+def cancel_live(live):
+    """Cancel the request running on a stream, if any; it ends within one event step, or before it
+    starts if it is still loading its model."""
+    if live["session"] is not None:
+        live["session"].cancel()
+        live["session"].wake()
+    if live["cancel"] is not None:
+        live["cancel"].set()
+    if live["dequeue"] is not None:
+        live["dequeue"]()
+
+
+class StreamChannel:
+    """One stream of a connection: the messages sent through it carry its stream_id (if it has
+    one)."""
+
+    def __init__(self, websocket, stream_id=None):
+        self.websocket = websocket
+        self.stream_id = stream_id
+
+    async def send(self, frame):
+        await self.websocket.send(frame)
+
+
+class ClientStream:
+    """Requests of one stream id, run in order by their own task while the connection's other
+    streams run."""
+
+    def __init__(self, channel: StreamChannel):
+        self.channel = channel
+        self.requests = deque()
+        self.live = {"session": None, "cancel": None, "dequeue": None}
+        self.task = None
+
+
+async def run_stream(streams, stream_id):
+    """Run the queued requests of a stream, then drop it so it no longer counts towards
+    max_streams."""
+    stream = streams[stream_id]
+    while stream.requests:
+        await handle_request(stream.channel, stream.requests.popleft(), stream.live)
+    del streams[stream_id]
+
+
+async def route_message(websocket, message, streams):
+    """Hand a client message to its stream, starting the stream if needed.
+
+    Requests with a "stream_id" run concurrently with the other streams of the connection, their
+    messages carry the same stream_id; requests without one form the default stream. Within a stream
+    requests run one at a time in order.
+
+    Playhead reports ({"action": "playhead", "seconds": s, "playing": bool}) are applied at once to
+    the stream's running request, so a paced stream keeps pace while its handler is busy streaming
+    it.
+
+    {"action": "resync"} sends the whole piece of the stream's running request again (see
+    send_resync).
+
+    A {"action": "cancel"} message, a new request on the same stream (unless it has "supersede":
+    false) and closing the connection cancel the running request, so no compute is spent on a stream
+    nobody wants anymore. A superseding request also drops the requests still waiting on the stream,
+    at most max_stream_requests others may wait behind the running one.
+    """
+    try:
+        request = json.loads(message)
+    except json.JSONDecodeError as e:
+        log(f"JSON decode error: {e}")
+        await send_msg(websocket, {
+            "status": "error",
+            "error": f"Invalid JSON: {str(e)}"
+        })
+        return
+    if not isinstance(request, dict):
+        await send_msg(websocket, {"status": "error", "error": "Requests must be JSON objects"})
+        return
+    action = request.get("action")
+    stream_id = request.get("stream_id")
+    stream = streams.get(stream_id)
+
+    if action == "protocol":
+        # Switch the frames this connection receives: "json" text or "protobuf" binary
+        params = request.get("params", request)
+        wire_format = params.get("format", wire_protocol.JSON)
+        if wire_format not in wire_protocol.FORMATS:
+            await send_msg(websocket, {
+                "status": "error",
+                "error": f"format must be one of {wire_protocol.FORMATS}, got {wire_format!r}"
+            })
+            return
+        wire_formats[websocket] = wire_format
+        await send_msg(websocket, {"type": "protocol", "format": wire_format})
+        return
+    if action == "playhead":
+        session = stream.live["session"] if stream is not None else None
+        if session is not None:
+            params = request.get("params", request)
+            session.set_playhead(params.get("seconds", 0.0), params.get("playing", True))
+            session.wake()
+        return
+    if action == "resync":
+        if stream is not None and stream.live["session"] is not None:
+            await send_resync(stream.channel, stream.live["session"])
+        return
+    if action == "cancel":
+        if stream is not None:
+            cancel_live(stream.live)
+        return
+
+    if stream is None:
+        if len(streams) >= max_streams:
+            await send_msg(StreamChannel(websocket, stream_id), {
+                "status": "error",
+                "error": f"Too many concurrent streams on this connection (max {max_streams})"
+            })
+            return
+        stream = streams[stream_id] = ClientStream(StreamChannel(websocket, stream_id))
+    if request.get("supersede", True) is not False:
+        stream.requests.clear()
+        cancel_live(stream.live)
+    elif len(stream.requests) >= max_stream_requests:
+        await send_msg(stream.channel, {
+            "status": "error",
+            "error": f"Too many requests waiting on this stream (max {max_stream_requests})"
+        })
+        return
+    stream.requests.append(request)
+    if stream.task is None or stream.task.done():
+        stream.task = asyncio.create_task(run_stream(streams, stream_id))
+
+
+async def handle_request(websocket, request, live):
+    """Run one request of a stream; `websocket` is the stream's StreamChannel.
+
+    stream-events and generate-midi run on the model named by the "model" param (the default model
+    if unset), a continue runs on the model of its session. The model stays loaded while the request
+    runs. The request's cancel event is in `live` before its first await, a cancel that arrives
+    while it loads its model or sends its start message stops it before it decodes.
+    """
+    model = None
+    cancel = live["cancel"] = threading.Event()
+    try:
+        action = request.get("action")
+
+        if action == "stream-events":
+            # TRUE EVENT STREAMING MODE
+            params = request.get("params", {})
+            snapshot_mode = _snapshot_mode(params)
+            flush = _flush_policy(params)
+            model = await acquire_model(params.get("model"))
+            tokenizer = model.tokenizer
+            
+            seed = int(params.get("seed", 999))
+            duration = _parse_duration(params)
+            default_events = 1024 if duration else 200
+            gen_events = int(params.get("gen_events", params.get("max_len", default_events)))
+            temp = float(params.get("temp", 0.85))
+            top_p = float(params.get("top_p", 0.95))
+            top_k = int(params.get("top_k", 50))
+            log(f"Starting event stream: {gen_events} events, seed={seed}, temp={temp}")
+            
+            prompt, instruments, constraints = _prompt_and_constraints(tokenizer, params)
+
+            # Create queue and params for the scheduler
+            event_queue = asyncio.Queue()
+            gen_params = {
+                'seed': seed,
+                'gen_events': gen_events,
+                'temp': temp,
+                'top_p': top_p,
+                'top_k': top_k,
+                **constraints,
+                'lookahead': params.get("lookahead"),
+                'max_backlog': params.get("max_backlog"),
+                **duration,
+            }
+            
+            # Join the scheduler's batch, events come back through the queue
+            session = StreamSession(
+                tokenizer,
+                prompt,
+                gen_params,
+                event_sink(event_queue)
+            )
+            session.model_name = model.name
+
+            # Send start message
+            await send_msg(websocket, {
+                "type": "start",
+                "session_id": session.session_id,
+                "params": {
+                    "seed": seed,
+                    "gen_events": gen_events,
+                    "temp": temp,
+                    "instruments": instruments,
+                    "model": model.name
+                }
+            })
+
+            live["session"] = session
+            if cancel.is_set():
+                # the scheduler drops it before its first step, it completes as cancelled
+                session.cancel()
+            model.scheduler.submit(session)
+            log("🔄 Session submitted to batch scheduler")
+
+            try:
+                await stream_session(websocket, session, event_queue, snapshot_mode, flush)
+            finally:
+                live["session"] = None
+
+        elif action == "continue":
+            # Resume a finished stream from its retained kv cache, nothing is prefilled
+            params = request.get("params", {})
+            snapshot_mode = _snapshot_mode(params)
+            flush = _flush_policy(params)
+            session_id = params.get("session_id", request.get("session_id"))
+            session = session_store.take(session_id)
+            if session is None:
+                await send_msg(websocket, {
+                    "status": "error",
+                    "error": f"Unknown or expired session: {session_id}"
+                })
+                return
+            model = await acquire_model(session.model_name)
+
+            duration = _parse_duration(params)
+            default_events = 1024 if duration else 200
+            gen_events = int(params.get("gen_events", params.get("max_len", default_events)))
+            event_queue = asyncio.Queue()
+            continued_from = len(session.tokens)
+            needs_decoding = session.resume(
+                dict(params, gen_events=gen_events, **duration),
+                event_sink(event_queue)
+            )
+            log(f"Continuing session {session_id}: {gen_events} events after {continued_from}")
+
+            await send_msg(websocket, {
+                "type": "start",
+                "session_id": session.session_id,
+                "params": {
+                    "gen_events": gen_events,
+                    "temp": session.temp,
+                    "continued_from": continued_from,
+                    "model": model.name
+                }
+            })
+
+            live["session"] = session
+            if needs_decoding:
+                if cancel.is_set():
+                    session.cancel()
+                model.scheduler.submit(session)
+            try:
+                await stream_session(websocket, session, event_queue, snapshot_mode, flush)
+            finally:
+                live["session"] = None
+        
+        elif action == "generate-midi":
+            # STANDARD GENERATION (wait for all events)
+            params = request.get("params", {})
+            model = await acquire_model(params.get("model"))
+            tokenizer = model.tokenizer
+            
+            seed = int(params.get("seed", 999))
+            duration = _parse_duration(params)
+            default_events = 1024 if duration else 80
+            gen_events = int(params.get("gen_events", params.get("max_len", default_events)))
+            temp = float(params.get("temp", 0.85))
+            top_p = float(params.get("top_p", 0.95))
+            top_k = int(params.get("top_k", 50))
+            log(f"Generating MIDI: {gen_events} events, seed={seed}")
+            
+            generator = np.random.RandomState(seed)
+            prompt, _, constraints = _prompt_and_constraints(tokenizer, params)
+
+            # Collect all events
+            prompt_len = int(getattr(prompt, "shape", [0])[0]) if prompt is not None else 0
+            max_len = gen_events + prompt_len
+
+            # Score of the piece, built as the events arrive like the streaming path does
+            detokenizer = StreamingDetokenizer(tokenizer)
+            if prompt is not None:
+                detokenizer.extend(prompt.tolist())
+            else:
+                detokenizer.append([tokenizer.bos_id]
+                                   + [tokenizer.pad_id] * (tokenizer.max_token_seq - 1))
+
+            if cancel.is_set():
+                log("🛑 Generation cancelled before it started")
+                await send_msg(websocket, {"status": "cancelled"})
+                return
+            try:
+                position, events, dequeue = generate_async(
+                    model.model,
+                    prompt=prompt,
+                    batch_size=1,
+                    max_len=max_len,
+                    temp=temp,
+                    top_p=top_p,
+                    top_k=top_k,
+                    generator=generator,
+                    prefix_cache=model.prefix_cache,
+                    cancel=cancel,
+                    **constraints,
+                    **duration
+                )
+            except ServerBusy as e:
+                log(f"⏳ Generate queue full, rejected ({generate_pool.stats()})")
+                await send_msg(websocket, {
+                    "status": "error",
+                    "error": str(e),
+                    "retry_after": e.retry_after
+                })
+                return
+            live["dequeue"] = dequeue
+            if position > 0:
+                # Every worker is busy: tell the client where it stands instead of going silent
+                await send_msg(websocket, {
+                    "type": "queued",
+                    "position": position,
+                    "expected_wait": generate_pool.expected_wait(position)
+                })
+
+            # events actually generated, a duration limit or eos may stop before gen_events
+            generated = 0
+            try:
+                async for token_seq in events:
+                    if getattr(token_seq, "ndim", 1) > 1:
+                        token_seq = token_seq[0]
+                    detokenizer.append(token_seq.tolist())
+                    generated += 1
+            finally:
+                live["dequeue"] = None
+            if cancel.is_set():
+                log(f"🛑 Generation cancelled after {generated} events")
+                await send_msg(websocket, {"status": "cancelled"})
+                return
+            
+            # Convert to MIDI
+            midi_bytes = MIDI.score2midi(detokenizer.score())
+            
+            # Send response
+            await send_msg(websocket, {
+                "status": "ok",
+                "events": generated,
+                "midi_b64": midi_bytes,
+                "size_bytes": len(midi_bytes)
+            })
+            
+            log(f"Generated {generated} events (+prompt {prompt_len}) ({len(midi_bytes)} bytes)")
+        
+        else:
+            await send_msg(websocket, {
+                "status": "error",
+                "error": f"Unknown action: {action}"
+            })
+
+    except Exception as e:
+        import traceback
+        log(f"Error: {type(e).__name__}: {e}")
+        log(f"Traceback:\n{traceback.format_exc()}")
+        try:
+            await send_msg(websocket, {
+                "status": "error",
+                "error": str(e)
+            })
+        except:
+            pass
+    finally:
+        live["cancel"] = None
+        if model is not None:
+            model_registry.release(model.name)
+
+
 async def handler(websocket, path=None):
     """WebSocket handler with true event streaming.
 
@@ -287,322 +1268,33 @@ async def handler(websocket, path=None):
     - (websocket, path)  [older]
     - (websocket)        [newer]
     """
-    global model_base, model_token, tokenizer, device
     if path is None:
         # websockets>=12 passes only the connection; path is available on the protocol.
         path = getattr(websocket, "path", None)
     client_addr = websocket.remote_address
-    log(f"Client connected: {client_addr} path={path}")
-    
+    if getattr(websocket, "subprotocol", None) == wire_protocol.PROTOBUF_SUBPROTOCOL:
+        wire_formats[websocket] = wire_protocol.PROTOBUF
+    log(f"Client connected: {client_addr} path={path} "
+        f"format={wire_formats.get(websocket, wire_protocol.JSON)}")
+
+    # stream id -> ClientStream; control messages reach a stream while it is busy streaming
+    streams = {}
     try:
         async for message in websocket:
-            try:
-                request = json.loads(message)
-                action = request.get("action")
-                
-                if action == "stream-events":
-                    # TRUE EVENT STREAMING MODE
-                    params = request.get("params", {})
-                    
-                    seed = int(params.get("seed", 999))
-                    gen_events = int(params.get("gen_events", params.get("max_len", 200)))
-                    temp = float(params.get("temp", 0.85))
-                    top_p = float(params.get("top_p", 0.95))
-                    top_k = int(params.get("top_k", 50))
-                    bpm = int(params.get("bpm", 120))
-                    instruments = params.get("instruments", ["Acoustic Grand"])
-                    drum_kit = params.get("drum_kit", "None")
-                    time_sig = params.get("time_sig", None)
-                    key_sig = params.get("key_sig", None)
-
-                    allow_cc = params.get("allow_cc", True)
-                    disable_control_change = bool(params.get("disable_control_change", not allow_cc))
-
-                    disable_patch_change = bool(params.get("disable_patch_change", False)) if "disable_patch_change" in params else None
-                    disable_channels = params.get("disable_channels", None) if "disable_channels" in params else None
-                    
-                    log(f"Starting event stream: {gen_events} events, seed={seed}, temp={temp}")
-                    
-                    # Send start message
-                    await websocket.send(json.dumps({
-                        "type": "start",
-                        "params": {
-                            "seed": seed,
-                            "gen_events": gen_events,
-                            "temp": temp,
-                            "instruments": instruments
-                        }
-                    }))
-                    
-                    # Build prompt
-                    prompt = build_initial_prompt(
-                        tokenizer,
-                        bpm=bpm,
-                        instruments=instruments,
-                        drum_kit=drum_kit,
-                        time_sig=time_sig,
-                        key_sig=key_sig,
-                    )
-
-                    # If the client didn't explicitly choose decoding constraints, mirror app.py defaults:
-                    # - when instruments/drums are specified, prevent patch changes and restrict channels.
-                    if disable_patch_change is None or disable_channels is None:
-                        used_channels = []
-                        if isinstance(instruments, list) and len(instruments) > 0:
-                            # Channels assigned in build_initial_prompt: 0..8 then 10.. as needed
-                            ch = 0
-                            for _ in instruments:
-                                used_channels.append(ch)
-                                ch = (ch + 1) if ch != 8 else 10
-                        if isinstance(drum_kit, str) and drum_kit != "None":
-                            used_channels.append(9)
-
-                        if len(used_channels) > 0:
-                            if disable_patch_change is None:
-                                disable_patch_change = True
-                            if disable_channels is None:
-                                disable_channels = [c for c in range(16) if c not in set(used_channels)]
-
-                    disable_patch_change = bool(disable_patch_change) if disable_patch_change is not None else False
-                    
-                    # Create model tuple
-                    model = (model_base, model_token, tokenizer)
-                    
-                    # Create queue and params for thread
-                    event_queue = queue.Queue()
-                    gen_params = {
-                        'seed': seed,
-                        'gen_events': gen_events,
-                        'temp': temp,
-                        'top_p': top_p,
-                        'top_k': top_k,
-                        'disable_patch_change': disable_patch_change,
-                        'disable_control_change': disable_control_change,
-                        'disable_channels': disable_channels,
-                    }
-                    
-                    # Start generation in background thread
-                    thread = threading.Thread(
-                        target=generate_in_thread,
-                        args=(model, prompt, gen_params, event_queue),
-                        daemon=True
-                    )
-                    thread.start()
-                    log("🔄 Generation thread started")
-                    
-                    # Stream events as they arrive from queue
-                    event_count = 0
-                    # Initialize buffer with prompt tokens (as list for detokenize)
-                    events_buffer = prompt.tolist()
-                    running = True
-                    
-                    while running:
-                        try:
-                            # Non-blocking check with small timeout for async friendliness
-                            msg_type, data = event_queue.get(timeout=0.01)
-                            
-                            if msg_type == 'event':
-                                # Got one event token sequence!
-                                token_seq = data
-                                event_count += 1
-                                
-                                # Convert token sequence to event
-                                try:
-                                    # token_seq is (1, max_token_seq) - get the first row
-                                    token_list = token_seq[0].tolist() if token_seq.ndim > 1 else token_seq.tolist()
-                                    event = tokenizer.tokens2event(token_list)
-                                    events_buffer.append(token_list)
-                                    
-                                    # Send event immediately
-                                    event_msg = {
-                                        "type": "event",
-                                        "index": event_count,
-                                        "event": event,
-                                        "tokens": token_list
-                                    }
-                                    await websocket.send(json.dumps(event_msg))
-                                    
-                                    if event_count % 10 == 0:  # Log every 10 events to reduce spam
-                                        log(f"→ Sent event #{event_count}: {event}")
-                                    
-                                    # Every 20 events, send a MIDI snapshot
-                                    if event_count % 20 == 0 or event_count == gen_events:
-                                        try:
-                                            # Convert accumulated events to MIDI
-                                            # detokenize expects a list of token sequences
-                                            mid_seq = tokenizer.detokenize(events_buffer)
-                                            midi_bytes = MIDI.score2midi(mid_seq)
-                                            midi_b64 = base64.b64encode(midi_bytes).decode('utf-8')
-                                            
-                                            # Send MIDI snapshot
-                                            snapshot_msg = {
-                                                "type": "snapshot",
-                                                "index": event_count,
-                                                "total_events": len(events_buffer),
-                                                "midi_b64": midi_b64,
-                                                "size_bytes": len(midi_bytes)
-                                            }
-                                            await websocket.send(json.dumps(snapshot_msg))
-                                            
-                                            log(f"📦 Sent snapshot at {event_count} events: {len(midi_bytes)} bytes")
-                                        except Exception as e:
-                                            log(f"Snapshot error at {event_count}: {e}")
-                                
-                                except Exception as e:
-                                    log(f"Event decode error: {e}")
-                                    continue
-                            
-                            elif msg_type == 'complete':
-                                # Generation finished
-                                running = False
-                                
-                                # Send completion message
-                                complete_msg = {
-                                    "type": "complete",
-                                    "total_events": event_count
-                                }
-                                await websocket.send(json.dumps(complete_msg))
-                                
-                                log(f"✅ Stream complete: {event_count} events sent")
-                                log(f"   - Total snapshots: {event_count // 20}")
-                                log(f"   - Buffer final size: {len(events_buffer)}")
-                            
-                            elif msg_type == 'error':
-                                # Error in generation thread
-                                running = False
-                                error_msg = str(data)
-                                log(f"❌ Generation error: {error_msg}")
-                                await websocket.send(json.dumps({
-                                    "status": "error",
-                                    "error": error_msg
-                                }))
-                        
-                        except queue.Empty:
-                            # No event ready yet, yield to event loop
-                            await asyncio.sleep(0.001)
-                
-                elif action == "generate-midi":
-                    # STANDARD GENERATION (wait for all events)
-                    params = request.get("params", {})
-                    
-                    seed = int(params.get("seed", 999))
-                    gen_events = int(params.get("gen_events", params.get("max_len", 80)))
-                    temp = float(params.get("temp", 0.85))
-                    top_p = float(params.get("top_p", 0.95))
-                    top_k = int(params.get("top_k", 50))
-                    bpm = int(params.get("bpm", 120))
-                    instruments = params.get("instruments", ["Acoustic Grand"])
-                    drum_kit = params.get("drum_kit", "None")
-                    time_sig = params.get("time_sig", None)
-                    key_sig = params.get("key_sig", None)
-
-                    allow_cc = params.get("allow_cc", True)
-                    disable_control_change = bool(params.get("disable_control_change", not allow_cc))
-
-                    disable_patch_change = bool(params.get("disable_patch_change", False)) if "disable_patch_change" in params else None
-                    disable_channels = params.get("disable_channels", None) if "disable_channels" in params else None
-                    
-                    log(f"Generating MIDI: {gen_events} events, seed={seed}")
-                    
-                    # Build prompt
-                    generator = np.random.RandomState(seed)
-                    prompt = build_initial_prompt(
-                        tokenizer,
-                        bpm=bpm,
-                        instruments=instruments,
-                        drum_kit=drum_kit,
-                        time_sig=time_sig,
-                        key_sig=key_sig,
-                    )
-
-                    if disable_patch_change is None or disable_channels is None:
-                        used_channels = []
-                        if isinstance(instruments, list) and len(instruments) > 0:
-                            ch = 0
-                            for _ in instruments:
-                                used_channels.append(ch)
-                                ch = (ch + 1) if ch != 8 else 10
-                        if isinstance(drum_kit, str) and drum_kit != "None":
-                            used_channels.append(9)
-
-                        if len(used_channels) > 0:
-                            if disable_patch_change is None:
-                                disable_patch_change = True
-                            if disable_channels is None:
-                                disable_channels = [c for c in range(16) if c not in set(used_channels)]
-
-                    disable_patch_change = bool(disable_patch_change) if disable_patch_change is not None else False
-                    
-                    # Create model tuple
-                    model = (model_base, model_token, tokenizer)
-                    
-                    # Collect all events
-                    prompt_len = int(getattr(prompt, "shape", [0])[0]) if prompt is not None else 0
-                    max_len = gen_events + prompt_len
-
-                    events_buffer = prompt.tolist() if prompt is not None else [[tokenizer.bos_id] + [tokenizer.pad_id] * (tokenizer.max_token_seq - 1)]
-
-                    for token_seq in generate(
-                        model,
-                        prompt=prompt,
-                        batch_size=1,
-                        max_len=max_len,
-                        temp=temp,
-                        top_p=top_p,
-                        top_k=top_k,
-                        disable_patch_change=disable_patch_change,
-                        disable_control_change=disable_control_change,
-                        disable_channels=disable_channels,
-                        generator=generator
-                    ):
-                        token_list = token_seq[0].tolist() if getattr(token_seq, "ndim", 1) > 1 else token_seq.tolist()
-                        events_buffer.append(token_list)
-                    
-                    # Convert to MIDI
-                    mid_seq = tokenizer.detokenize(events_buffer)
-                    midi_bytes = MIDI.score2midi(mid_seq)
-                    
-                    # Send response
-                    await websocket.send(json.dumps({
-                        "status": "ok",
-                        "events": gen_events,
-                        "midi_b64": base64.b64encode(midi_bytes).decode('utf-8'),
-                        "size_bytes": len(midi_bytes)
-                    }))
-                    
-                    log(f"Generated {gen_events} events (+prompt {prompt_len}) ({len(midi_bytes)} bytes)")
-                
-                else:
-                    await websocket.send(json.dumps({
-                        "status": "error",
-                        "error": f"Unknown action: {action}"
-                    }))
-            
-            except json.JSONDecodeError as e:
-                log(f"JSON decode error: {e}")
-                await websocket.send(json.dumps({
-                    "status": "error",
-                    "error": f"Invalid JSON: {str(e)}"
-                }))
-            
-            except Exception as e:
-                import traceback
-                log(f"Error: {type(e).__name__}: {e}")
-                log(f"Traceback:\n{traceback.format_exc()}")
-                try:
-                    await websocket.send(json.dumps({
-                        "status": "error",
-                        "error": str(e)
-                    }))
-                except:
-                    pass
-    
+            await route_message(websocket, message, streams)
     except websockets.exceptions.ConnectionClosed:
+        pass
+    finally:
+        for stream in list(streams.values()):
+            stream.requests.clear()
+            cancel_live(stream.live)
         log(f"Client disconnected: {client_addr}")
 
 
 def main():
-    global model_base, model_token, tokenizer, device
+    global model_registry, model_specs, default_model, providers, session_settings, max_batch
+    global prefix_cache_bytes, session_store, generate_pool, max_streams, max_stream_requests
+    global device, warmup_batch_sizes, warmup_past_lengths
     
     parser = argparse.ArgumentParser(description="WebSocket server with true event streaming")
     parser.add_argument("--host", type=str, default="0.0.0.0")
@@ -610,6 +1302,33 @@ def main():
     parser.add_argument("--model-config", type=str, default="models/default/config.json")
     parser.add_argument("--model-base", type=str, default="models/default/model_base.onnx")
     parser.add_argument("--model-token", type=str, default="models/default/model_token.onnx")
+    parser.add_argument(
+        "--model-name",
+        type=str,
+        default=os.environ.get("MODEL_NAME", "default"),
+        help="Name of the --model-* model, used by requests without a \"model\" param",
+    )
+    parser.add_argument(
+        "--models",
+        type=str,
+        default=os.environ.get("MODELS_CONFIG"),
+        help="JSON file of more models requests may pick by name: {name: {model_config, "
+             "model_base, model_token, model_*_url, quantized}}, loaded on first use",
+    )
+    parser.add_argument(
+        "--quantized",
+        action="store_true",
+        default=os.environ.get("MODEL_QUANTIZED", "0").lower() in ("1", "true", "yes"),
+        help="Serve the INT8 weight-quantized --model-* model (*.int8.onnx next to it, quantized "
+             "on first load when missing); models of --models pick it with \"quantized\": true",
+    )
+    parser.add_argument(
+        "--models-memory-mb",
+        type=int,
+        default=int(os.environ.get("MODELS_MEMORY_MB", 4096)),
+        help="Memory budget for resident models, the least recently used idle ones are unloaded "
+             "beyond it",
+    )
 
     # Auto-download defaults match the upstream midi-model ONNX demo.
     # Can be overridden via CLI or env vars.
@@ -647,6 +1366,98 @@ def main():
         help="Disable auto-download of model files",
     )
     parser.add_argument("--device", type=str, default="cuda", choices=["cuda", "cpu"])
+    parser.add_argument(
+        "--max-batch",
+        type=int,
+        default=int(os.environ.get("MAX_BATCH", 8)),
+        help="Max stream sessions decoded together in one batched step",
+    )
+    parser.add_argument(
+        "--prefix-cache-mb",
+        type=int,
+        default=int(os.environ.get("PREFIX_CACHE_MB", 256)),
+        help="Memory budget for cached prompt prefills of each loaded model (0 disables the "
+             "prefix cache)",
+    )
+    parser.add_argument(
+        "--session-memory-mb",
+        type=int,
+        default=int(os.environ.get("SESSION_MEMORY_MB", 1024)),
+        help="Memory budget for the kv caches of idle sessions kept for `continue`",
+    )
+    parser.add_argument(
+        "--generate-workers",
+        type=int,
+        default=int(os.environ.get("GENERATE_WORKERS", 2)),
+        help="Worker threads for generate-midi requests",
+    )
+    parser.add_argument(
+        "--generate-queue",
+        type=int,
+        default=int(os.environ.get("GENERATE_QUEUE", 8)),
+        help="generate-midi requests that may wait for a worker before new ones are rejected",
+    )
+    parser.add_argument(
+        "--max-streams",
+        type=int,
+        default=int(os.environ.get("MAX_STREAMS", 4)),
+        help="Concurrent streams (stream_id) per connection",
+    )
+    parser.add_argument(
+        "--max-stream-requests",
+        type=int,
+        default=int(os.environ.get("MAX_STREAM_REQUESTS", 4)),
+        help="Requests with supersede: false that may wait on one stream before new ones are "
+             "rejected",
+    )
+    parser.add_argument(
+        "--warmup-batch-sizes",
+        type=str,
+        default=os.environ.get("WARMUP_BATCH_SIZES", "1,8"),
+        help="Comma separated batch sizes each model decodes at startup (empty disables warmup)",
+    )
+    parser.add_argument(
+        "--warmup-past-lengths",
+        type=str,
+        default=os.environ.get("WARMUP_PAST_LENGTHS", "16,512"),
+        help="Comma separated prompt lengths (events) the warmup batches decode after",
+    )
+    parser.add_argument(
+        "--ort-profile",
+        type=str,
+        choices=list(SESSION_PROFILES),
+        default=os.environ.get("ORT_PROFILE", "default"),
+        help="ONNX Runtime session profile: ORT defaults, latency (one request at a time), "
+             "throughput (concurrent sessions share the cores) or low_memory",
+    )
+    parser.add_argument(
+        "--intra-op-threads",
+        type=int,
+        default=int(os.environ["ORT_INTRA_OP_THREADS"]) if os.environ.get("ORT_INTRA_OP_THREADS")
+        else None,
+        help="Threads of each ORT session, e.g. the container's CPU limit (default: the profile's, "
+             "else ORT's)",
+    )
+    parser.add_argument(
+        "--inter-op-threads",
+        type=int,
+        default=int(os.environ["ORT_INTER_OP_THREADS"]) if os.environ.get("ORT_INTER_OP_THREADS")
+        else None,
+        help="Threads running independent ORT nodes in parallel (default: the profile's, else "
+             "ORT's)",
+    )
+    parser.add_argument(
+        "--no-optimized-cache",
+        action="store_true",
+        default=os.environ.get("ORT_OPTIMIZED_CACHE", "1").lower() in ("0", "false", "no"),
+        help="Do not save ORT's optimized graphs next to the models for later starts",
+    )
+    parser.add_argument(
+        "--session-ttl",
+        type=float,
+        default=float(os.environ.get("SESSION_TTL", 600)),
+        help="Seconds an idle session is kept for `continue`",
+    )
     args = parser.parse_args()
 
     # Make MODEL_PATH effective for relative paths.
@@ -655,7 +1466,7 @@ def main():
     args.model_token = _resolve_model_path(args.model_token)
     
     device = args.device
-    app_onnx.device = device  # Update app_onnx module's device variable
+    midi_inference.device = device  # Update midi_inference module's device variable
     
     log("="*60)
     log("WebSocket Server with TRUE Event Streaming")
@@ -665,6 +1476,8 @@ def main():
     log(f"Model config: {args.model_config}")
     log(f"Model base: {args.model_base}")
     log(f"Model token: {args.model_token}")
+    if args.models:
+        log(f"More models: {args.models}")
     log("="*60)
     
     # Load models
@@ -681,40 +1494,37 @@ def main():
                     "falling back to CPU. Install 'onnxruntime-gpu' for CUDA."
                 )
             device = "cpu"
-            app_onnx.device = device
+            midi_inference.device = device
             providers = ["CPUExecutionProvider"]
 
         rt.set_default_logger_severity(3)
 
-        _ensure_model_files(args)
-
-        try:
-            model_base = rt.InferenceSession(args.model_base, providers=providers)
-            model_token = rt.InferenceSession(args.model_token, providers=providers)
-        except Exception as e:
-            # Common when a previous run was interrupted mid-download leaving a partial file.
-            msg = str(e)
-            if (not args.no_download) and (
-                "INVALID_PROTOBUF" in msg
-                or "Protobuf parsing failed" in msg
-                or "NO_SUCHFILE" in msg
-                or "File doesn't exist" in msg
-            ):
-                log(f"⚠️  Model load failed ({e}); forcing re-download and retrying once...")
-                _ensure_model_files(args, force=True)
-                model_base = rt.InferenceSession(args.model_base, providers=providers)
-                model_token = rt.InferenceSession(args.model_token, providers=providers)
-            else:
-                raise
-
-        tokenizer = get_tokenizer(args.model_config)
-
-        log("✅ Models loaded successfully")
-        log(f"Tokenizer version: {tokenizer.version}")
-        log(f"Vocab size: {tokenizer.vocab_size}")
+        session_settings = {
+            "profile": args.ort_profile,
+            "intra_op_threads": args.intra_op_threads,
+            "inter_op_threads": args.inter_op_threads,
+            "optimized_cache": not args.no_optimized_cache,
+        }
+        log(f"ORT sessions: {session_settings}")
+        max_batch = args.max_batch
+        prefix_cache_bytes = args.prefix_cache_mb * 1024 * 1024
+        model_specs = _model_specs(args)
+        default_model = args.model_name
+        model_registry = ModelRegistry(model_specs.keys(), load_model,
+                                       args.models_memory_mb * 1024 * 1024, size=model_size)
+        warmup_batch_sizes = [int(n) for n in args.warmup_batch_sizes.split(",") if n.strip()]
+        warmup_past_lengths = [int(n) for n in args.warmup_past_lengths.split(",") if n.strip()]
+        log(f"Models: {list(model_specs)} (default: {default_model}, "
+            f"budget {args.models_memory_mb} MB)")
+        log(f"Batch schedulers: max batch {args.max_batch} per model")
+        session_store = SessionStore(args.session_memory_mb * 1024 * 1024, args.session_ttl)
+        generate_pool = GeneratePool(args.generate_workers, args.generate_queue)
+        log(f"Generate pool: {args.generate_workers} workers, queue of {args.generate_queue}")
+        max_streams = args.max_streams
+        max_stream_requests = args.max_stream_requests
 
     except Exception as e:
-        log(f"❌ Failed to load models: {e}")
+        log(f"❌ Failed to set up the server: {e}")
         import traceback
         log(traceback.format_exc())
         sys.exit(1)
@@ -723,15 +1533,26 @@ def main():
     log("")
     log("🚀 Starting WebSocket server...")
     log(f"📡 Connect to: ws://{args.host}:{args.port}")
+    log(f"🩺 Readiness: http://{args.host}:{args.port}/health "
+        "(503 until the default model is loaded and warm)")
     log("")
     log("Available actions:")
+    log("  • protocol       - Choose the wire format: json (default) or protobuf "
+        "(see midi_stream.proto)")
     log("  • stream-events  - Stream events one-by-one as generated")
+    log("  • continue       - Continue a finished stream from its kept session")
+    log("  • playhead       - Report the playback position of a paced stream (lookahead param)")
+    log("  • resync         - Resend the whole piece of the running stream (snapshot_mode: delta)")
+    log("  • cancel         - Stop the running request (new requests supersede it too)")
     log("  • generate-midi  - Standard generation (wait for all events)")
+    log("  Requests with a stream_id run concurrently on one connection (max streams per "
+        f"connection: {args.max_streams}), their messages carry the stream_id")
     log("")
     log("Press Ctrl+C to stop")
     log("="*60)
     
     async def start():
+        global ready
         async with websockets.serve(
             handler,
             args.host,
@@ -739,11 +1560,28 @@ def main():
             ping_interval=20,
             ping_timeout=20,
             close_timeout=5,
+            select_subprotocol=wire_protocol.select_subprotocol,
+            process_request=health_check,
         ):
+            # The default model is loaded and warmed up behind the open port, the others on their
+            # first request
+            start_time = time.monotonic()
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, model_registry.acquire,
+                                                                 default_model)
+            except Exception as e:
+                log(f"❌ Failed to load models: {e}")
+                import traceback
+                log(traceback.format_exc())
+                return False
+            model_registry.release(default_model)
+            ready = True
+            log(f"✅ Ready in {time.monotonic() - start_time:.1f}s")
             await asyncio.Future()  # Run forever
     
     try:
-        asyncio.run(start())
+        if asyncio.run(start()) is False:
+            sys.exit(1)
     except KeyboardInterrupt:
         log("\n⚠️  Server stopped by user")
 